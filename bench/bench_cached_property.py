@@ -0,0 +1,49 @@
+"""
+Compare the cost of reading each kind of cached property against a plain
+attribute read.
+
+    $ python bench/bench_cached_property.py
+"""
+
+import timeit
+
+
+SETUP = '''
+from teena import (cached_property, instance_cached_property,
+                   slot_cached_property)
+
+class Plain(object):
+    def __init__(self):
+        self.value = 1
+
+class WeakRef(object):
+    @cached_property
+    def value(self):
+        return 1
+
+class Instance(object):
+    @instance_cached_property
+    def value(self):
+        return 1
+
+class Slot(object):
+    __slots__ = ('_cached_value',)
+
+    @slot_cached_property
+    def value(self):
+        return 1
+
+obj = %s()
+obj.value
+'''
+
+
+def main(number=1000000):
+    for kind in ('Plain', 'WeakRef', 'Instance', 'Slot'):
+        seconds = min(timeit.repeat('obj.value', SETUP % kind,
+                                    number=number, repeat=3))
+        print '%-10s %6.1f ns/read' % (kind, seconds / number * 1e9)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Compare deregistering and closing a tee's worth of outputs one fd at a time
+against doing it in bulk with an `FdSet`.
+
+    $ python bench/bench_close.py
+"""
+
+import os
+import time
+
+from teena.fdutils import FdSet, classify, close_fd, try_remove_handler
+from teena.thread_loop import ThreadLoop
+
+
+def setup(count):
+    loop = ThreadLoop()
+    fds = []
+    for _ in xrange(count // 2):
+        fds.extend(os.pipe())
+    for fd in fds:
+        classify(fd)
+        loop.add_handler(fd, lambda fd, events: None, loop.ERROR)
+    return loop, fds
+
+
+def one_at_a_time(loop, fds):
+    for fd in fds:
+        try_remove_handler(loop, fd)
+        close_fd(fd)
+
+
+def in_bulk(loop, fds):
+    fds = FdSet(fds)
+    fds.deregister(loop)
+    fds.close()
+
+
+def main(count=1000, repeat=20):
+    for name, teardown in [('one at a time', one_at_a_time),
+                           ('FdSet', in_bulk)]:
+        best = None
+        for _ in xrange(repeat):
+            loop, fds = setup(count)
+            start = time.time()
+            teardown(loop, fds)
+            elapsed = time.time() - start
+            loop.close()
+            best = elapsed if best is None else min(best, elapsed)
+        print '%-16s %6.0f ns/fd' % (name, best / count * 1e9)
+
+
+if __name__ == '__main__':
+    main()
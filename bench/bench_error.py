@@ -0,0 +1,49 @@
+"""
+Compare the cost of catching an error with `except Error.X` against catching
+`OSError` and comparing its errno by hand.
+
+    $ python bench/bench_error.py
+"""
+
+import timeit
+
+
+SETUP = '''
+import errno
+from teena import Error
+exc = OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+def fail():
+    raise exc
+'''
+
+CASES = [
+    ('except OSError + errno', '''
+try:
+    fail()
+except OSError, e:
+    if e.errno != errno.EAGAIN:
+        raise
+'''),
+    ('except Error.EAGAIN', '''
+try:
+    fail()
+except Error.EAGAIN:
+    pass
+'''),
+    ('except (Error.EINTR, Error.EAGAIN)', '''
+try:
+    fail()
+except (Error.EINTR, Error.EAGAIN):
+    pass
+'''),
+]
+
+
+def main(number=200000):
+    for name, stmt in CASES:
+        seconds = min(timeit.repeat(stmt, SETUP, number=number, repeat=3))
+        print '%-36s %6.0f ns/raise' % (name, seconds / number * 1e9)
+
+
+if __name__ == '__main__':
+    main()
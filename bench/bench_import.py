@@ -0,0 +1,42 @@
+"""
+Time how long a fresh interpreter takes to import teena, and some of its
+names, against starting up without importing it at all.
+
+    $ python bench/bench_import.py
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+
+CASES = [
+    ('python', 'pass'),
+    ('import teena', 'import teena'),
+    ('from teena import Error', 'from teena import Error'),
+    ('from teena import Pipe', 'from teena import Pipe'),
+    ('from teena import tee', 'from teena import tee'),
+]
+
+
+def time_run(statement, repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement],
+                              env=env)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(repeat=20):
+    for name, statement in CASES:
+        print '%-26s %6.1f ms' % (name, time_run(statement, repeat) * 1e3)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,115 @@
+import imp
+import importlib
+import sys
+from types import ModuleType
+
+
 DEFAULT_BUFSIZE = 4096
 
-from error import Error
-import fdutils
-from cached_property import cached_property
-from pipe import Pipe
-from tee import tee
+# Public name -> (submodule, name in it, or None for the submodule itself).
+# Nothing is imported until it's first used: `tee` and `splice` bring in
+# tornado and threading, and a script which only needs `Error` or `Pipe`
+# shouldn't have to pay for them.
+_exports = {
+    'BroadcastServer': ('broadcast', 'BroadcastServer'),
+    'Error': ('error', 'Error'),
+    'fdutils': ('fdutils', None),
+    'rawio': ('rawio', None),
+    'cached_property': ('cached_property', 'cached_property'),
+    'instance_cached_property': ('cached_property',
+                                 'instance_cached_property'),
+    'slot_cached_property': ('cached_property', 'slot_cached_property'),
+    'expiring_cached_property': ('cached_property',
+                                 'expiring_cached_property'),
+    'async_cached_property': ('cached_property', 'async_cached_property'),
+    'invalidate': ('cached_property', 'invalidate'),
+    'Pipe': ('pipe', 'Pipe'),
+    'PipePool': ('pipe', 'PipePool'),
+    'ReplayLog': ('replay', 'ReplayLog'),
+    'LogReader': ('replay', 'LogReader'),
+    'SharedRing': ('ring', 'SharedRing'),
+    'TeeHandle': ('handle', 'TeeHandle'),
+    'TeeStats': ('handle', 'TeeStats'),
+    'as_completed': ('handle', 'as_completed'),
+    'ring_tee': ('ring', 'ring_tee'),
+    'tee': ('tee', 'tee'),
+    'splice': ('splice', 'splice'),
+}
+
+__all__ = sorted(_exports)
+
+
+def _load(name):
+    submodule, attribute = _exports[name]
+    __import__(__name__ + '.' + submodule)
+    value = sys.modules[__name__ + '.' + submodule]
+    if attribute is not None:
+        value = getattr(value, attribute)
+    return value
+
+
+class _SharedName(object):
+
+    """
+    A name exported by a submodule which has the same name.
+
+    Importing `teena.tee` puts the submodule in the package's `__dict__`, as
+    `tee`. The `tee()` function has to win over it, as it always has, so its
+    name is a data descriptor, which takes precedence.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+
+    def __get__(self, module, cls):
+        if module is None:
+            return self
+        if self.value is None:
+            self.value = _load(self.name)
+        return self.value
+
+    def __set__(self, module, value):
+        self.value = value
+
+
+class _LazyModule(ModuleType):
+
+    """
+    The `teena` package, importing its public names on first access.
+
+    Its submodules can be got at as attributes, too (`teena.thread_loop`),
+    as they could when the package imported them all up front.
+    """
+
+    tee = _SharedName('tee')
+    splice = _SharedName('splice')
+    cached_property = _SharedName('cached_property')
+
+    def __getattr__(self, name):
+        if name not in _exports:
+            try:
+                imp.find_module(name, self.__path__)
+            except ImportError:
+                raise AttributeError(
+                    "'module' object has no attribute %r" % name)
+            # Importing it puts it in the package's `__dict__`.
+            return importlib.import_module(__name__ + '.' + name)
+        # From now on, it's found without calling `__getattr__()`.
+        value = self.__dict__[name] = _load(name)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports))
+
+
+def _install():
+    module = _LazyModule(__name__, __doc__)
+    module.__dict__.update(sys.modules[__name__].__dict__)
+    # Python 2 empties a module's globals when the module is freed, and these
+    # functions still use this module's globals.
+    module.__dict__['_module'] = sys.modules[__name__]
+    sys.modules[__name__] = module
+
+
+_install()
@@ -0,0 +1,147 @@
+"""
+Serving a stream to every client which connects to a TCP socket.
+
+    >>> server = BroadcastServer(camera_fd, ('0.0.0.0', 8554))
+    >>> with server.loop.background():
+    ...     pass
+
+A `BroadcastServer` is a `tee()` whose outputs are its clients. Clients are
+accepted on the tee's own loop, and sent the stream from wherever it's got
+to when they connect. A client which has gone away, or can't keep up, is
+dropped (and closed), without holding up anyone else. When the input ends,
+every client is sent what's left for it, and then disconnected, and the
+server stops listening.
+
+How each client's socket is set up depends on the `policy`:
+
+- `THROUGHPUT` sets `TCP_CORK`, so only full segments are sent (or what's
+  been waiting for 200ms), at the cost of a little latency.
+- `LATENCY` sets `TCP_NODELAY`, so every write is sent straight away, at
+  the cost of more, smaller packets.
+"""
+
+import errno
+import os
+import socket
+import time
+
+from teena.tee import WOULD_BLOCK, tee
+
+
+__all__ = ['BroadcastServer', 'THROUGHPUT', 'LATENCY']
+
+
+THROUGHPUT = 'throughput'
+LATENCY = 'latency'
+
+# The most a client can fall behind the stream by, by default, before it's
+# dropped.
+DEFAULT_MAX_CLIENT_BACKLOG = 1 << 22
+
+# The most clients accepted per wakeup, so a burst of connections can't
+# hold up the stream for long.
+ACCEPTS_PER_WAKEUP = 64
+
+# How long to stop accepting clients for when the process (or the system)
+# has run out of fds, rather than being woken straight away to fail again.
+ACCEPT_BACKOFF = 0.1
+
+
+class BroadcastServer(object):
+
+    """
+    A TCP server which sends everything from an input to every client.
+
+    The server listens on `address` (by default, a free port on the
+    loopback interface; see `address` for where it ended up) and runs on
+    `loop`, which is a tee of the input. A client with more than
+    `max_client_backlog` bytes of the stream waiting for it is dropped.
+    Any other keyword arguments are passed on to `tee()`.
+    """
+
+    def __init__(self, input_fd, address=('127.0.0.1', 0), policy=THROUGHPUT,
+                 max_client_backlog=DEFAULT_MAX_CLIENT_BACKLOG,
+                 bufsize=1 << 16, listen_backlog=128, **tee_options):
+        if policy not in (THROUGHPUT, LATENCY):
+            raise ValueError("Unknown broadcast policy: %r" % (policy,))
+        self.policy = policy
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(listen_backlog)
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+        self.listening = True
+        # The timer for listening again, while out of fds.
+        self._backoff = None
+
+        self.loop = tee(input_fd, (), bufsize=bufsize,
+                        max_backlog=max_client_backlog, keep_reading=True,
+                        **tee_options)
+        self.loop.add_handler(self.socket.fileno(), self._accept,
+                              self.loop.READ)
+        self.loop.on_input_end = self.close
+
+    @property
+    def stats(self):
+        """
+        The tee's `teena.handle.TeeStats`, keyed by client fd.
+
+        Since fd numbers are reused, these are for the latest client to have
+        each one.
+        """
+        return self.loop.stats
+
+    def _accept(self, fd, events):
+        for _ in xrange(ACCEPTS_PER_WAKEUP):
+            try:
+                client, address = self.socket.accept()
+            except socket.error, exc:
+                if exc.errno in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                elif exc.errno in WOULD_BLOCK:
+                    return
+                elif exc.errno in (errno.EMFILE, errno.ENFILE):
+                    # The connection waits in the backlog until there's an
+                    # fd for it.
+                    self._back_off()
+                    return
+                raise
+            self._configure(client)
+            # The tee closes its outputs by fd, so it gets an fd of its own,
+            # which the socket object can't close from under it.
+            client_fd = os.dup(client.fileno())
+            client.close()
+            self.loop.add_output(client_fd, owned=True)
+
+    def _back_off(self):
+        self.loop.remove_handler(self.socket.fileno())
+        self._backoff = self.loop.add_timeout(time.time() + ACCEPT_BACKOFF,
+                                              self._listen_again)
+
+    def _listen_again(self):
+        self._backoff = None
+        self.loop.add_handler(self.socket.fileno(), self._accept,
+                              self.loop.READ)
+
+    def _configure(self, client):
+        client.setblocking(False)
+        if self.policy == LATENCY:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        elif hasattr(socket, 'TCP_CORK'):
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    def close(self):
+        """
+        Stop accepting clients; those already connected carry on.
+
+        This has to be called in the loop's thread; from any other, use
+        `server.loop.add_callback(server.close)`.
+        """
+        if self.listening:
+            self.listening = False
+            if self._backoff is not None:
+                self.loop.remove_timeout(self._backoff)
+                self._backoff = None
+            self.loop.remove_handler(self.socket.fileno())
+            self.socket.close()
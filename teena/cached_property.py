@@ -1,23 +1,102 @@
+from functools import partial
+import operator
+import threading
+import time
 import weakref
 
-__all__ = ['cached_property']
+__all__ = ['cached_property', 'instance_cached_property',
+           'slot_cached_property', 'expiring_cached_property',
+           'async_cached_property', 'invalidate']
 
 
-class CachedProperty(object):
+class InFlight(object):
 
-    __slots__ = ('func', 'cache')
+    """
+    Per-instance locks for the computations of a single cached property.
 
-    def __init__(self, func):
+    A lock only exists while some thread is computing the property for that
+    instance, so instances whose values are already cached cost nothing.
+    """
+
+    __slots__ = ('lock', 'locks')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # id(obj) -> [lock, number of threads using it]
+        self.locks = {}
+
+    def run(self, obj, compute):
+        """Call `compute(obj)`, in at most one thread at a time per `obj`."""
+        key = id(obj)
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                return compute(obj)
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+
+class BaseCachedProperty(object):
+
+    """
+    What every kind of cached property has in common.
+
+    Each kind has a `forget(obj)` method, to forget the value cached for
+    `obj`, so it's recomputed. Those with `can_forget_all` can also forget
+    the values for every instance at once, with `forget_all()`.
+    """
+
+    __slots__ = ()
+
+    can_forget_all = False
+
+    def forget_all(self):
+        """Forget the values cached for every instance."""
+        raise TypeError('%s values can only be invalidated per instance' %
+                        (self.__class__.__name__,))
+
+
+class LockingMixin(BaseCachedProperty):
+
+    __slots__ = ()
+
+    @classmethod
+    def locked(cls, func):
+        """
+        Create a thread-safe cached property.
+
+        If several threads access the property before it's been computed, one
+        of them computes it while the rest wait for and share its result.
+        Reading an already-cached value takes no locks.
+        """
+        return cls(func, locking=True)
+
+
+class CachedProperty(LockingMixin):
+
+    __slots__ = ('func', 'cache', 'in_flight')
+
+    can_forget_all = True
+
+    def __init__(self, func, locking=False):
         self.func = func
         self.cache = weakref.WeakKeyDictionary()
+        self.in_flight = InFlight() if locking else None
 
     def __get__(self, obj, type=None):
         if obj is None:  # the property was accessed on the class.
             return self
         if obj not in self.cache:
-            self.cache[obj] = val = CachedPropertyValue(is_computed=True,
-                                                        value=self.func(obj))
-            return val.value
+            if self.in_flight is not None:
+                return self.in_flight.run(obj, self._compute)
+            return self._compute(obj)
         val = self.cache[obj]
         if val.is_present:
             return val.value
@@ -36,6 +115,20 @@ class CachedProperty(object):
     def __delete__(self, obj):
         self.cache[obj] = CachedPropertyValue(is_present=False)
 
+    def forget(self, obj):
+        self.cache.pop(obj, None)
+
+    def forget_all(self):
+        self.cache.clear()
+
+    def _compute(self, obj):
+        # Another thread may have cached it while this one waited for a lock.
+        if obj in self.cache:
+            return self.__get__(obj)
+        self.cache[obj] = val = CachedPropertyValue(is_computed=True,
+                                                    value=self.func(obj))
+        return val.value
+
 
 # An alias, for naming consistency with `property`.
 cached_property = CachedProperty
@@ -49,3 +142,386 @@ class CachedPropertyValue(object):
         self.is_present = is_present
         self.is_computed = is_computed
         self.value = value
+
+
+class InstanceCachedProperty(LockingMixin):
+
+    """
+    A cached property which stores its value in the instance's `__dict__`.
+
+    This is a non-data descriptor, so once the value has been computed it
+    shadows the descriptor, and reading it is a plain attribute lookup.
+    Setting the attribute overwrites the cached value; deleting it forgets the
+    value, so that it's recomputed on the next access.
+    """
+
+    __slots__ = ('func', 'name', 'in_flight')
+
+    def __init__(self, func, locking=False):
+        self.func = func
+        self.name = func.__name__
+        self.in_flight = InFlight() if locking else None
+
+    def __get__(self, obj, type=None):
+        if obj is None:  # the property was accessed on the class.
+            return self
+        if self.in_flight is not None:
+            return self.in_flight.run(obj, self._compute)
+        obj.__dict__[self.name] = value = self.func(obj)
+        return value
+
+    def forget(self, obj):
+        obj.__dict__.pop(self.name, None)
+
+    def _compute(self, obj):
+        # Another thread may have cached it while this one waited for a lock.
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            pass
+        obj.__dict__[self.name] = value = self.func(obj)
+        return value
+
+
+instance_cached_property = InstanceCachedProperty
+
+
+class SlotCachedProperty(LockingMixin):
+
+    """
+    A cached property which stores its value in a dedicated slot.
+
+    For classes with `__slots__` and no `__dict__`: a property named `foo`
+    is kept in the slot `_cached_foo`, which the class must declare. Setting
+    the property overwrites the cached value; deleting it forgets the value,
+    so that it's recomputed on the next access.
+    """
+
+    __slots__ = ('func', 'slot_name', 'get_slot', 'in_flight')
+
+    def __init__(self, func, locking=False):
+        self.func = func
+        self.slot_name = '_cached_' + func.__name__
+        self.get_slot = operator.attrgetter(self.slot_name)
+        self.in_flight = InFlight() if locking else None
+
+    def __get__(self, obj, type=None):
+        if obj is None:  # the property was accessed on the class.
+            return self
+        try:
+            return self.get_slot(obj)
+        except AttributeError:
+            pass
+        if self.in_flight is not None:
+            return self.in_flight.run(obj, self._compute)
+        return self._compute(obj)
+
+    def __set__(self, obj, value):
+        try:
+            setattr(obj, self.slot_name, value)
+        except AttributeError:
+            raise TypeError('%s must declare a %r slot to use %r' %
+                            (type(obj).__name__, self.slot_name,
+                             self.func.__name__))
+
+    def __delete__(self, obj):
+        try:
+            delattr(obj, self.slot_name)
+        except AttributeError:
+            raise AttributeError('%r has no attribute %r' %
+                                 (obj, self.func.__name__))
+
+    def forget(self, obj):
+        try:
+            delattr(obj, self.slot_name)
+        except AttributeError:
+            pass
+
+    def _compute(self, obj):
+        # Another thread may have cached it while this one waited for a lock.
+        try:
+            return self.get_slot(obj)
+        except AttributeError:
+            pass
+        value = self.func(obj)
+        self.__set__(obj, value)
+        return value
+
+
+slot_cached_property = SlotCachedProperty
+
+
+class ExpiringCachedProperty(LockingMixin):
+
+    """
+    A cached property which is recomputed once its value goes stale.
+
+    The value is stale `ttl` seconds after it was computed, or as soon as
+    `version(obj)` returns something different from when it was computed (or
+    both, if both are given). Values are kept in the instance's `__dict__`.
+    Setting the property caches a fresh value; deleting it forgets the value.
+    """
+
+    __slots__ = ('func', 'name', 'ttl', 'version', 'generation', 'in_flight')
+
+    can_forget_all = True
+
+    def __init__(self, func, ttl=None, version=None, locking=False):
+        self.func = func
+        self.name = func.__name__
+        self.ttl = ttl
+        self.version = version
+        # Bumped by forget_all(), to make every cached value stale at once.
+        self.generation = 0
+        self.in_flight = InFlight() if locking else None
+
+    def __get__(self, obj, type=None):
+        if obj is None:  # the property was accessed on the class.
+            return self
+        entry = obj.__dict__.get(self.name)
+        if entry is not None and self._is_fresh(obj, entry):
+            return entry[0]
+        if self.in_flight is not None:
+            return self.in_flight.run(obj, self._compute)
+        return self._compute(obj, check=False)
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = self._entry(obj, value)
+
+    def __delete__(self, obj):
+        self.forget(obj)
+
+    def forget(self, obj):
+        obj.__dict__.pop(self.name, None)
+
+    def forget_all(self):
+        self.generation += 1
+
+    def _entry(self, obj, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        version = None if self.version is None else self.version(obj)
+        return (value, expires, version, self.generation)
+
+    def _is_fresh(self, obj, entry):
+        value, expires, version, generation = entry
+        return (generation == self.generation and
+                (expires is None or time.time() < expires) and
+                (self.version is None or self.version(obj) == version))
+
+    def _compute(self, obj, check=True):
+        # Another thread may have cached it while this one waited for a lock.
+        if check:
+            entry = obj.__dict__.get(self.name)
+            if entry is not None and self._is_fresh(obj, entry):
+                return entry[0]
+        value = self.func(obj)
+        obj.__dict__[self.name] = self._entry(obj, value)
+        return value
+
+
+def expiring_cached_property(ttl=None, version=None, locking=False):
+    """
+    Decorate a method as an `ExpiringCachedProperty`.
+
+        >>> class Socket(object):
+        ...     @expiring_cached_property(ttl=5.0)
+        ...     def send_buffer_size(self):
+        ...         return self.sock.getsockopt(SOL_SOCKET, SO_SNDBUF)
+    """
+    return partial(ExpiringCachedProperty, ttl=ttl, version=version,
+                   locking=locking)
+
+
+class AsyncCachedProperty(BaseCachedProperty):
+
+    """
+    A cached property whose value is computed asynchronously.
+
+    The decorated method takes a `callback`, which it must call with the
+    value once it's ready. Reading the property gives a function which takes
+    a callback in the same way, so it can be used with `tornado.gen.Task`:
+
+        >>> class Resolver(object):
+        ...     @async_cached_property
+        ...     def address(self, callback):
+        ...         self.lookup(self.hostname, callback=callback)
+        >>> address = yield gen.Task(resolver.address)
+
+    Callers who ask for the value while it's being computed wait for that
+    computation, rather than starting another. Values are kept in the
+    instance's `__dict__`; setting the property caches a value, deleting it
+    forgets the value.
+
+    The computation fails if the method calls its callback with `error=`
+    (an exception) instead of a value, if it raises (straight away, or
+    later, in any callback it scheduled through Tornado), or if it lets go
+    of the callback without calling it. Nothing is cached, so the next
+    caller starts again, and every caller waiting for it has its `errback`
+    called with the exception:
+
+        >>> resolver.address(connect, errback=report)
+
+    If any of them didn't give one, the exception is raised, as it would
+    have been without the property.
+    """
+
+    __slots__ = ('func', 'name', 'generation')
+
+    can_forget_all = True
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.generation = 0
+
+    def __get__(self, obj, type=None):
+        if obj is None:  # the property was accessed on the class.
+            return self
+        return partial(self.fetch, obj)
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = AsyncValue(self.generation, value=value,
+                                             is_computed=True)
+
+    def __delete__(self, obj):
+        self.forget(obj)
+
+    def forget(self, obj):
+        obj.__dict__.pop(self.name, None)
+
+    def forget_all(self):
+        self.generation += 1
+
+    def fetch(self, obj, callback, errback=None):
+        """
+        Call `callback` with the value for `obj`, computing it if needed, or
+        `errback` with the exception, if computing it fails.
+        """
+        state = obj.__dict__.get(self.name)
+        if state is not None and state.generation == self.generation:
+            if state.is_computed:
+                return callback(state.value)
+            return state.waiters.append((callback, errback))
+
+        # Only asynchronous properties need Tornado; `Pipe` doesn't.
+        from tornado.stack_context import ExceptionStackContext
+        obj.__dict__[self.name] = state = AsyncValue(self.generation)
+        state.waiters.append((callback, errback))
+        resolver = _Resolver(self, obj, state)
+        with ExceptionStackContext(resolver.handle_exception):
+            self.func(obj, resolver)
+
+    def _resolve(self, state, value):
+        if state.waiters is None:
+            return
+        state.value = value
+        state.is_computed = True
+        waiters, state.waiters = state.waiters, []
+        for callback, errback in waiters:
+            callback(value)
+
+    def _fail(self, obj, state, error):
+        """
+        Give up on a computation, and tell everyone waiting for it. Returns
+        False if any of them had no errback, or it had already finished.
+        """
+        if state.is_computed or state.waiters is None:
+            return False
+        if obj.__dict__.get(self.name) is state:
+            del obj.__dict__[self.name]
+        waiters, state.waiters = state.waiters, None
+        handled = True
+        for callback, errback in waiters:
+            if errback is None:
+                handled = False
+            else:
+                errback(error)
+        return handled
+
+
+async_cached_property = AsyncCachedProperty
+
+
+class _Resolver(object):
+
+    """
+    The callback an `AsyncCachedProperty`'s method is given, to call with
+    its value (or an `error`). It fails the computation if it's thrown away
+    without having been called.
+    """
+
+    __slots__ = ('prop', 'obj', 'state', 'called')
+
+    def __init__(self, prop, obj, state):
+        self.prop = prop
+        self.obj = obj
+        self.state = state
+        self.called = False
+
+    def __call__(self, value=None, error=None):
+        self.called = True
+        if error is not None:
+            if not self.prop._fail(self.obj, self.state, error):
+                raise error
+        else:
+            self.prop._resolve(self.state, value)
+
+    def handle_exception(self, type, value, traceback):
+        return self.prop._fail(self.obj, self.state, value)
+
+    def __del__(self):
+        if not self.called:
+            self.prop._fail(self.obj, self.state, RuntimeError(
+                '%s never called back' % (self.prop.name,)))
+
+
+class AsyncValue(object):
+
+    __slots__ = ('generation', 'is_computed', 'value', 'waiters')
+
+    def __init__(self, generation, is_computed=False, value=None):
+        self.generation = generation
+        self.is_computed = is_computed
+        self.value = value
+        self.waiters = []
+
+
+def invalidate(obj_or_class, *names):
+    """
+    Forget cached property values, so that they're recomputed when next read.
+
+    Given an instance, this forgets the values of its cached properties (all
+    of them, or just those named). Given a class, it forgets their values for
+    every instance; only `cached_property`, `expiring_cached_property` and
+    `async_cached_property` support this, and for a class with any other
+    kind, a `TypeError` is raised before anything's forgotten.
+    """
+    if isinstance(obj_or_class, type):
+        cls, obj = obj_or_class, None
+    else:
+        cls, obj = type(obj_or_class), obj_or_class
+
+    seen = set()
+    properties = []
+    for klass in cls.__mro__:
+        for name, attr in vars(klass).iteritems():
+            # Only the first definition of each name along the MRO counts.
+            if name in seen:
+                continue
+            seen.add(name)
+            if not isinstance(attr, BaseCachedProperty):
+                continue
+            if names and name not in names:
+                continue
+            properties.append(attr)
+
+    if obj is not None:
+        for attr in properties:
+            attr.forget(obj)
+        return
+    for attr in properties:
+        if not attr.can_forget_all:
+            raise TypeError('%s values can only be invalidated per instance' %
+                            (attr.__class__.__name__,))
+    for attr in properties:
+        attr.forget_all()
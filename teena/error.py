@@ -1,7 +1,6 @@
 """Easier handling of exceptions with error numbers."""
 
 import __builtin__
-import abc
 import errno
 import re
 import sys
@@ -15,7 +14,7 @@ ERRORS = dict((name, value) for name, value in vars(errno).iteritems()
 class Error(__builtin__.EnvironmentError):
 
     """
-    An abstract base class which can be used to check for errors with errno.
+    A base class which can be used to check for errors with errno.
 
     Example:
 
@@ -56,34 +55,96 @@ class Error(__builtin__.EnvironmentError):
         ... except Error.EPIPE:
         ...     print "Pipe was closed at the other end"
         Pipe was closed at the other end
+
+    Some common groups of errors have their own matchers, which catch any of
+    several errnos in one check:
+
+        >>> try:
+        ...     os.write(write_fd, "Hello!\\n")
+        ... except Error.DISCONNECTED:
+        ...     print "Reader has gone away"
+        Reader has gone away
+
+    And you can define your own with `Error.category()`.
     """
 
+    # The errnos a matcher catches; None means any errno at all.
+    match_errnos = None
+    # The single errno caught by an `Error.ENAME` matcher.
     match_errno = None
 
-    class __metaclass__(abc.ABCMeta):
+    class __metaclass__(type):
+
         def __getattr__(cls, error_name):
-            if cls.match_errno is None and error_name in ERRORS:
-                return cls.matcher(error_name, ERRORS[error_name])
+            # Matchers are created on first use, then stored on the class so
+            # later lookups never get this far.
+            if cls.match_errnos is None and error_name in ERRORS:
+                matcher = cls.matcher(error_name, ERRORS[error_name])
+                matcher.match_errno = ERRORS[error_name]
+                setattr(cls, error_name, matcher)
+                return matcher
             raise AttributeError(error_name)
 
+        def __instancecheck__(cls, instance):
+            return cls.matches(getattr(instance, 'errno', None))
+
+        def __subclasscheck__(cls, exc_type):
+            # An `except` clause only checks the type of the exception; the
+            # instance being handled (and so its errno) is in sys.exc_info().
+            exc_errno = getattr(sys.exc_info()[1], 'errno', None)
+            if exc_errno is not None and (cls.match_errnos is None or
+                                          exc_errno in cls.match_errnos):
+                return True
+            return type.__subclasscheck__(cls, exc_type)
+
     def __init__(self):
         raise TypeError("Cannot create teena.Error instances")
 
     @classmethod
-    def __subclasshook__(cls, exc_type):
-        exc_type, exc_info, traceback = sys.exc_info()
-        exc_errno = getattr(exc_info, 'errno', None)
-        if cls.match_errno is None:
-            return exc_errno is not None
-        elif exc_errno is not None:
-            return exc_errno == cls.match_errno
-        return False
+    def matches(cls, exc_errno):
+        """Return True if this class should catch an error with `exc_errno`."""
+        if exc_errno is None:
+            return False
+        return cls.match_errnos is None or exc_errno in cls.match_errnos
 
     @classmethod
-    def matcher(cls, error_name, error_number):
+    def matcher(cls, name, *error_numbers):
         # Return a dynamically-created subclass of the current class with the
-        # `match_errno` attribute set.
-        return type(cls.__name__ + "." + error_name,
+        # `match_errnos` attribute set.
+        return type(cls.__name__ + "." + name,
                     (cls,),
-                    {'match_errno': error_number,
+                    {'match_errnos': frozenset(error_numbers),
                      '__module__': cls.__module__})
+
+    @classmethod
+    def category(cls, name, *errors):
+        """
+        Define a matcher, `Error.<name>`, which catches any of several errors.
+
+        Errors may be given as names (which are skipped if the platform
+        doesn't define them) or numbers:
+
+            >>> Error.category('NOT_FOUND', 'ENOENT', errno.ENOTDIR)
+            <class 'teena.error.Error.NOT_FOUND'>
+        """
+        error_numbers = []
+        for error in errors:
+            if isinstance(error, basestring):
+                if error not in ERRORS:
+                    continue
+                error = ERRORS[error]
+            error_numbers.append(error)
+        matcher = cls.matcher(name, *error_numbers)
+        setattr(cls, name, matcher)
+        return matcher
+
+
+# The operation may succeed if it's simply tried again.
+Error.category('TRANSIENT', 'EAGAIN', 'EWOULDBLOCK', 'EINTR')
+# A non-blocking operation couldn't proceed without blocking.
+Error.category('WOULD_BLOCK', 'EAGAIN', 'EWOULDBLOCK')
+# The other end of a pipe, socket or terminal has gone away.
+Error.category('DISCONNECTED', 'EPIPE', 'ECONNRESET', 'ECONNABORTED',
+               'ENOTCONN', 'ESHUTDOWN', 'EIO')
+# The file descriptor is closed, or was never open.
+Error.category('BAD_FD', 'EBADF')
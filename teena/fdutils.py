@@ -1,10 +1,69 @@
 """Utilities for dealing with file descriptors."""
 
+import collections
+import ctypes
+import errno
+from functools import partial
 import os
+import stat
 
 from teena import Error
 
 
+# The kinds of file descriptor `classify()` tells apart.
+PIPE = 'pipe'
+SOCKET = 'socket'
+FILE = 'file'
+TTY = 'tty'
+CHAR_DEVICE = 'char_device'
+BLOCK_DEVICE = 'block_device'
+DIRECTORY = 'directory'
+OTHER = 'other'
+
+# The ways `transfer_strategy()` can choose to move data between two fds.
+SPLICE = 'splice'
+SENDFILE = 'sendfile'
+WRITE = 'write'
+READ_WRITE = 'read_write'
+
+# epoll refuses these (with EPERM): they're always ready.
+UNPOLLABLE = frozenset([FILE, DIRECTORY, BLOCK_DEVICE])
+# What splice(2) can move data to or from, besides a pipe.
+SPLICEABLE = frozenset([PIPE, SOCKET, FILE])
+
+
+class FdInfo(collections.namedtuple('FdInfo', 'kind sock_type')):
+
+    """What `classify()` knows about a file descriptor."""
+
+    __slots__ = ()
+
+    @property
+    def pollable(self):
+        """True if this fd can be waited on with an IOLoop."""
+        return self.kind not in UNPOLLABLE
+
+
+# fd -> FdInfo, for fds which have been classified and not yet closed.
+_classified = {}
+
+# close_range(2) is Linux 5.9+; its syscall number is the same on every
+# architecture. Older glibcs don't wrap it.
+SYS_close_range = 436
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _close_range = None
+else:
+    _close_range = getattr(_libc, 'close_range', None)
+    if _close_range is None and hasattr(_libc, 'syscall'):
+        _close_range = partial(_libc.syscall, SYS_close_range)
+    elif _close_range is not None:
+        _close_range.argtypes = [ctypes.c_uint, ctypes.c_uint, ctypes.c_int]
+        _close_range.restype = ctypes.c_int
+
+
 def ensure_fd(fd):
     """Ensure an argument is a file descriptor."""
     if not isinstance(fd, int):
@@ -14,19 +73,253 @@ def ensure_fd(fd):
     return fd
 
 
-def close_fd(fd):
-    """Close a file descriptor, ignoring EBADF."""
-    if os.isatty(fd):
-        return
+def is_nonblocking(fd):
+    """Return True if a file descriptor is in non-blocking mode."""
     try:
-        os.close(fd)
-    except Error.EBADF:
-        pass
+        import fcntl
+    except ImportError:
+        return False
+    return bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+
+
+def is_writable(fd):
+    """
+    Return True if a file descriptor has room to be written to now (or has
+    an error, which a write will report), without waiting.
+    """
+    import select
+    poller = select.poll()
+    poller.register(fd, select.POLLOUT)
+    return bool(poller.poll(0))
+
+
+def bytes_available(fd):
+    """Return the number of bytes waiting to be read from a pipe or socket."""
+    import fcntl
+    import struct
+    import termios
+    buf = fcntl.ioctl(fd, termios.FIONREAD, '\0\0\0\0')
+    return struct.unpack('i', buf)[0]
+
+
+def classify(fd, refresh=False):
+
+    """
+    Find out what kind of file a descriptor refers to.
+
+        >>> classify(sys.stdin.fileno())
+        FdInfo(kind='tty', sock_type=None)
+
+    The result is cached until the fd is closed with `close_fd()`, so it
+    only costs an `fstat()` (and for sockets, a `getsockopt()`) the first
+    time. An fd number which is closed some other way, and then reused, has
+    to be reclassified with `refresh=True`, or forgotten with `forget_fd()`.
+    """
+
+    if not refresh:
+        info = _classified.get(fd)
+        if info is not None:
+            return info
+
+    mode = os.fstat(fd).st_mode
+    sock_type = None
+    if stat.S_ISFIFO(mode):
+        kind = PIPE
+    elif stat.S_ISSOCK(mode):
+        kind = SOCKET
+        sock_type = _sock_type(fd)
+    elif stat.S_ISREG(mode):
+        kind = FILE
+    elif stat.S_ISCHR(mode):
+        kind = TTY if os.isatty(fd) else CHAR_DEVICE
+    elif stat.S_ISBLK(mode):
+        kind = BLOCK_DEVICE
+    elif stat.S_ISDIR(mode):
+        kind = DIRECTORY
+    else:
+        kind = OTHER
+    info = _classified[fd] = FdInfo(kind, sock_type)
+    return info
+
+
+def _sock_type(fd):
+    import socket
+    return get_socket_option(fd, socket.SOL_SOCKET, socket.SO_TYPE)
+
+
+def _with_socket(fd, method, *args):
+    import socket
+    # fromfd() dups the fd, and the family given doesn't matter here.
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        return getattr(sock, method)(*args)
+    finally:
+        sock.close()
+
+
+def get_socket_option(fd, level, option):
+    """`getsockopt()` on a socket's fd, rather than a socket object."""
+    return _with_socket(fd, 'getsockopt', level, option)
+
+
+def set_socket_option(fd, level, option, value):
+    """`setsockopt()` on a socket's fd, rather than a socket object."""
+    _with_socket(fd, 'setsockopt', level, option, value)
+
+
+def socket_error(fd):
+    """Return a socket's pending error (0 if there isn't one), clearing it."""
+    import socket
+    return get_socket_option(fd, socket.SOL_SOCKET, socket.SO_ERROR)
+
+
+def is_packet(fd):
+
+    """
+    Return True if each write to a file descriptor is a message of its own.
+
+    That is, it's a datagram or seqpacket socket, or a packet-mode pipe
+    (`Pipe(direct=True)`), where every read returns exactly one write.
+    """
+
+    import socket
+    info = classify(fd)
+    if info.kind == SOCKET:
+        return info.sock_type in (socket.SOCK_DGRAM, socket.SOCK_SEQPACKET)
+    if info.kind == PIPE and hasattr(os, 'O_DIRECT'):
+        import fcntl
+        return bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_DIRECT)
+    return False
+
+
+def forget_fd(fd):
+    """Drop the cached classification of a file descriptor."""
+    _classified.pop(fd, None)
+
+
+def transfer_strategy(input_fd, output_fd, refresh=False):
+
+    """
+    Choose the cheapest way to copy data from one fd to another.
+
+    - `SPLICE` if one is a pipe and the other a pipe, socket or file: the data
+      never leave the kernel.
+    - `SENDFILE` from a regular file to a socket or another file.
+    - `WRITE` to a regular file, which is always ready, so it can be written
+      as soon as data are read, without waiting on the loop.
+    - `READ_WRITE` otherwise.
+
+    With `refresh=True`, both fds are reclassified (see `classify()`).
+    """
+
+    from teena import rawio
+    source = classify(input_fd, refresh=refresh).kind
+    dest = classify(output_fd, refresh=refresh).kind
+    if rawio.HAVE_SPLICE and PIPE in (source, dest):
+        if source in SPLICEABLE and dest in SPLICEABLE:
+            return SPLICE
+    if rawio.HAVE_SENDFILE and source == FILE and dest in (SOCKET, FILE):
+        return SENDFILE
+    if dest == FILE:
+        return WRITE
+    return READ_WRITE
+
+
+def close_fd(fd):
+    """Close a file descriptor, unless it's a tty, ignoring EBADF."""
+    # Not from the cache: the number may have been closed and reused since
+    # it was classified, and a wrong guess would leak the fd.
+    if not os.isatty(fd):
+        try:
+            os.close(fd)
+        except Error.BAD_FD:
+            pass
+    forget_fd(fd)
+
+
+def close_fds(fds):
+
+    """
+    Close many file descriptors at once, skipping ttys and ignoring EBADF.
+
+    Runs of consecutive fds are closed with a single `close_range()` call,
+    where the kernel supports it, and the rest one at a time.
+    """
+
+    closing = []
+    for fd in fds:
+        # As in `close_fd()`, a tty is looked for afresh.
+        if not os.isatty(fd):
+            closing.append(fd)
+        forget_fd(fd)
+    for first, last in _runs(sorted(closing)):
+        if first == last or not _try_close_range(first, last):
+            for fd in xrange(first, last + 1):
+                try:
+                    os.close(fd)
+                except Error.BAD_FD:
+                    pass
+
+
+def _runs(fds):
+    """Group sorted fds into (first, last) runs of consecutive numbers."""
+    runs = []
+    for fd in fds:
+        if runs and runs[-1][1] == fd - 1:
+            runs[-1][1] = fd
+        else:
+            runs.append([fd, fd])
+    return runs
+
+
+def _try_close_range(first, last):
+    global _close_range
+    if _close_range is None:
+        return False
+    if _close_range(first, last, 0) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err != errno.ENOSYS:
+        raise OSError(err, os.strerror(err))
+    # Not on this kernel; don't ask again.
+    _close_range = None
+    return False
+
+
+class FdSet(set):
+
+    """
+    A set of file descriptors, to be deregistered and closed together.
+
+        >>> finished = FdSet(fd for fd in outputs if done(fd))
+        >>> finished.deregister(loop)
+        >>> finished.close()
+
+    Tearing down hundreds of fds this way costs an `epoll_ctl()` for each
+    one still registered with the loop, and only a handful of `close_range()`
+    calls, rather than a `close()` (and the exception handling) apiece.
+    """
+
+    __slots__ = ()
+
+    def deregister(self, loop):
+        """Remove every fd in the set from an IOLoop."""
+        remove_handlers = getattr(loop, 'remove_handlers', None)
+        if remove_handlers is not None:
+            remove_handlers(self)
+            return
+        for fd in self:
+            try_remove_handler(loop, fd)
+
+    def close(self):
+        """Close every fd in the set (see `close_fds()`), and empty it."""
+        close_fds(self)
+        self.clear()
 
 
 def try_remove_handler(loop, fd):
     """Remove a handler from a loop, ignoring EBADF or KeyError."""
     try:
         loop.remove_handler(fd)
-    except (KeyError, Error.EBADF):
+    except (KeyError, Error.BAD_FD):
         pass
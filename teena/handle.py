@@ -0,0 +1,239 @@
+"""
+Running a loop in the background, and finding out how it went.
+
+`ThreadLoop.start_background()` starts a loop (such as a tee) in a thread
+of its own, and returns a `TeeHandle` for it, which works like a future:
+
+    >>> handle = tee(sock_fd, (log_fd, mirror_fd)).start_background()
+    >>> handle.add_done_callback(report)
+    >>> if not handle.wait(timeout=30):
+    ...     handle.cancel()
+
+Once it's done, a tee's `stats` say how much it read, how much it wrote to
+each output, and why it gave up on any outputs it dropped:
+
+    >>> handle.stats.bytes_written
+    {5: 1048576, 6: 65536}
+    >>> handle.stats.dropped
+    {6: 'EPIPE'}
+
+A thread looking after many loops at once can take them as they finish,
+with `as_completed()`, rather than waiting for each in turn.
+"""
+
+import errno
+import Queue
+import sys
+import threading
+import time
+
+from teena.pipe import write_unraisable
+
+
+__all__ = ['TeeHandle', 'TeeStats', 'MergedStats', 'as_completed', 'HANGUP',
+           'CANCELLED', 'BACKLOG']
+
+
+# Why an output was dropped, besides the name of the errno it failed with.
+# An error or hangup was reported on the output by the loop:
+HANGUP = 'hangup'
+# The loop was cancelled before the output was finished with:
+CANCELLED = 'cancelled'
+# More of the stream was waiting for the output than the tee's `max_backlog`:
+BACKLOG = 'backlog'
+
+
+class TeeStats(object):
+
+    """
+    What a tee has done so far.
+
+    `bytes_written` and `dropped` are keyed by output: its fd, or, for
+    outputs with an `append()` method, the object itself. An output which
+    was finished with normally (at the end of the input) isn't in `dropped`.
+    """
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.bytes_written = {}
+        self.dropped = {}
+
+    def __repr__(self):
+        return '<TeeStats read:%d written:%r dropped:%r>' % (
+            self.bytes_read, self.bytes_written, self.dropped)
+
+    def drop(self, output, reason):
+        """Record that an output was dropped, unless it already has been."""
+        if isinstance(reason, (int, long)):
+            reason = errno.errorcode.get(reason, str(reason))
+        self.dropped.setdefault(output, reason)
+
+
+class MergedStats(TeeStats):
+
+    """
+    The stats of a tee whose outputs are written by several loops.
+
+    What was read comes from the reading loop's `stats`; what was written,
+    and dropped, from all of them (`parts`) together, leaving out the
+    `hidden` outputs, through which the reading loop hands data to the
+    others. They're put together each time they're looked at.
+    """
+
+    def __init__(self, stats, parts, hidden=()):
+        self._stats = stats
+        self._parts = [stats] + list(parts)
+        self._hidden = set(hidden)
+
+    @property
+    def bytes_read(self):
+        return self._stats.bytes_read
+
+    @property
+    def bytes_written(self):
+        return self._merge('bytes_written')
+
+    @property
+    def dropped(self):
+        return self._merge('dropped')
+
+    def _merge(self, name):
+        merged = {}
+        for part in self._parts:
+            # Copied in one go, as other threads may be updating them.
+            merged.update(getattr(part, name).copy())
+        for output in self._hidden:
+            merged.pop(output, None)
+        return merged
+
+
+class TeeHandle(object):
+
+    """
+    A loop running in a background thread, started by `start_background()`.
+
+    The loop runs until it has nothing left to do, and is then closed
+    (unless `close` is False). If it raised an exception, `exception()`
+    returns it.
+    """
+
+    def __init__(self, loop, close=True):
+        self.loop = loop
+        self._close = close
+        self._finished = threading.Event()
+        # Guards `_callbacks`, and closing the loop, against `cancel()`.
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._exception = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '<TeeHandle %s>' % ('done' if self.done() else 'running',)
+
+    def _run(self):
+        try:
+            self.loop.run()
+        except Exception, exc:
+            self._exception = exc
+        with self._lock:
+            if self._close:
+                self.loop.close()
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            write_unraisable(callback, *sys.exc_info())
+
+    @property
+    def stats(self):
+        """The loop's `TeeStats` (None if it doesn't keep any)."""
+        return getattr(self.loop, 'stats', None)
+
+    def done(self):
+        """Return True if the loop has finished."""
+        return self._finished.is_set()
+
+    def cancelled(self):
+        """Return True if the loop was stopped early by `cancel()`."""
+        return self.done() and self.loop.cancelled
+
+    def exception(self):
+        """The exception the loop raised, if it's finished and raised one."""
+        return self._exception
+
+    def wait(self, timeout=None):
+        """Wait for the loop to finish; return False if `timeout` ran out."""
+        return self._finished.wait(timeout)
+
+    def cancel(self):
+        """
+        Stop the loop as soon as it can, and drop whatever's left.
+
+        A tee closes its input and every output it hasn't finished with, and
+        records them as dropped, with `CANCELLED`. Returns False if the loop
+        had already finished.
+        """
+        with self._lock:
+            if self.done():
+                return False
+            self.loop.cancel()
+        return True
+
+    def add_callback(self, callback):
+        """
+        Call `callback()` in the loop's thread, on its next iteration.
+
+        Returns False, and doesn't, if the loop has already finished. (Nor is
+        it called if the loop finishes before it gets to it.)
+        """
+        with self._lock:
+            if self.done():
+                return False
+            self.loop.add_callback(callback)
+        return True
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(handle)` once the loop has finished.
+
+        It's called in the loop's thread, or straight away if it's already
+        done. Exceptions it raises are printed, and otherwise ignored.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+
+def as_completed(handles, timeout=None):
+
+    """
+    Yield handles as their loops finish, whatever order that's in.
+
+    With a `timeout`, in seconds, stops early if they haven't all finished
+    by then.
+    """
+
+    finished = Queue.Queue()
+    handles = set(handles)
+    for handle in handles:
+        handle.add_done_callback(finished.put)
+    deadline = None if timeout is None else time.time() + timeout
+    for _ in xrange(len(handles)):
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+        try:
+            yield finished.get(timeout=remaining)
+        except Queue.Empty:
+            return
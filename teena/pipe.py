@@ -1,11 +1,32 @@
+import collections
+from contextlib import contextmanager
+import ctypes
 import errno
 import os
 import sys
+import threading
+import time
 
-from teena import DEFAULT_BUFSIZE, cached_property
+from teena import DEFAULT_BUFSIZE, rawio, slot_cached_property
+from teena.fdutils import bytes_available, forget_fd, is_nonblocking
 
 
-__all__ = ['Pipe']
+__all__ = ['Pipe', 'PipePool']
+
+
+# Linux's values, where the `os` and `fcntl` modules don't provide them.
+O_CLOEXEC = getattr(os, 'O_CLOEXEC', 02000000)
+O_DIRECT = getattr(os, 'O_DIRECT', None)
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+try:
+    _pipe2 = ctypes.CDLL(None, use_errno=True).pipe2
+except (OSError, AttributeError):
+    _pipe2 = None
+else:
+    _pipe2.argtypes = [ctypes.POINTER(ctypes.c_int), ctypes.c_int]
+    _pipe2.restype = ctypes.c_int
 
 
 class Pipe(object):
@@ -34,15 +55,77 @@ class Pipe(object):
         ...    pipe.write_file.flush()
         ...    print repr(pipe.read_file.readline())
         'FOO\\n'
+
+    On Linux, a pipe can also be created close-on-exec, or in packet mode
+    (`direct=True`, where each write is read back as a separate message), and
+    given a bigger (or smaller) buffer than the default 64 KiB:
+
+        >>> pipe = Pipe(non_blocking=True, cloexec=True, capacity=1 << 20)
+        >>> pipe.capacity
+        1048576
+
+    All of the flags are set atomically, in a single `pipe2()` call.
+
+    Data can also be moved through a pipe without file objects, straight
+    from and into any buffer. These methods return `(result, errno)` pairs,
+    like those in `teena.rawio`:
+
+        >>> pipe = Pipe()
+        >>> pipe.writev(['foo', bytearray('bar')])
+        (6, 0)
+        >>> buf = bytearray(3)
+        >>> pipe.readinto(buf), buf
+        ((3, 0), bytearray(b'foo'))
+        >>> pipe.read_available()
+        ('bar', 0)
+
+    `buffering` is passed on to `os.fdopen()` for `read_file` and
+    `write_file`, and is the read size for `read_available()` when no data
+    are waiting.
+
+    On Linux, `vmsplice()` puts a buffer into the pipe without copying it.
+    The pipe keeps a reference to each buffer (and, for a `bytearray`, stops
+    it being resized) until its bytes have been read out:
+
+        >>> data = bytearray(1 << 16)
+        >>> pipe.vmsplice(data)
+        (65536, 0)
+        >>> n, err = rawio.splice(pipe.read_fd, sock_fd, 1 << 16)
+
+    Modifying the contents of a buffer in the meantime changes what the
+    reader sees, so don't. And once the data have been spliced onwards, to
+    a socket or another pipe, the kernel may still share the pages after
+    the pipe has let go of them; buffers which are going to be reused should
+    be written with `write()`, or only reused after the receiving end has
+    been drained too.
     """
 
-    __slots__ = ('read_fd', 'write_fd', '__weakref__')
+    __slots__ = ('read_fd', 'write_fd', 'read_open', 'write_open',
+                 'buffering', '_cached_read_file', '_cached_write_file',
+                 '_pinned', '_vmspliced')
 
-    def __init__(self, non_blocking=False):
-        self.read_fd, self.write_fd = os.pipe()
+    def __init__(self, non_blocking=False, cloexec=False, direct=False,
+                 capacity=None, buffering=DEFAULT_BUFSIZE):
+        # Whether this object has yet to close each end itself. Once it has,
+        # it never closes that fd number again, in case it's been reused.
+        self.read_open = self.write_open = False
+        self.buffering = buffering
+        # (total vmspliced bytes at the buffer's end, buffer) pairs.
+        self._pinned = collections.deque()
+        self._vmspliced = 0
+        flags = 0
         if non_blocking:
-            self._set_nonblocking(self.read_fd)
-            self._set_nonblocking(self.write_fd)
+            flags |= os.O_NONBLOCK
+        if cloexec:
+            flags |= O_CLOEXEC
+        if direct:
+            if O_DIRECT is None:
+                raise NotImplementedError("Packet-mode pipes are not supported on this platform")
+            flags |= O_DIRECT
+        self.read_fd, self.write_fd = self._pipe(flags)
+        self.read_open = self.write_open = True
+        if capacity is not None:
+            self.capacity = capacity
 
     def __repr__(self):
         return '<Pipe r:%d w:%d>' % (self.read_fd, self.write_fd)
@@ -56,6 +139,29 @@ class Pipe(object):
     def __del__(self):
         self.close()
 
+    @classmethod
+    def _pipe(cls, flags):
+        """Create a pipe with the given `pipe2()` flags."""
+        if not flags:
+            return os.pipe()
+        if _pipe2 is not None:
+            fds = (ctypes.c_int * 2)()
+            if _pipe2(fds, flags) < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return fds[0], fds[1]
+
+        # Without pipe2(), set the flags one at a time.
+        if flags & ~(os.O_NONBLOCK | O_CLOEXEC):
+            raise NotImplementedError("Packet-mode pipes are not supported on this platform")
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            if flags & os.O_NONBLOCK:
+                cls._set_nonblocking(fd)
+            if flags & O_CLOEXEC:
+                cls._set_cloexec(fd)
+        return read_fd, write_fd
+
     @staticmethod
     def _set_nonblocking(fd):
         """Set a file descriptor to non-blocking mode (POSIX-only)."""
@@ -66,6 +172,39 @@ class Pipe(object):
         flags = fcntl.fcntl(fd, fcntl.F_GETFL)
         fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
+    @staticmethod
+    def _set_cloexec(fd):
+        """Set a file descriptor to close on exec (POSIX-only)."""
+        try:
+            import fcntl
+        except ImportError:
+            raise NotImplementedError("Close-on-exec pipes are not supported on this platform")
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def _fcntl(self, cmd, arg=0):
+        try:
+            import fcntl
+        except ImportError:
+            raise NotImplementedError("Pipe capacity is not supported on this platform")
+        # Either end will do, as long as one of them is still open.
+        try:
+            return fcntl.fcntl(self.write_fd, cmd, arg)
+        except IOError, exc:
+            if exc.errno != errno.EBADF:
+                raise
+        return fcntl.fcntl(self.read_fd, cmd, arg)
+
+    @property
+    def capacity(self):
+        """The size of this pipe's buffer, in bytes (Linux-only)."""
+        return self._fcntl(F_GETPIPE_SZ)
+
+    @capacity.setter
+    def capacity(self, size):
+        # The kernel rounds the size up to a power-of-two number of pages.
+        self._fcntl(F_SETPIPE_SZ, size)
+
     @staticmethod
     def _fd_closed(fd):
         try:
@@ -78,21 +217,77 @@ class Pipe(object):
 
     @staticmethod
     def _close_fd(fd):
+        forget_fd(fd)
         try:
             os.close(fd)
         except (OSError, IOError), exc:
             if exc.errno != errno.EBADF:
                 raise
 
-    @cached_property
-    def read_file(self, buffering=DEFAULT_BUFSIZE):
+    @slot_cached_property.locked
+    def read_file(self):
         """Get a file-like object for the read end of the pipe."""
-        return os.fdopen(self.read_fd, 'rb', buffering)
+        return os.fdopen(self.read_fd, 'rb', self.buffering)
 
-    @cached_property
-    def write_file(self, buffering=DEFAULT_BUFSIZE):
+    @slot_cached_property.locked
+    def write_file(self):
         """Get a file-like object for the write end of the pipe."""
-        return os.fdopen(self.write_fd, 'wb', buffering)
+        return os.fdopen(self.write_fd, 'wb', self.buffering)
+
+    def readinto(self, buf):
+        """Read from the pipe into a writable buffer."""
+        return rawio.readinto(self.read_fd, buf)
+
+    def read_available(self):
+        """Read everything waiting in the pipe, with a single `read()`."""
+        return rawio.read(self.read_fd,
+                          bytes_available(self.read_fd) or self.buffering)
+
+    def write(self, data):
+        """Write a string, or any other buffer, to the pipe."""
+        return rawio.write(self.write_fd, data)
+
+    def writev(self, buffers):
+        """Write several buffers to the pipe in one call."""
+        return rawio.writev(self.write_fd, buffers)
+
+    def vmsplice(self, buffers, flags=None):
+        """
+        Map one buffer, or a list of them, into the pipe (Linux-only).
+
+        Each buffer is pinned until the pipe has been read past its end.
+        vmsplice() ignores `O_NONBLOCK`, so unless `flags` are given, they're
+        `SPLICE_F_NONBLOCK` if the write end is non-blocking.
+        """
+        if not isinstance(buffers, (list, tuple)):
+            buffers = [buffers]
+        if flags is None:
+            flags = (rawio.SPLICE_F_NONBLOCK
+                     if is_nonblocking(self.write_fd) else 0)
+        self.release_consumed()
+        n, err = rawio.vmsplice(self.write_fd, buffers, flags)
+        remaining = n
+        for data in buffers:
+            if remaining <= 0:
+                break
+            self._vmspliced += min(remaining, len(data))
+            remaining -= len(data)
+            self._pinned.append((self._vmspliced, _pin(data)))
+        return n, err
+
+    @property
+    def pinned(self):
+        """The number of vmspliced buffers the pipe is keeping alive."""
+        return len(self._pinned)
+
+    def release_consumed(self):
+        """Let go of vmspliced buffers that have been read from the pipe."""
+        if not self._pinned or not self.read_open:
+            # Without the read end, there's no telling what's been read.
+            return
+        consumed = self._vmspliced - bytes_available(self.read_fd)
+        while self._pinned and self._pinned[0][0] <= consumed:
+            self._pinned.popleft()
 
     @property
     def read_closed(self):
@@ -106,11 +301,15 @@ class Pipe(object):
 
     def close_read(self):
         """Close the read end of this pipe."""
-        self._close_fd(self.read_fd)
+        if self.read_open:
+            self.read_open = False
+            self._close_fd(self.read_fd)
 
     def close_write(self):
         """Close the write end of this pipe."""
-        self._close_fd(self.write_fd)
+        if self.write_open:
+            self.write_open = False
+            self._close_fd(self.write_fd)
 
     def close(self):
         """
@@ -130,6 +329,116 @@ class Pipe(object):
                 if read_exc[0] is not None:
                     write_unraisable(self.close, *read_exc)
                 raise
+            finally:
+                self._pinned.clear()
+
+
+class PipePool(object):
+
+    """
+    A thread-safe pool of empty, non-blocking pipes, for reuse.
+
+        >>> pool = PipePool(capacity=1 << 20)
+        >>> with pool.pipe() as pipe:
+        ...     n, err = rawio.splice(sock_fd, pipe.write_fd, 1 << 20)
+        ...     n, err = rawio.splice(pipe.read_fd, file_fd, n)
+
+    Pipes are created with `Pipe(non_blocking=True, cloexec=True)` and the
+    given `capacity`, as they're needed. A pipe which is returned with data
+    still in it, with either end closed, or when there are already `max_idle`
+    pipes waiting, is closed instead of being kept. Idle pipes are closed
+    once they've been unused for `idle_timeout` seconds; this is checked
+    whenever a pipe is acquired or released.
+    """
+
+    def __init__(self, max_idle=16, capacity=None, idle_timeout=60.0):
+        self.max_idle = max_idle
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (pipe, time released) pairs, oldest on the left.
+        self.idle = collections.deque()
+
+    def __len__(self):
+        return len(self.idle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def acquire(self):
+        """Take an empty pipe from the pool, or create one."""
+        with self.lock:
+            expired = self._expire(time.time())
+            pipe = self.idle.pop()[0] if self.idle else None
+        self._close_all(expired)
+        if pipe is None:
+            pipe = Pipe(non_blocking=True, cloexec=True,
+                        capacity=self.capacity)
+        return pipe
+
+    def release(self, pipe):
+        """Return a pipe to the pool, or close it if it can't be reused."""
+        if not self._is_reusable(pipe):
+            pipe.close()
+            return
+        with self.lock:
+            now = time.time()
+            expired = self._expire(now)
+            if len(self.idle) < self.max_idle:
+                self.idle.append((pipe, now))
+                pipe = None
+        if pipe is not None:
+            expired.append(pipe)
+        self._close_all(expired)
+
+    @contextmanager
+    def pipe(self):
+        """Acquire a pipe for the duration of a `with` block."""
+        pipe = self.acquire()
+        try:
+            yield pipe
+        finally:
+            self.release(pipe)
+
+    def close(self):
+        """Close every idle pipe."""
+        with self.lock:
+            idle, self.idle = self.idle, collections.deque()
+        self._close_all(pipe for pipe, released in idle)
+
+    def _expire(self, now):
+        expired = []
+        while self.idle and now - self.idle[0][1] >= self.idle_timeout:
+            expired.append(self.idle.popleft()[0])
+        return expired
+
+    @staticmethod
+    def _is_reusable(pipe):
+        if not (pipe.read_open and pipe.write_open) or pipe.write_closed:
+            return False
+        try:
+            return bytes_available(pipe.read_fd) == 0
+        except (OSError, IOError), exc:
+            if exc.errno == errno.EBADF:
+                return False
+            raise
+
+    @staticmethod
+    def _close_all(pipes):
+        for pipe in pipes:
+            pipe.close()
+
+
+def _pin(data):
+    # A memoryview of a bytearray stops it from being resized (and so moved)
+    # for as long as the view exists. Other buffers are just kept alive.
+    try:
+        return memoryview(data)
+    except TypeError:
+        return data
 
 
 def write_unraisable(obj, exc_type, exc_value, exc_traceback):
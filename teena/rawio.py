@@ -0,0 +1,405 @@
+"""
+Low-level I/O which reports expected errors as values, not exceptions.
+
+Each function returns a `(result, errno)` pair. `errno` is 0 on success; if
+the call failed with one of the `EXPECTED` errors (would block, interrupted,
+disconnected, bad fd) it's that errno instead, and the result is empty. Any
+other error is raised as an `OSError`, as usual.
+
+    >>> read_fd, write_fd = os.pipe()
+    >>> Pipe._set_nonblocking(read_fd)
+    >>> read(read_fd, 4096)
+    ('', 11)
+    >>> write(write_fd, 'hello')
+    (5, 0)
+    >>> read(read_fd, 4096)
+    ('hello', 0)
+
+`read()` and `write()` use the `os` module and compare errnos directly,
+which on CPython is cheaper than a ctypes call. `readinto()`, `writev()`,
+`splice()`, `vmsplice()`, `sendfile()`, `sendmsg()`, `sendmmsg()` and
+`zerocopy_completions()`, which `os` doesn't offer, go straight to libc
+through ctypes.
+"""
+
+import ctypes
+import errno
+import mmap
+import os
+import struct
+
+from teena import Error
+
+
+__all__ = ['EXPECTED', 'read', 'readinto', 'write', 'writev', 'writev_all',
+           'splice', 'vmsplice', 'sendfile', 'sendmsg', 'sendmmsg',
+           'zerocopy_completions', 'map_view']
+
+
+EXPECTED = (Error.TRANSIENT.match_errnos | Error.DISCONNECTED.match_errnos |
+            Error.BAD_FD.match_errnos)
+
+# The most buffers `writev()` will pass to the kernel in one call.
+IOV_MAX = 1024
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_GIFT = 8
+
+MSG_DONTWAIT = 0x40
+MSG_ERRQUEUE = 0x2000
+MSG_NOSIGNAL = 0x4000
+MSG_ZEROCOPY = 0x4000000
+# Not in Python 2's `socket` module: the option which lets a socket be sent
+# MSG_ZEROCOPY, and where its completion notifications come from.
+SO_ZEROCOPY = 60
+SO_EE_ORIGIN_ZEROCOPY = 5
+SO_EE_CODE_ZEROCOPY_COPIED = 1
+
+# A control message's header, and the extended error of a notification
+# on a socket's error queue.
+_CMSGHDR = struct.Struct('@' + ('Q' if ctypes.sizeof(ctypes.c_size_t) == 8
+                                else 'I') + 'ii')
+_CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+_SOCK_EXTENDED_ERR = struct.Struct('@IBBBBII')
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _read = _libc.read
+    _writev = _libc.writev
+except (OSError, AttributeError):
+    _libc = None
+else:
+    _read.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    _read.restype = ctypes.c_ssize_t
+    _writev.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+    _writev.restype = ctypes.c_ssize_t
+
+try:
+    _splice = _libc.splice
+except AttributeError:
+    _splice = None
+else:
+    _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _splice.restype = ctypes.c_ssize_t
+
+try:
+    _vmsplice = _libc.vmsplice
+except AttributeError:
+    _vmsplice = None
+else:
+    _vmsplice.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_size_t,
+                          ctypes.c_uint]
+    _vmsplice.restype = ctypes.c_ssize_t
+
+try:
+    _sendfile = _libc.sendfile
+except AttributeError:
+    _sendfile = None
+else:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+try:
+    _sendmmsg = _libc.sendmmsg
+except AttributeError:
+    _sendmmsg = None
+else:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                          ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+try:
+    _sendmsg = _libc.sendmsg
+    _recvmsg = _libc.recvmsg
+except AttributeError:
+    _sendmsg = _recvmsg = None
+else:
+    for _function in (_sendmsg, _recvmsg):
+        _function.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr),
+                              ctypes.c_int]
+        _function.restype = ctypes.c_ssize_t
+
+HAVE_SPLICE = _splice is not None
+HAVE_SENDFILE = _sendfile is not None
+
+
+def _error(empty):
+    err = ctypes.get_errno()
+    if err not in EXPECTED:
+        raise OSError(err, os.strerror(err))
+    return empty, err
+
+
+def address_of(data):
+    """
+    Return the address, and length, of the memory behind a buffer.
+
+    Strings are used in place, as are writable buffers such as `bytearray`,
+    `mmap` and ctypes arrays. Raises `TypeError` for anything else.
+    """
+    if isinstance(data, str):
+        address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+        return address, len(data)
+    if isinstance(data, ctypes.Array):
+        return ctypes.addressof(data), ctypes.sizeof(data)
+    array = (ctypes.c_char * len(data)).from_buffer(data)
+    return ctypes.addressof(array), len(data)
+
+
+def _addressable(data):
+    # Read-only buffers (e.g. a memoryview of a string) have to be copied.
+    try:
+        address_of(data)
+    except TypeError:
+        return memoryview(data).tobytes()
+    return data
+
+
+def read(fd, nbytes):
+    """Read up to `nbytes` bytes; `('', 0)` means end-of-file."""
+    try:
+        return os.read(fd, nbytes), 0
+    except OSError, exc:
+        if exc.errno not in EXPECTED:
+            raise
+        return '', exc.errno
+
+
+def readinto(fd, buf, nbytes=None):
+    """Read into a writable buffer, without allocating a new string."""
+    address, length = address_of(buf)
+    if nbytes is not None:
+        length = min(length, nbytes)
+    if _libc is None:
+        data, err = read(fd, length)
+        if err:
+            return 0, err
+        ctypes.memmove(address, data, len(data))
+        return len(data), 0
+    result = _read(fd, address, length)
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def write(fd, data, offset=0):
+    """Write `data` (from `offset` onwards); returns the number of bytes."""
+    if offset:
+        data = buffer(data, offset)
+    try:
+        return os.write(fd, data), 0
+    except OSError, exc:
+        if exc.errno not in EXPECTED:
+            raise
+        return 0, exc.errno
+
+
+def _iovecs(buffers):
+    iov = (iovec * len(buffers))()
+    for i, data in enumerate(buffers):
+        iov[i].iov_base, iov[i].iov_len = address_of(data)
+    return iov
+
+
+def writev(fd, buffers):
+    """Write several buffers in one call; returns the total bytes written."""
+    buffers = buffers[:IOV_MAX]
+    if len(buffers) == 1:
+        return write(fd, buffers[0])
+    if _libc is None:
+        return write(fd, ''.join(memoryview(data).tobytes()
+                                 for data in buffers))
+    buffers = map(_addressable, buffers)
+    result = _writev(fd, _iovecs(buffers), len(buffers))
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def writev_all(fd, buffers):
+    """
+    Write every buffer, retrying after partial writes and EINTR.
+
+    Meant for regular files, which never block; stops at any other error.
+    """
+    buffers = list(buffers)
+    total = 0
+    while buffers:
+        written, err = writev(fd, buffers[:IOV_MAX])
+        if err == errno.EINTR:
+            continue
+        elif err:
+            return total, err
+        total += written
+        while written:
+            if written < len(buffers[0]):
+                buffers[0] = buffers[0][written:]
+                break
+            written -= len(buffers.pop(0))
+    return total, 0
+
+
+def splice(fd_in, fd_out, nbytes, flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK):
+    """Move up to `nbytes` between two fds, at least one a pipe (Linux)."""
+    if _splice is None:
+        raise NotImplementedError("splice() is not supported on this platform")
+    result = _splice(fd_in, None, fd_out, None, nbytes, flags)
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def vmsplice(fd, buffers, flags=0):
+    """
+    Map buffers' pages into the pipe `fd`, rather than copying them (Linux).
+
+    Until the data have been read out of the pipe, the kernel still refers
+    to the buffers' memory: they must be kept alive, and not modified, until
+    then. `Pipe.vmsplice()` keeps them alive for you. With `SPLICE_F_GIFT`,
+    the pages are given to the kernel outright, and must never be touched
+    again. Buffers must be addressable in place (see `address_of()`).
+    """
+    if _vmsplice is None:
+        raise NotImplementedError("vmsplice() is not supported on this platform")
+    buffers = buffers[:IOV_MAX]
+    result = _vmsplice(fd, _iovecs(buffers), len(buffers), flags)
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def sendfile(fd_out, fd_in, nbytes, offset=None):
+    """
+    Copy up to `nbytes` from a file to another fd, in the kernel (Linux).
+
+    Without an `offset`, the copy starts from (and moves) the input's file
+    position; with one, it starts there, and the position is left alone.
+    """
+    if _sendfile is None:
+        raise NotImplementedError("sendfile() is not supported on this platform")
+    if offset is not None:
+        offset = ctypes.byref(ctypes.c_int64(offset))
+    result = _sendfile(fd_out, fd_in, offset, nbytes)
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def sendmsg(fd, buffers, flags=MSG_NOSIGNAL):
+    """
+    Send several buffers on a socket in one call, with `sendmsg()` flags.
+
+    With `MSG_ZEROCOPY` (on a socket with `SO_ZEROCOPY` set), the kernel
+    sends straight from the buffers' memory, which mustn't be modified, or
+    freed, until `zerocopy_completions()` says it's done with them.
+    """
+    buffers = buffers[:IOV_MAX]
+    if _sendmsg is None:
+        return writev(fd, buffers)
+    buffers = map(_addressable, buffers)
+    header = msghdr()
+    header.msg_iov = _iovecs(buffers)
+    header.msg_iovlen = len(buffers)
+    result = _sendmsg(fd, header, flags)
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def zerocopy_completions(fd):
+    """
+    Read MSG_ZEROCOPY completion notifications from a socket's error queue.
+
+    Every `sendmsg()` with `MSG_ZEROCOPY` which doesn't fail is numbered,
+    from 0, per socket (wrapping around at 2**32). This returns
+    `(first, last, copied)` ranges of those numbers whose buffers the kernel
+    has finished with, and the errno which ended the reading (0 once the
+    queue's empty). `copied` means the kernel had to copy the data anyway
+    (over loopback, say), so `MSG_ZEROCOPY` was only overhead.
+    """
+    if _recvmsg is None:
+        return [], 0
+    ranges = []
+    control = ctypes.create_string_buffer(64)
+    header = msghdr()
+    while True:
+        header.msg_control = ctypes.addressof(control)
+        header.msg_controllen = len(control)
+        result = _recvmsg(fd, header, MSG_ERRQUEUE | MSG_DONTWAIT)
+        if result < 0:
+            err = _error(None)[1]
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                err = 0
+            return ranges, err
+        data = control.raw[:header.msg_controllen]
+        if len(data) < _CMSGHDR.size:
+            continue
+        offset = -(-_CMSGHDR.size // _CMSG_ALIGN) * _CMSG_ALIGN
+        ee_errno, origin, _, code, _, first, last = \
+            _SOCK_EXTENDED_ERR.unpack_from(data, offset)
+        if origin == SO_EE_ORIGIN_ZEROCOPY and not ee_errno:
+            ranges.append((first, last,
+                           bool(code & SO_EE_CODE_ZEROCOPY_COPIED)))
+
+
+def sendmmsg(fd, messages):
+    """
+    Send each buffer, on a connected socket, as a separate message.
+
+    Returns the number of messages sent, which may be fewer than were given.
+    On Linux, they all go in one `sendmmsg()` call; elsewhere, only the
+    first is sent, with `write()`.
+    """
+    messages = messages[:IOV_MAX]
+    if _sendmmsg is None:
+        written, err = write(fd, messages[0])
+        return (0, err) if err else (1, 0)
+    messages = map(_addressable, messages)
+    iov = _iovecs(messages)
+    headers = (mmsghdr * len(messages))()
+    for i in xrange(len(messages)):
+        headers[i].msg_hdr.msg_iov = ctypes.pointer(iov[i])
+        headers[i].msg_hdr.msg_iovlen = 1
+    result = _sendmmsg(fd, headers, len(messages), 0)
+    if result < 0:
+        return _error(0)
+    return result, 0
+
+
+def map_view(fd, offset, nbytes, access=mmap.ACCESS_WRITE):
+    """
+    Map part of a file, and return a memoryview of it, without copying it.
+
+    The mapping lasts as long as the view does. A read-only fd can be mapped
+    with `mmap.ACCESS_COPY`, which shares the pages until they're written.
+    """
+    # Mappings have to start on a page boundary.
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mapping = mmap.mmap(fd, offset + nbytes - start, offset=start,
+                        access=access)
+    return memoryview((ctypes.c_char * nbytes).from_buffer(mapping,
+                                                           offset - start))
@@ -0,0 +1,418 @@
+"""
+A persistent, segmented log of a stream, which can be replayed from any
+offset.
+
+    >>> log = ReplayLog('/var/spool/capture', retention_bytes=10 << 30)
+    >>> with tee(sock_fd, (sys.stdout, log)).background():
+    ...     pass
+
+    >>> reader = LogReader('/var/spool/capture', record=1000)
+    >>> reader.read_record().tobytes()
+    '...the 1001st chunk of the stream...'
+
+Every chunk appended to a `ReplayLog` is a record, and is written to the
+end of the current segment file; once that reaches `segment_size`, a new
+one is started. Each segment has an index, with the byte offset and length
+of every record in it, so a `LogReader` (in this process or any other on the
+same host) can find any byte or record offset with a binary search, and
+then read from the segment through a memory mapping, or `sendfile()` it
+straight to another fd.
+
+Old segments are deleted, whole, once the log is bigger than
+`retention_bytes`, or they're older than `retention_age` seconds.
+
+Segments are named by the byte offset of their first byte, as
+`<offset>.log`, next to `<offset>.index`. An index starts with the number
+and byte offset of the segment's first record, followed by the offset and
+length of each record. A record is only indexed once its data have been
+written, so readers never see half of one. And a segment's index (with
+its header) is created before its log, so readers, who go by the logs,
+never see a segment without one.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+
+from teena import rawio
+
+
+__all__ = ['ReplayLog', 'LogReader']
+
+
+# An index's header (first record number, byte offset), and its entries
+# (byte offset, length); both absolute.
+HEADER = struct.Struct('<QQ')
+ENTRY = struct.Struct('<QQ')
+
+DEFAULT_SEGMENT_SIZE = 1 << 26
+
+
+def _segment_path(directory, base, suffix):
+    return os.path.join(directory, '%020d.%s' % (base, suffix))
+
+
+def _list_segments(directory):
+    """The base offsets of the segments in a directory, in order."""
+    return sorted(int(name[:-4]) for name in os.listdir(directory)
+                  if name.endswith('.log') and name[:-4].isdigit())
+
+
+def _read_header(directory, base):
+    """A segment's (first record number, byte offset), or None if unwritten."""
+    fd = os.open(_segment_path(directory, base, 'index'), os.O_RDONLY)
+    try:
+        data = os.read(fd, HEADER.size)
+    finally:
+        os.close(fd)
+    if len(data) < HEADER.size:
+        return None
+    return HEADER.unpack(data)
+
+
+class _FirstRecords(object):
+
+    """
+    The number of each segment's first record, for `bisect`, read from its
+    index's header only when it's asked for. A segment whose header hasn't
+    been written yet comes after every record.
+    """
+
+    def __init__(self, directory, segments):
+        self.directory = directory
+        self.segments = segments
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getitem__(self, i):
+        header = _read_header(self.directory, self.segments[i])
+        return sys.maxint if header is None else header[0]
+
+
+class _Index(object):
+
+    """
+    A segment's index, mapped, as a sequence of record offsets for `bisect`.
+
+    `refresh()` maps whatever's been added to it since it was last mapped.
+    Until its header has been written, an index has no records, and its
+    `first_record` is None.
+    """
+
+    def __init__(self, directory, base):
+        self.fd = os.open(_segment_path(directory, base, 'index'),
+                          os.O_RDONLY)
+        self.map = None
+        self.size = 0
+        self.first_record, self.base = None, base
+        self.refresh()
+
+    def refresh(self):
+        size = os.fstat(self.fd).st_size
+        if size <= self.size or size < HEADER.size:
+            return
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        self.size = size
+        if self.first_record is None:
+            self.first_record, self.base = HEADER.unpack_from(self.map)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+    def __len__(self):
+        return max(self.size - HEADER.size, 0) // ENTRY.size
+
+    def __getitem__(self, i):
+        return self.entry(i)[0]
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self.map, HEADER.size + i * ENTRY.size)
+
+
+class ReplayLog(object):
+
+    """
+    The writing end of a log: a `tee()` output, or appended to directly.
+
+    An existing log in `directory` is carried on with.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 retention_bytes=None, retention_age=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.log_fd = self.index_fd = None
+
+        segments = _list_segments(directory)
+        if segments and _read_header(directory, segments[-1]) is None:
+            # The writer stopped while it was starting a segment; nothing
+            # was written to it.
+            for suffix in ('log', 'index'):
+                os.unlink(_segment_path(directory, segments[-1], suffix))
+            del segments[-1]
+        if segments:
+            index = _Index(directory, segments[-1])
+            self.next_record = index.first_record + len(index)
+            if len(index):
+                offset, length = index.entry(len(index) - 1)
+                self.end = offset + length
+            else:
+                self.end = index.base
+            index.close()
+            self._open(segments[-1], index.first_record)
+            # Drop anything written after the last indexed record, and any
+            # half-written index entry.
+            os.ftruncate(self.log_fd, self.end - self.base)
+            os.ftruncate(self.index_fd, HEADER.size + len(index) * ENTRY.size)
+        else:
+            self.next_record = self.end = 0
+            self._open(0, 0)
+
+    def _open(self, base, first_record):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self.base = base
+        self.index_fd = os.open(
+            _segment_path(self.directory, base, 'index'), flags, 0644)
+        if os.fstat(self.index_fd).st_size == 0:
+            _write_all(self.index_fd, [HEADER.pack(first_record, base)])
+        self.log_fd = os.open(
+            _segment_path(self.directory, base, 'log'), flags, 0644)
+
+    def _roll(self):
+        os.close(self.log_fd)
+        os.close(self.index_fd)
+        self._open(self.end, self.next_record)
+        self._expire()
+
+    def _expire(self):
+        segments = _list_segments(self.directory)[:-1]
+        # The log's size (in data), not counting its current segment.
+        total = self.end - self.base
+        sizes = {}
+        for base in segments:
+            sizes[base] = os.path.getsize(
+                _segment_path(self.directory, base, 'log'))
+            total += sizes[base]
+        now = time.time()
+        for base in segments:
+            path = _segment_path(self.directory, base, 'log')
+            too_big = (self.retention_bytes is not None and
+                       total > self.retention_bytes)
+            too_old = (self.retention_age is not None and
+                       now - os.path.getmtime(path) > self.retention_age)
+            if not (too_big or too_old):
+                break
+            os.unlink(path)
+            os.unlink(_segment_path(self.directory, base, 'index'))
+            total -= sizes[base]
+
+    def append(self, chunks):
+        """Write each chunk to the log as a record."""
+        records, entries = [], []
+        for data in chunks:
+            if self.end > self.base and (
+                    self.end - self.base + len(data) > self.segment_size):
+                self._flush(records, entries)
+                records, entries = [], []
+                self._roll()
+            records.append(data)
+            entries.append(ENTRY.pack(self.end, len(data)))
+            self.end += len(data)
+            self.next_record += 1
+        self._flush(records, entries)
+
+    def _flush(self, records, entries):
+        if records:
+            _write_all(self.log_fd, records)
+            _write_all(self.index_fd, entries)
+
+    def reader(self, offset=None, record=None):
+        """A `LogReader` for this log (see `LogReader`)."""
+        return LogReader(self.directory, offset=offset, record=record)
+
+    def close(self):
+        """Close the current segment."""
+        for fd in (self.log_fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.log_fd = self.index_fd = None
+
+
+def _write_all(fd, chunks):
+    written, err = rawio.writev_all(fd, chunks)
+    if err:
+        raise OSError(err, os.strerror(err))
+
+
+class LogReader(object):
+
+    """
+    A reader of a `ReplayLog`, from any byte or record offset.
+
+    Without an `offset` or a `record`, reading starts from the oldest data
+    still in the log. Reads never block: at the end of what's been written
+    so far, they return nothing, and can be tried again later.
+    """
+
+    def __init__(self, directory, offset=None, record=None):
+        self.directory = directory
+        self.segments = []
+        self.segment = self.fd = self.index = None
+        self.position = 0
+        if record is not None:
+            self.seek_record(record)
+        else:
+            self.seek(offset or 0)
+
+    def _refresh(self):
+        self.segments = _list_segments(self.directory)
+
+    def _open(self, base):
+        if self.segment == base:
+            return
+        self.close()
+        self.segment = base
+        self.fd = os.open(_segment_path(self.directory, base, 'log'),
+                          os.O_RDONLY)
+        self.index = _Index(self.directory, base)
+
+    def _record_at(self, position):
+        """The index of the record in this segment which `position` is in."""
+        i = bisect.bisect_right(self.index, position) - 1
+        if i == len(self.index) - 1:
+            # It may be in a record which has been added since.
+            self.index.refresh()
+            i = bisect.bisect_right(self.index, position) - 1
+        return i
+
+    def seek(self, offset):
+        """
+        Read from a byte offset next.
+
+        An offset from before the oldest retained segment starts from the
+        beginning of that segment instead.
+        """
+        self._refresh()
+        if not self.segments:
+            self.position = offset
+            return
+        i = max(bisect.bisect_right(self.segments, offset) - 1, 0)
+        self._open(self.segments[i])
+        self.position = max(offset, self.segments[i])
+
+    def seek_record(self, record):
+        """Read from the start of the `record`th record next."""
+        self._refresh()
+        if not self.segments:
+            self.seek(0)
+            return
+        i = bisect.bisect_right(
+            _FirstRecords(self.directory, self.segments), record) - 1
+        if i < 0:
+            # Expired; start with the oldest record there is.
+            self.seek(self.segments[0])
+            return
+        index = _Index(self.directory, self.segments[i])
+        try:
+            if record - index.first_record < len(index):
+                self.seek(index.entry(record - index.first_record)[0])
+            else:
+                # Not written yet; wait for it at the end of the log.
+                self.seek(index.base if not len(index) else
+                          sum(index.entry(len(index) - 1)))
+        finally:
+            index.close()
+
+    @property
+    def record(self):
+        """The number of the record which is read next (or the one it's in)."""
+        self._available()
+        if self.segment is None:
+            return 0
+        if self.index.first_record is None:
+            self.index.refresh()
+            if self.index.first_record is None:
+                # Nothing's been written to this segment yet.
+                return self._records_before(self.segment)
+        return self.index.first_record + self._record_at(self.position)
+
+    def _records_before(self, base):
+        earlier = [segment for segment in self.segments if segment < base]
+        if not earlier:
+            return 0
+        index = _Index(self.directory, earlier[-1])
+        index.close()
+        return (index.first_record or 0) + len(index)
+
+    def _available(self):
+        """Bytes left in the current segment, moving on if it's finished."""
+        while True:
+            if self.segment is None:
+                self.seek(self.position)
+                if self.segment is None:
+                    return 0
+            size = os.fstat(self.fd).st_size
+            left = self.segment + size - self.position
+            if left > 0:
+                return left
+            # A segment is finished once there's another after it.
+            self._refresh()
+            later = [base for base in self.segments if base > self.segment]
+            if not later or later[0] > self.position:
+                return 0
+            self._open(later[0])
+
+    def read(self, nbytes):
+        """A memoryview of up to `nbytes` bytes; empty at the end, for now."""
+        nbytes = min(nbytes, self._available())
+        if not nbytes:
+            return memoryview('')
+        view = rawio.map_view(self.fd, self.position - self.segment, nbytes,
+                              access=mmap.ACCESS_COPY)
+        self.position += nbytes
+        return view
+
+    def read_record(self):
+        """
+        A memoryview of the next whole record, or None if it isn't indexed
+        yet. After a `seek()` into the middle of a record, this is the rest
+        of that record.
+        """
+        self._available()
+        if self.segment is None:
+            return None
+        i = self._record_at(self.position)
+        if i < 0:
+            return None
+        offset, length = self.index.entry(i)
+        if self.position >= offset + length:
+            return None
+        return self.read(offset + length - self.position)
+
+    def send_to(self, fd, nbytes):
+        """`sendfile()` up to `nbytes` to another fd; `(sent, errno)`."""
+        nbytes = min(nbytes, self._available())
+        if not nbytes:
+            return 0, 0
+        sent, err = rawio.sendfile(fd, self.fd, nbytes,
+                                   offset=self.position - self.segment)
+        self.position += sent
+        return sent, err
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.index.close()
+            self.fd = self.segment = self.index = None
@@ -0,0 +1,329 @@
+"""
+Fanning a stream out to other processes, through shared memory.
+
+A `SharedRing` is a ring buffer in an anonymous shared mapping, which
+processes forked after it's created all see. `ring_tee()` reads its input
+straight into the ring, once, however many consumers there are; each
+consumer, in its own process, reads the data back out as memoryviews of the
+shared memory, without a copy:
+
+    >>> ring = SharedRing(consumers=4, capacity=1 << 22)
+    >>> for consumer in ring.consumers:
+    ...     worker = multiprocessing.Process(target=work, args=(consumer,))
+    ...     worker.start()
+    ...     consumer.detach()
+    >>> with ring_tee(sys.stdin, ring, bufsize=1 << 16).background():
+    ...     pass
+
+    >>> def work(consumer):
+    ...     for view in consumer:
+    ...         process(view)
+
+Positions, not data, go through pipes: the ring tells each consumer how far
+it's been written, and consumers tell the ring how far they've read. Every
+position is a single small write, so messages are never split, and because
+they're syscalls, each process sees the data in the shared memory by the
+time it sees the position.
+
+The input isn't read while the ring is full, until the slowest consumer has
+caught up. A consumer whose process has gone away (once it's been detached)
+is forgotten about, rather than holding up everyone else: its pipe is
+watched for errors, so that's noticed even while nothing's being read.
+"""
+
+import ctypes
+import errno
+import mmap
+import os
+import struct
+
+from teena import DEFAULT_BUFSIZE, Error, rawio
+from teena.fdutils import close_fd, ensure_fd, try_remove_handler
+from teena.pipe import Pipe
+from teena.tee import WOULD_BLOCK
+from teena.thread_loop import ThreadLoop
+
+
+__all__ = ['SharedRing', 'RingConsumer', 'ring_tee']
+
+
+# How far the ring has been written, sent to a consumer; and how far a
+# consumer has read (with its index), sent back.
+POSITION = struct.Struct('<Q')
+ACK = struct.Struct('<IQ')
+
+# Read whole numbers of messages, so none are ever split between reads.
+POSITIONS_PER_READ = 512
+ACKS_PER_READ = 341
+
+DISCONNECTED = Error.DISCONNECTED.match_errnos | Error.BAD_FD.match_errnos
+
+
+class SharedRing(object):
+
+    """
+    A ring buffer in memory shared with forked processes, for `ring_tee()`.
+
+    `capacity` is the most data, in bytes, that can be waiting for the
+    slowest consumer. There are a fixed number of consumers, in
+    `consumers`, each of which should be used by one process (or thread);
+    a forked process can only use one.
+    """
+
+    def __init__(self, consumers, capacity=1 << 20):
+        self.capacity = capacity
+        self._map = mmap.mmap(-1, capacity)
+        self._data = (ctypes.c_char * capacity).from_buffer(self._map)
+        self._view = memoryview(self._data)
+        # The process which created the ring, and feeds it.
+        self._pid = os.getpid()
+        self._feedback = Pipe()
+        Pipe._set_nonblocking(self._feedback.read_fd)
+        self.consumers = [RingConsumer(self, index)
+                          for index in xrange(consumers)]
+
+    def _chunk(self, offset, size):
+        """Get `size` bytes of the ring from `offset`, to read into."""
+        return (ctypes.c_char * size).from_buffer(self._map, offset)
+
+    def _attach(self, consumer):
+        # The first time a consumer is used in a forked process, close this
+        # process' copies of the ends the producer writes to, so consumers
+        # see the end of the stream when the producer closes its own; and of
+        # the other consumers' ends, so the producer sees when any of their
+        # processes has gone away, even while this one is still going.
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            for other in self.consumers:
+                other._notify.close_write()
+                if other is not consumer:
+                    other._notify.close_read()
+
+    def close(self):
+        """
+        Close the ring's pipes, and unmap its memory.
+
+        No memoryviews from its consumers may be used after this.
+        """
+        for consumer in self.consumers:
+            consumer._notify.close()
+        self._feedback.close()
+        del self._view, self._data
+        self._map.close()
+
+
+class RingConsumer(object):
+
+    """
+    One reader of a `SharedRing`.
+
+    `read()` waits for data and returns memoryviews of it, in the ring's
+    memory, and `release()` hands the bytes back to be overwritten, once
+    they've been dealt with. Iterating over a consumer does both, releasing
+    each view when the next one is asked for, so a view mustn't be kept
+    beyond that.
+    """
+
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+        # How far this consumer has read and released, and how far it knows
+        # the ring's been written.
+        self.cursor = 0
+        self.end = 0
+        self.eof = False
+        self._notify = Pipe()
+        Pipe._set_nonblocking(self._notify.write_fd)
+
+    def __iter__(self):
+        while True:
+            views = self.read()
+            if not views:
+                return
+            for view in views:
+                yield view
+                self.release(len(view))
+
+    def fileno(self):
+        """The fd which becomes readable when there's more data to read."""
+        return self._notify.read_fd
+
+    def detach(self):
+        """Close the producer's copy of this consumer's end of its pipe."""
+        self._notify.close_read()
+
+    def read(self):
+        """
+        Wait for data, and return all that's unread, as a list of memoryviews.
+
+        There are two views where the data wrap around the end of the ring,
+        and none at the end of the stream.
+        """
+        self.ring._attach(self)
+        while self.cursor == self.end:
+            if self.eof:
+                return []
+            self._wait()
+        capacity = self.ring.capacity
+        start, size = self.cursor % capacity, self.end - self.cursor
+        first = min(size, capacity - start)
+        views = [self.ring._view[start:start + first]]
+        if first < size:
+            views.append(self.ring._view[:size - first])
+        return views
+
+    def _wait(self):
+        while True:
+            data, err = rawio.read(self._notify.read_fd,
+                                   POSITION.size * POSITIONS_PER_READ)
+            if err != errno.EINTR:
+                break
+        if err or not data:
+            self.eof = True
+            return
+        # Only the latest position matters.
+        self.end = POSITION.unpack_from(data, len(data) - POSITION.size)[0]
+
+    def release(self, nbytes):
+        """Let the ring reuse the next `nbytes` bytes this consumer has read."""
+        self.cursor += nbytes
+        os.write(self.ring._feedback.write_fd,
+                 ACK.pack(self.index, self.cursor))
+
+
+def ring_tee(input_fd, ring, bufsize=DEFAULT_BUFSIZE):
+
+    """
+    Create a ThreadLoop which copies an input into a `SharedRing`.
+
+    Each read goes straight into the ring's memory, up to `bufsize` bytes at
+    a time. At the end of the input, the input is closed, and each consumer
+    reads to the end of what's in the ring.
+
+    A consumer is only told about new data when it's caught up with what
+    it was last told (or when the ring is full waiting on it), so its pipe
+    never fills up with positions. While it's behind, it will come back for
+    more by itself.
+    """
+
+    loop = ThreadLoop()
+    input_fd = ensure_fd(input_fd)
+    feedback_fd = ring._feedback.read_fd
+    count = len(ring.consumers)
+    # Which consumers are still there; how far each has read, and how far
+    # it's been told the ring has been written.
+    active = set(xrange(count))
+    cursors = [0] * count
+    notified = [0] * count
+    # How far the ring has been written, and whether the input is being
+    # listened to (it isn't while the ring is full).
+    position = [0]
+    reading = [False]
+    # The consumer each notification pipe's write end belongs to.
+    notify_fds = dict((consumer._notify.write_fd, consumer.index)
+                      for consumer in ring.consumers)
+
+    def room():
+        if not active:
+            return ring.capacity
+        return ring.capacity - (position[0] -
+                                min(cursors[index] for index in active))
+
+    def notify(index):
+        written, err = rawio.write(ring.consumers[index]._notify.write_fd,
+                                   POSITION.pack(position[0]))
+        if err in DISCONNECTED:
+            drop(index)
+        elif not err:
+            notified[index] = position[0]
+
+    def drop(index):
+        active.discard(index)
+        try_remove_handler(loop, ring.consumers[index]._notify.write_fd)
+
+    def on_notify_error(fd, events):
+        # The consumer's process has gone. It isn't waited for any more, so
+        # the ring may have room again (or there may be nobody left to read
+        # for, which the reader finds out).
+        drop(notify_fds[fd])
+        if not reading[0] and (room() > 0 or not active):
+            start_reading()
+
+    def start_reading():
+        if not reading[0]:
+            reading[0] = True
+            loop.add_handler(input_fd, reader, loop.READ | loop.ERROR)
+
+    def stop_reading():
+        if reading[0]:
+            reading[0] = False
+            try_remove_handler(loop, input_fd)
+
+    def finish(close):
+        stop_reading()
+        try_remove_handler(loop, feedback_fd)
+        for fd in notify_fds:
+            try_remove_handler(loop, fd)
+        if close:
+            close_fd(input_fd)
+        # Tell every consumer that's behind where the stream ends, since it
+        # won't be able to ask again, and then that it has.
+        for index in list(active):
+            if notified[index] != position[0]:
+                notify(index)
+        for consumer in ring.consumers:
+            consumer._notify.close_write()
+
+    def reader(fd, events):
+        if events & loop.ERROR and not events & loop.READ:
+            finish(close=True)
+            return
+        # If all of the consumers have gone, stop, but don't close the input.
+        if not active:
+            finish(close=False)
+            return
+        space = room()
+        if space <= 0:
+            # Waiting on a consumer whose process has gone would be forever;
+            # telling it where the ring's got to finds that out.
+            for index in list(active):
+                if position[0] - cursors[index] >= ring.capacity:
+                    notify(index)
+            if room() <= 0:
+                stop_reading()
+                return
+            space = room()
+
+        offset = position[0] % ring.capacity
+        size = min(space, bufsize, ring.capacity - offset)
+        nbytes, err = rawio.readinto(fd, ring._chunk(offset, size))
+        if err == errno.EINTR or err in WOULD_BLOCK:
+            return
+        elif err or not nbytes:
+            finish(close=True)
+            return
+
+        position[0] += nbytes
+        for index in list(active):
+            if cursors[index] == notified[index]:
+                notify(index)
+
+    def on_feedback(fd, events):
+        data, err = rawio.read(fd, ACK.size * ACKS_PER_READ)
+        if err or not data:
+            return
+        for offset in xrange(0, len(data), ACK.size):
+            index, cursor = ACK.unpack_from(data, offset)
+            cursors[index] = cursor
+            if (index in active and cursor == notified[index] and
+                    position[0] > cursor):
+                notify(index)
+        if room() > 0:
+            start_reading()
+
+    loop.add_handler(feedback_fd, on_feedback, loop.READ)
+    for fd in notify_fds:
+        loop.add_handler(fd, on_notify_error, loop.ERROR)
+    start_reading()
+    return loop
@@ -0,0 +1,63 @@
+"""
+Token buckets, for limiting how fast a tee writes to an output.
+
+    >>> tee(sock_fd, (live_fd, archive_fd), rate_limits={archive_fd: 1 << 20})
+
+A bucket fills up with tokens (bytes) at its `rate`, up to its `burst`, and
+every byte written takes one out. An output whose bucket is empty isn't
+written to, or polled, until a timer says there's enough in it again.
+"""
+
+import time
+
+
+__all__ = ['TokenBucket']
+
+
+# The smallest burst a bucket has by default, so a slow rate doesn't mean
+# many tiny writes.
+MIN_BURST = 4096
+
+
+class TokenBucket(object):
+
+    """
+    Up to `rate` bytes a second, on average, in bursts of up to `burst`
+    bytes (by default, a tenth of a second's worth, or `MIN_BURST`,
+    whichever's more). It starts full.
+
+    A write may take more than there is, as a message can't be split; the
+    bucket then stays empty until it's paid back.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("A token bucket's rate must be positive")
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(int(rate) // 10, MIN_BURST)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def __repr__(self):
+        return '<TokenBucket rate:%d burst:%d tokens:%d>' % (
+            self.rate, self.burst, self.tokens)
+
+    def available(self):
+        """The whole number of bytes which can be written now."""
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          self.burst)
+        self.updated = now
+        return max(int(self.tokens), 0)
+
+    def consume(self, nbytes):
+        """Take out what's been written."""
+        self.tokens -= nbytes
+
+    def delay(self, nbytes):
+        """Seconds until `nbytes` (up to a burst) can be written."""
+        self.available()
+        wanted = min(nbytes, self.burst)
+        return max(wanted - self.tokens, 0) / self.rate
@@ -0,0 +1,127 @@
+"""
+Keeping a slow output's backlog on disk, instead of in memory.
+
+    >>> spill = SpillFile()
+    >>> spill.append(['foo', 'bar'])
+    >>> spill.view(4).tobytes()
+    'foob'
+    >>> spill.consume(4)
+    >>> len(spill)
+    2
+
+A `SpillFile` is an unlinked temporary file, written only at its end and
+read from its start. Its contents are read back through a memory mapping,
+which is kept and reused until the data move past it, so `view()` doesn't
+copy them (or map them afresh each time), or sent to another fd with
+`send_to()`, which doesn't even map them. Once they've been consumed,
+they're punched out of the file (where the filesystem can), and when
+everything has been consumed the file is truncated, so neither the disk
+nor the page cache holds on to what's no longer needed.
+"""
+
+import ctypes
+import errno
+import mmap
+import os
+import tempfile
+
+from teena import rawio
+
+
+__all__ = ['SpillFile']
+
+
+# fallocate(2) modes (Linux).
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# How much has to have been consumed before it's punched out of the file.
+PUNCH_SIZE = 1 << 20
+
+# The most of the file that's mapped at once.
+MAP_SIZE = 1 << 24
+
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+except (OSError, AttributeError):
+    _fallocate = None
+else:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                           ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+
+
+class SpillFile(object):
+
+    """An append-only temporary file, consumed from the front."""
+
+    def __init__(self, directory=None):
+        self.fd, path = tempfile.mkstemp(prefix='teena-spill-', dir=directory)
+        os.unlink(path)
+        # Offsets in the file: where the unconsumed data start and end, and
+        # how much of the front has been punched out already.
+        self.start = self.end = self.punched = 0
+        self.can_punch = _fallocate is not None
+        # The part of the file that's mapped, as a memoryview, and where it
+        # starts.
+        self._window = None
+        self._window_start = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<SpillFile fd:%d %d bytes>' % (self.fd, len(self))
+
+    def append(self, chunks):
+        """Write chunks of data to the end of the file."""
+        written, err = rawio.writev_all(self.fd, chunks)
+        self.end += written
+        if err:
+            raise OSError(err, os.strerror(err))
+
+    def view(self, nbytes):
+        """A memoryview of up to `nbytes` of the data, from the start."""
+        nbytes = min(nbytes, len(self))
+        offset = self.start - self._window_start
+        if self._window is None or offset + nbytes > len(self._window):
+            # Map as much as there is, so later views can use it too.
+            self._window = rawio.map_view(
+                self.fd, self.start, min(max(nbytes, MAP_SIZE), len(self)))
+            self._window_start = self.start
+            offset = 0
+        return self._window[offset:offset + nbytes]
+
+    def send_to(self, fd, nbytes):
+        """`sendfile()` up to `nbytes` from the start; doesn't consume them."""
+        return rawio.sendfile(fd, self.fd, min(nbytes, len(self)),
+                              offset=self.start)
+
+    def consume(self, nbytes):
+        """Discard `nbytes` from the start of the data."""
+        self.start += nbytes
+        if self.start == self.end:
+            # All caught up: start again from the beginning.
+            self._window = None
+            os.ftruncate(self.fd, 0)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            self.start = self.end = self.punched = 0
+        elif self.can_punch and self.start - self.punched >= PUNCH_SIZE:
+            self._punch(self.start - self.start % mmap.PAGESIZE)
+
+    def _punch(self, until):
+        if _fallocate(self.fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                      self.punched, until - self.punched) < 0:
+            err = ctypes.get_errno()
+            if err not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                raise OSError(err, os.strerror(err))
+            self.can_punch = False
+            return
+        self.punched = until
+
+    def close(self):
+        """Close (and so delete) the file."""
+        if self.fd is not None:
+            self._window = None
+            os.close(self.fd)
+            self.fd = None
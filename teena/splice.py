@@ -0,0 +1,135 @@
+"""Copying a stream of data from one file descriptor to another."""
+
+import errno
+
+from teena import DEFAULT_BUFSIZE, rawio
+from teena.fdutils import (SENDFILE, SPLICE, PIPE, classify, close_fd,
+                           ensure_fd, is_nonblocking, is_writable,
+                           transfer_strategy, try_remove_handler)
+from teena.tee import IOLOOP, WOULD_BLOCK, tee
+from teena.thread_loop import ThreadLoop
+
+
+def splice(input_fd, output_fd, bufsize=DEFAULT_BUFSIZE, backend=IOLOOP,
+           strategy=None):
+
+    """
+    Create a loop which copies everything from one input to one output.
+
+    Example:
+
+        >>> in_pipe, out_pipe = Pipe(), Pipe()
+        >>> with splice(in_pipe.read_fd, out_pipe.write_fd).background():
+        ...     os.write(in_pipe.write_fd, "FooBar\\n")
+        ...     in_pipe.close_write()
+        >>> os.read(out_pipe.read_fd, 8192)
+        'FooBar\\n'
+
+    This is a tee with a single output, and closes the input and output in the
+    same way. With `backend=IO_URING`, if either side is a pipe, the data are
+    moved with `splice(2)` and never copied into this process.
+
+    Otherwise, the `strategy` is picked by `fdutils.transfer_strategy()`,
+    unless it's given. With `SPLICE` (one side is a pipe) or `SENDFILE` (the
+    input is a regular file), the data are moved by the kernel, without a
+    copy in this process either; anything else goes through `tee()`.
+    """
+
+    input_fd, output_fd = ensure_fd(input_fd), ensure_fd(output_fd)
+    if backend == IOLOOP:
+        if strategy is None:
+            strategy = transfer_strategy(input_fd, output_fd, refresh=True)
+        if strategy in (SPLICE, SENDFILE):
+            return _kernel_copy(input_fd, output_fd, bufsize, strategy)
+    return tee(input_fd, (output_fd,), bufsize=bufsize, backend=backend)
+
+
+def _sendfile(input_fd, output_fd, nbytes):
+    return rawio.sendfile(output_fd, input_fd, nbytes)
+
+
+def _kernel_copy(input_fd, output_fd, bufsize, strategy):
+
+    """
+    A loop which has the kernel move data from the input to the output.
+
+    The input is waited on until a transfer would block with the output
+    full; then the output, until it's writable again. A transfer which
+    would block has either emptied the input or filled the output, and
+    `poll()` says which, so an output which keeps up is never waited on. A
+    side which can't be polled (a regular file) is never waited on, because
+    it's always ready.
+    """
+
+    loop = ThreadLoop()
+    move = rawio.splice if strategy == SPLICE else _sendfile
+    # Not from the cache: either number may have been closed and reused
+    # since it was classified.
+    input_info = classify(input_fd, refresh=True)
+    output_info = classify(output_fd, refresh=True)
+    # A blocking socket, for instance, may only be read once per wakeup;
+    # splice() never blocks on a pipe, and a regular file is always ready.
+    drain = (input_info.kind == PIPE or not input_info.pollable or
+             is_nonblocking(input_fd))
+    done = [False]
+
+    def finish(close):
+        done[0] = True
+        for fd in (input_fd, output_fd):
+            try_remove_handler(loop, fd)
+            if close:
+                close_fd(fd)
+
+    def wait_on(fd, handler, events):
+        # Only one side is registered at a time: a hangup on the input, say,
+        # mustn't be acted on while there's still data to move out of it.
+        for side in (input_fd, output_fd):
+            try_remove_handler(loop, side)
+        loop.add_handler(fd, handler, events | loop.ERROR)
+
+    def transfer():
+        """Move data until a side would block, and say whether one did."""
+        while True:
+            moved, err = move(input_fd, output_fd, bufsize)
+            if err == errno.EINTR:
+                continue
+            elif err in WOULD_BLOCK:
+                return True
+            # End of the input (close both, as a tee does), or an error on
+            # either side (leave them be).
+            elif err or not moved:
+                finish(close=not err)
+                return False
+            elif not drain:
+                return False
+
+    def output_full():
+        # Only once the input's drained (with `drain`) does a transfer block
+        # because it's empty; otherwise the output must be full.
+        return output_info.pollable and not (drain and
+                                             is_writable(output_fd))
+
+    def on_input(fd, events):
+        # An error or hangup ends with the transfer returning nothing, or
+        # failing.
+        if transfer() and output_full():
+            wait_on(output_fd, on_output, loop.WRITE)
+
+    def on_output(fd, events):
+        if events & loop.ERROR:
+            finish(close=False)
+            return
+        if transfer() and output_full():
+            # Filled up again before the input ran out.
+            return
+        if not done[0] and input_info.pollable:
+            wait_on(input_fd, on_input, loop.READ)
+
+    if input_info.pollable:
+        loop.add_handler(input_fd, on_input, loop.READ | loop.ERROR)
+    elif output_info.pollable:
+        loop.add_handler(output_fd, on_output, loop.WRITE | loop.ERROR)
+    else:
+        # Between two regular files, there's nothing to wait for at all.
+        loop.add_callback(transfer)
+    return loop
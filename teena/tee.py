@@ -6,16 +6,54 @@ outputs.
 """
 
 import collections
+import errno
 from functools import partial
+import itertools
 import os
+import socket
 import sys
+import time
 
-from teena import DEFAULT_BUFSIZE, Error
-from teena.fdutils import ensure_fd, close_fd, try_remove_handler
+from teena import DEFAULT_BUFSIZE, Error, rawio
+from teena.fdutils import (PIPE, SOCKET, FdSet, ensure_fd, classify,
+                           close_fd, get_socket_option, is_nonblocking,
+                           is_packet, is_writable, set_socket_option, socket_error,
+                           try_remove_handler)
+from teena.handle import BACKLOG, CANCELLED, HANGUP, MergedStats, TeeStats
+from teena.shaping import TokenBucket
+from teena.spill import SpillFile
 from teena.thread_loop import ThreadLoop
 
 
-def tee(input_fd, output_fds, bufsize=DEFAULT_BUFSIZE):
+WOULD_BLOCK = Error.WOULD_BLOCK.match_errnos
+
+# The most reads a tee will make from a non-blocking input per wakeup.
+DEFAULT_READS_PER_WAKEUP = 16
+
+# The default read size in packet mode: the biggest datagram there can be.
+MAX_PACKET_SIZE = 65536
+
+# The least that's worth sending with MSG_ZEROCOPY, in one call: below
+# this, pinning the pages and handling the notification costs more than
+# the copy.
+ZEROCOPY_MIN_SIZE = 1 << 14
+
+# The most a tee will write from an output's spill file in one go.
+SPILL_WRITE_SIZE = 1 << 20
+
+# The I/O backends a tee can use. `IOLOOP` is a Tornado IOLoop (epoll on
+# Linux); `IO_URING` is only available on Linux 5.7+, and falls back to
+# `IOLOOP` elsewhere.
+IOLOOP = 'ioloop'
+IO_URING = 'io_uring'
+
+
+def tee(input_fd, output_fds, bufsize=None,
+        reads_per_wakeup=DEFAULT_READS_PER_WAKEUP, backend=IOLOOP,
+        spill_threshold=None, spill_dir=None, packets=False,
+        max_backlog=None, keep_reading=False, max_sndbuf=None,
+        zerocopy=False, writer_threads=None, rate_limits=None,
+        priorities=None):
 
     """
     Create a ThreadLoop which tees from one input to many outputs.
@@ -31,100 +69,802 @@ def tee(input_fd, output_fds, bufsize=DEFAULT_BUFSIZE):
     In this case, input written to one pipe is copied to both stdout *and*
     another pipe. This is useful for capturing output and having it display on
     the console in real-time.
+
+    If the input is non-blocking, each time it becomes readable it will be
+    read until it would block, up to `reads_per_wakeup` reads of `bufsize`
+    bytes, so a single busy input can't starve the rest of the loop. Blocking
+    inputs are read once per wakeup.
+
+    Outputs are written as soon as data have been read, if they have room
+    (and outputs which can't be polled, such as regular files, always do);
+    only those which fall behind are polled for when they're writable again.
+
+    Besides fds, an output can be anything with an `append()` method, which
+    is called with each batch of chunks as soon as they've been read, and
+    its `close()` method (if any) at the end of the input. A
+    `teena.replay.ReplayLog` is one.
+
+    Normally, a slow output's backlog is kept in memory, however big it gets.
+    With a `spill_threshold`, once an output has more than that many bytes
+    waiting, what it's sent after that goes to a `teena.spill.SpillFile` (in
+    `spill_dir`), until it's caught up. Nothing is lost, and nothing slows
+    the input down, but memory use stays flat. A socket or pipe output is
+    sent its spilled data with `sendfile()`; anything else is written from
+    a memory mapping of the file. (Only the default backend spills.) An
+    output whose backlog can't be written to the file (because the disk is
+    full, say) is dropped, with the name of the errno.
+
+    With `packets=True`, the input is a stream of messages, not bytes: a
+    datagram socket, say, or a packet-mode pipe. Each read is one message,
+    of up to `bufsize` bytes (64 KiB by default, the most a datagram can
+    hold; anything longer is cut short by the kernel), and an empty message
+    ends the input. Except from a datagram socket, which anyone can send an
+    empty datagram to: that's skipped, and the input only ends when the
+    socket's shut down (or the tee's cancelled). Every output which keeps
+    message boundaries itself (see `fdutils.is_packet()`) is sent each
+    message intact: a socket with `sendmmsg()`, all of those waiting in one
+    call, and a pipe with a write per message. Other outputs just get the
+    bytes. A message which is too big for an output is dropped, for that
+    output alone, and a datagram output carries on after its receiver has
+    refused one. Packet mode can't be combined with spilling, and always
+    uses the default backend.
+
+    A stream socket output is sent its data with `sendmsg()`. Linux sizes
+    a TCP socket's send buffer by itself, until it's set explicitly; with
+    `max_sndbuf`, a socket which fills up while more than its buffer's
+    worth is waiting for it has its `SO_SNDBUF` doubled, up to that size,
+    so it's written (and woken) less often. With `zerocopy=True`, on Linux
+    4.14+, a socket sent a batch of at least `ZEROCOPY_MIN_SIZE` bytes is
+    sent it with `MSG_ZEROCOPY`, straight from the chunks read, which are
+    kept until the kernel says (on the socket's error queue) that it's done
+    with them. An output that's finished isn't closed until then, either.
+    Where the kernel has to copy the data anyway (such as over loopback),
+    the socket goes back to ordinary sends.
+
+    With a `max_backlog`, an output with more than that many bytes waiting
+    in memory is dropped (and recorded as dropped for `BACKLOG`), rather
+    than holding on to more and more of the stream for it.
+
+    Outputs can be added while the loop is running, in its thread, with
+    `loop.add_output(output, owned=False, rate_limit=None, priority=0)`.
+    An output added with `owned=True` is closed if it's dropped, too, not
+    just when it's done. When there are no outputs left, the tee stops
+    reading its input, unless `keep_reading` is set, in which case it reads
+    and discards it, for any outputs still to come. Once the input has
+    ended, `loop.on_input_end()` is called, if it's been set.
+
+    Outputs can be given a `rate_limits` entry: the most bytes a second
+    they're written (on average), or a `teena.shaping.TokenBucket`. An
+    output which has used up its allowance isn't written to, or polled,
+    until a timer says it can be again. And they can be given a
+    `priorities` entry (0 by default): when several outputs are ready at
+    once, the higher-priority ones are written first. Both are keyed by
+    output, as given in `output_fds`.
+
+    With `writer_threads`, the outputs are shared out between that many
+    loops, each writing its own in a thread of its own, so the system calls
+    for a large fan-out can run on more than one core. The tee's loop only
+    reads, and hands every batch it reads to each of them, in order; it
+    starts them when it's run, and isn't finished until they all are.
+    Outputs added with `add_output()` are written by the tee's own loop.
+
+    With `input_fd=None`, the tee has no input of its own: its loop is
+    handed each batch of chunks with `loop.feed(chunks)`, and told that
+    the input has ended with `loop.end_input()`, both in its thread.
+
+    The loop keeps a `teena.handle.TeeStats` as `loop.stats`: the bytes read
+    and written to each output, and why any outputs were dropped. Running it
+    with `loop.start_background()`, rather than `background()`, returns a
+    `teena.handle.TeeHandle`, to wait on it with a timeout, cancel it, or be
+    called back when it's done.
+
+    Passing `backend=IO_URING` returns a `teena.uring.URingTee` instead,
+    which has the same `background()` interface (though no handles, or
+    stats) but submits all of its reads and writes through io_uring, if the
+    kernel supports it. It has none of the options above, though: with any of
+    `input_fd=None`, `spill_threshold`, `packets`, `max_backlog`,
+    `keep_reading`, `max_sndbuf`, `zerocopy`, `writer_threads`, `rate_limits`
+    or `priorities`, the default backend is used instead.
     """
 
+    if packets and spill_threshold is not None:
+        raise ValueError("A packet-mode tee can't spill its outputs")
+    if bufsize is None:
+        bufsize = MAX_PACKET_SIZE if packets else DEFAULT_BUFSIZE
+
+    if backend == IO_URING:
+        from teena import uring
+        ioloop_only = (
+            input_fd is None or spill_threshold is not None or packets or
+            max_backlog is not None or keep_reading or
+            max_sndbuf is not None or zerocopy or writer_threads or
+            rate_limits or priorities)
+        if uring.is_supported() and not ioloop_only:
+            return uring.URingTee(input_fd, output_fds, bufsize=bufsize)
+    elif backend != IOLOOP:
+        raise ValueError("Unknown tee backend: %r" % (backend,))
+
+    shards = []
+    if writer_threads is not None and writer_threads > 1:
+        output_fds = list(output_fds)
+        output_options = dict(
+            spill_threshold=spill_threshold, spill_dir=spill_dir,
+            packets=packets, max_backlog=max_backlog, max_sndbuf=max_sndbuf,
+            zerocopy=zerocopy, rate_limits=rate_limits, priorities=priorities)
+        for i in xrange(min(writer_threads, len(output_fds))):
+            shards.append(_Shard(output_fds[i::writer_threads],
+                                 output_options))
+        output_fds = shards
+
     loop = ThreadLoop()
+    stats = loop.stats = TeeStats()
 
-    input_fd = ensure_fd(input_fd)
-    # Every output file descriptor gets its own buffer, to begin with.
-    buffers = {}
-    for output_fd in output_fds:
-        buffers[ensure_fd(output_fd)] = collections.deque()
+    if input_fd is not None:
+        input_fd = ensure_fd(input_fd)
+        input_nonblocking = is_nonblocking(input_fd)
+        info = classify(input_fd, refresh=True)
+        input_datagrams = (packets and info.kind == SOCKET and
+                           info.sock_type == socket.SOCK_DGRAM)
+    # Every fd output, keyed by fd (see `_Output`). When outputs have
+    # priorities, `ranked` holds those which do, and `by_priority` every
+    # output, in order of priority, when it's needed (and since outputs came
+    # or went); those which become writable are only noted as `ready` at
+    # first, and then all written in order.
+    outputs = {}
+    ranked = set()
+    by_priority = [None]
+    ready = set()
+    # Outputs which aren't fds, but are handed each batch of chunks through
+    # an `append()` method, such as a `teena.replay.ReplayLog`.
+    appendables = []
+    # Chunks which the kernel was still sending with MSG_ZEROCOPY when their
+    # output went away; they're kept as long as the loop is.
+    orphaned_pins = []
+    # Set once the input is exhausted; writers close their outputs as soon as
+    # their buffers have been flushed.
+    terminating = [False]
 
-    def schedule_clean_up_writers():
-        for output_fd, output_buffer in buffers.iteritems():
-            if not output_buffer:
-                try_remove_handler(loop, output_fd)
+    def add_output(output, owned=False, rate_limit=None, priority=0):
+        if hasattr(output, 'append') and not hasattr(output, 'fileno'):
+            appendables.append(output)
+            stats.bytes_written[output] = 0
+            return
+        output_fd = ensure_fd(output)
+        if terminating[0]:
+            # Too late: there's nothing more to send it.
+            if owned:
                 close_fd(output_fd)
-            else:
-                loop.add_handler(output_fd, partial(writer, terminating=True),
-                                 loop.WRITE | loop.ERROR)
+            return
+        # An fd number may have been used by an earlier output.
+        stats.bytes_written[output_fd] = 0
+        stats.dropped.pop(output_fd, None)
+        if rate_limit is not None and not isinstance(rate_limit, TokenBucket):
+            rate_limit = TokenBucket(rate_limit)
+        output = outputs[output_fd] = _Output(
+            output_fd, owned=owned, bucket=rate_limit, priority=priority,
+            packets=packets, zerocopy=zerocopy)
+        if priority:
+            ranked.add(output)
+        by_priority[0] = None
+        if output.always_ready:
+            return
+        # Each output listens for errors only, until it has data to write.
+        try:
+            loop.add_handler(output_fd, partial(writer, output), loop.ERROR)
+        except Error.BAD_FD:
+            drop_writer(output, errno.EBADF)
 
-    def clean_up_reader(input_fd, close=False):
-        try_remove_handler(loop, input_fd)
+    def live(output):
+        # Whether it hasn't been dropped (or finished with).
+        return outputs.get(output.fd) is output
+
+    def forget_writer(output):
+        outputs.pop(output.fd, None)
+        ranked.discard(output)
+        ready.discard(output)
+        by_priority[0] = None
+        output.writing = False
+        if output.timer is not None:
+            loop.remove_timeout(output.timer)
+            output.timer = None
+        pins = output.release()
+        if pins:
+            orphaned_pins.append(pins)
+
+    def drop_writer(output, reason=None):
+        # An output is dropped with a reason if it's given up on; it's
+        # dropped without one once it's finished.
+        close = reason is not None and output.owned
+        if reason is not None:
+            stats.drop(output.fd, reason)
+        try_remove_handler(loop, output.fd)
+        forget_writer(output)
         if close:
-            close_fd(input_fd)
+            close_fd(output.fd)
+
+    def start_writing(output):
+        if output.timer is not None:
+            # It'll be written when its timer goes off.
+            return True
+        if output.always_ready:
+            # Keep writing for as long as the file makes progress.
+            backlog = None
+            while (output.pending() and output.timer is None and
+                   backlog != output.backlog()):
+                backlog = output.backlog()
+                writer(output, output.fd, 0)
+            return live(output)
+        if output.writing:
+            return True
+        # Try writing it straight away (if a blocking output has room), so
+        # an output which keeps up with the input is never polled for WRITE
+        # events at all.
+        if output.nonblocking or is_writable(output.fd):
+            write(output)
+            if (not live(output) or output.timer is not None or
+                    not output.has_data()):
+                return live(output)
+        try:
+            loop.update_handler(output.fd, loop.WRITE | loop.ERROR)
+        except (Error.BAD_FD, Error.ENOENT), exc:
+            drop_writer(output, exc.errno)
+            return False
+        output.writing = True
+        return True
+
+    def stop_writing(output):
+        if not output.writing:
+            return
+        output.writing = False
+        try:
+            loop.update_handler(output.fd, loop.ERROR)
+        except (Error.BAD_FD, Error.ENOENT), exc:
+            drop_writer(output, exc.errno)
+
+    def schedule_clean_up_writers():
+        terminating[0] = True
+        while appendables:
+            close = getattr(appendables.pop(), 'close', None)
+            if close is not None:
+                close()
+        # Every output with nothing left to write is finished with at once.
+        finished = FdSet(output.fd for output in outputs.values()
+                         if not output.pending())
+        for output_fd in finished:
+            forget_writer(outputs[output_fd])
+        finished.deregister(loop)
+        finished.close()
+
+    def cancel():
+        # Give up on every output still going, and close everything.
+        clean_up_reader(input_fd, close=True)
+        while appendables:
+            output = appendables.pop()
+            stats.drop(output, CANCELLED)
+            close = getattr(output, 'close', None)
+            if close is not None:
+                close()
+        dropped = FdSet(outputs)
+        for output_fd in dropped:
+            stats.drop(output_fd, CANCELLED)
+            forget_writer(outputs[output_fd])
+        dropped.deregister(loop)
+        dropped.close()
+
+    def clean_up_reader(input_fd, close=False):
+        if input_fd is not None:
+            try_remove_handler(loop, input_fd)
+            if close:
+                close_fd(input_fd)
+        if close and loop.on_input_end is not None:
+            loop.on_input_end()
+
+    def end_input():
+        loop.awaiting_input = False
+        schedule_clean_up_writers()
+        clean_up_reader(input_fd, close=True)
 
     def reader(fd, events):
         # If there's an error on the input, flush the output buffers, close and
-        # clean up the reader, and stop.
-        if events & loop.ERROR:
-            schedule_clean_up_writers()
-            clean_up_reader(fd, close=True)
+        # clean up the reader, and stop. A hangup may arrive together with the
+        # last of the data (epoll reports READ | ERROR), so keep reading until
+        # there's nothing left.
+        if events & loop.ERROR and not events & loop.READ:
+            end_input()
             return
 
-        # If there are no file descriptors to write to any more, stop, but
-        # don't close the input.
-        if not buffers:
+        # If there are no outputs to write to any more, stop, but don't close
+        # the input.
+        if not (outputs or appendables or keep_reading):
             clean_up_reader(fd, close=False)
             return
 
-        # The loop is necessary for errors like EAGAIN and EINTR.
-        while True:
-            try:
-                data = os.read(fd, bufsize)
-            except (Error.EAGAIN, Error.EINTR):
+        # Drain the input until it would block, the budget for this wakeup
+        # runs out, or the input is exhausted. EAGAIN always hands control
+        # back to the loop; it'll call us again when there's more to read.
+        chunks = []
+        exhausted = False
+        for _ in xrange(reads_per_wakeup):
+            data, err = rawio.read(fd, bufsize)
+            if err == errno.EINTR:
                 continue
-            except (Error.EPIPE, Error.ECONNRESET, Error.EIO):
-                schedule_clean_up_writers()
-                clean_up_reader(fd, close=True)
-                return
-            break
+            elif err in WOULD_BLOCK:
+                # A datagram socket which has been shut down has nothing to
+                # read, rather than an empty read, once it's drained.
+                exhausted = bool(input_datagrams and events & loop.ERROR)
+                break
+            if not (err or data or events & loop.ERROR) and input_datagrams:
+                # An empty datagram, not the end of the input (which a
+                # datagram socket only reaches by being shut down).
+                if not input_nonblocking:
+                    break
+                continue
+            # The source of the data for the input FD has been closed, or has
+            # gone away.
+            if err or not data:
+                exhausted = True
+                break
+            chunks.append(data)
+            # A blocking input may only be read once per readiness event, and
+            # a short read means a non-blocking one has been drained (unless
+            # it's a message, which is as long as it is).
+            if not input_nonblocking or (len(data) < bufsize and
+                                         not packets):
+                break
 
-        # The source of the data for the input FD has been closed.
-        if not data:
-            schedule_clean_up_writers()
-            clean_up_reader(fd, close=True)
-            return
+        if chunks:
+            feed(chunks)
+        if exhausted:
+            end_input()
 
-        # Put the chunk of data in the buffer of every registered output.
-        # If an output FD has been closed, remove it from the list of buffers.
-        bad_fds = []
-        for output_fd, buffer in buffers.iteritems():
-            buffer.appendleft(data)
+    def in_order():
+        if not ranked:
+            return outputs.values()
+        if by_priority[0] is None:
+            by_priority[0] = sorted(outputs.values(),
+                                    key=lambda output: -output.priority)
+        return by_priority[0]
+
+    def feed(chunks):
+        # Put the chunks of data in the buffer of every registered output, and
+        # make sure each one is listening for WRITE events. If an output FD
+        # has been closed, it's removed from the list of buffers. An output
+        # which is spilling carries on until it has caught up, so that its
+        # data stay in order.
+        size = sum(itertools.imap(len, chunks))
+        stats.bytes_read += size
+        for output in in_order():
+            if not live(output):
+                # Dropped since the order was worked out.
+                continue
+            try:
+                output.push(chunks, size, spill_threshold, spill_dir)
+            except (OSError, IOError), exc:
+                # Out of disk space, say: its data can't be kept.
+                drop_writer(output, exc.errno or str(exc))
+                continue
+            if max_backlog is not None and output.queued > max_backlog:
+                drop_writer(output, BACKLOG)
+                continue
+            start_writing(output)
+        for output in appendables[:]:
             try:
-                loop.add_handler(output_fd, writer, loop.WRITE | loop.ERROR)
-            except Error.EBADF:
-                bad_fds.append(output_fd)
-        for bad_fd in bad_fds:
-            del buffers[bad_fd]
+                output.append(chunks)
+            except (OSError, IOError), exc:
+                appendables.remove(output)
+                stats.drop(output, exc.errno or str(exc))
+            else:
+                stats.bytes_written[output] += size
 
-    def writer(fd, events, terminating=False):
+    def writer(output, fd, events):
         if events & loop.ERROR:
-            try_remove_handler(loop, fd)
-            del buffers[fd]
+            if not output.recoverable():
+                drop_writer(output, HANGUP)
+                return
+            elif not events & loop.WRITE:
+                finish_writing(output)
+                return
+        if ranked and events & loop.WRITE:
+            if not ready:
+                loop.add_callback(write_ready)
+            ready.add(output)
+            return
+        write(output)
+
+    def write_ready():
+        # Every output which became writable in the last iteration, most
+        # important first.
+        ordered = sorted(ready, key=lambda output: -output.priority)
+        ready.clear()
+        for output in ordered:
+            if output.writing:
+                write(output)
+
+    def write(output):
+        bucket = output.bucket
+        limit = None
+        if bucket is not None:
+            limit = bucket.available()
+            if not limit:
+                defer(output)
+                return
+
+        # There's no input -- stop listening for WRITE events, they'll be
+        # requested again when there's something to write.
+        if not output.has_data():
+            stop_writing(output)
+            return
+
+        written, err = output.write(limit)
+        stats.bytes_written[output.fd] += written
+        if bucket is not None:
+            bucket.consume(written)
+        if (max_sndbuf is not None and output.stream_socket and
+                (not err or err in WOULD_BLOCK) and output.queued):
+            # The socket has filled up, with more still waiting for it.
+            output.grow_send_buffer(max_sndbuf)
+        if err in WOULD_BLOCK:
+            return
+        elif err:
+            drop_writer(output, err)
             return
+        if (bucket is not None and output.has_data() and
+                not bucket.available()):
+            defer(output)
+            return
+        finish_writing(output)
 
-        # There's no input -- unschedule the writer, it'll be rescheduled again
-        # when there's something for it to write.
-        if not buffers[fd]:
-            try_remove_handler(loop, fd)
-            if terminating:
-                close_fd(fd)
+    def defer(output):
+        # Stop polling the output until its bucket has enough in it for the
+        # backlog, or a whole burst.
+        if output.timer is not None:
+            return
+        stop_writing(output)
+        if not live(output):
             return
+        delay = output.bucket.delay(output.backlog())
+        output.timer = loop.add_timeout(time.time() + delay,
+                                        partial(resume, output))
+
+    def resume(output):
+        output.timer = None
+        start_writing(output)
+
+    def finish_writing(output):
+        # An output that's caught up stays polled for WRITE events until a
+        # wakeup finds nothing to write, rather than being switched off and
+        # on again with every chunk.
+        if terminating[0] and not output.pending():
+            drop_writer(output)
+            close_fd(output.fd)
+
+    if input_fd is not None:
+        loop.add_handler(input_fd, reader, loop.READ | loop.ERROR)
+    rate_limits = rate_limits or {}
+    priorities = priorities or {}
+    for output in output_fds:
+        add_output(output, rate_limit=rate_limits.get(output),
+                   priority=priorities.get(output, 0))
+    loop.add_output = add_output
+    loop.feed = feed
+    # Safe to call from other threads.
+    loop.has_outputs = lambda: bool(outputs or appendables)
+    loop.awaiting_input = input_fd is None
+    loop.end_input = end_input
+    loop.on_cancel = cancel
+    if shards:
+        loop.workers = [shard.loop for shard in shards]
+        loop.stats = MergedStats(stats, [shard.loop.stats for shard in shards],
+                                 hidden=shards)
+
+    return loop
+
+
+def _first_bytes(chunks, nbytes):
+    """The chunks which hold the first `nbytes` bytes of a batch."""
+    taken = []
+    for data in chunks:
+        if len(data) >= nbytes:
+            taken.append(data[:nbytes])
+            break
+        taken.append(data)
+        nbytes -= len(data)
+    return taken
+
+
+def _first_messages(messages, nbytes):
+    """The messages which hold the first `nbytes` bytes (at least one)."""
+    total = 0
+    for i, data in enumerate(messages):
+        total += len(data)
+        if total >= nbytes:
+            return messages[:i + 1]
+    return messages
+
+
+def _enable_zerocopy(fd):
+    try:
+        set_socket_option(fd, socket.SOL_SOCKET, rawio.SO_ZEROCOPY, 1)
+    except socket.error:
+        # Not on this kernel, or not for this kind of socket.
+        return False
+    return True
+
+
+class _Output(object):
+
+    """
+    One of a tee's fd outputs: what's waiting for it, and how it's written.
+
+    The tee decides when an output is written, and what to do when that
+    fails; the output knows how to write itself, whatever kind of fd it is.
+    """
+
+    def __init__(self, fd, owned=False, bucket=None, priority=0,
+                 packets=False, zerocopy=False):
+        self.fd = fd
+        # Whether it's closed when it's dropped, and not just once it's done.
+        self.owned = owned
+        self.bucket = bucket
+        self.priority = priority
+        # The chunks waiting for it, and how many bytes they come to; and
+        # its spill file, once it's needed one.
+        self.buffer = collections.deque()
+        self.queued = 0
+        self.spill = None
+        # Whether it's registered for WRITE events; and while its bucket is
+        # empty, the timer it's waiting on.
+        self.writing = False
+        self.timer = None
+        info = classify(fd, refresh=True)
+        # Outputs which can't be polled are written straight after each
+        # read, and so are others with room, unless they're waiting for
+        # WRITE events already (non-blocking ones without checking first).
+        # Pipes and sockets can be sent spilled data with `sendfile()`.
+        self.always_ready = not info.pollable
+        self.nonblocking = is_nonblocking(fd)
+        self.can_sendfile = (info.kind in (PIPE, SOCKET) and
+                             rawio.HAVE_SENDFILE)
+        # In packet mode, whether it's sent a message at a time; and if so,
+        # whether it's a socket, and a datagram socket.
+        self.packets = packets and is_packet(fd)
+        self.packet_socket = self.packets and info.kind == SOCKET
+        self.datagrams = (self.packet_socket and
+                          info.sock_type == socket.SOCK_DGRAM)
+        # Stream sockets are sent data with `sendmsg()`; this is the size of
+        # the send buffer, once it's been looked at.
+        self.stream_socket = (not self.packets and info.kind == SOCKET and
+                              info.sock_type == socket.SOCK_STREAM)
+        self.send_buffer = None
+        # Whether it's being sent data with MSG_ZEROCOPY; and if it ever has
+        # been, the number of its next send, and each send's chunks, by
+        # number, until the kernel has finished with them.
+        self.zerocopy = (zerocopy and self.stream_socket and
+                         _enable_zerocopy(fd))
+        self.zerocopy_sends = 0
+        self.pins = {} if self.zerocopy else None
+
+    def __repr__(self):
+        return '<_Output fd:%d queued:%d>' % (self.fd, self.queued)
+
+    def has_data(self):
+        """Whether there's anything waiting to be written to it."""
+        return bool(self.buffer or self.spill)
 
-        data = buffers[fd].pop()
+    def pending(self):
+        """Whether it isn't done with yet (the kernel may still be sending)."""
+        return bool(self.buffer or self.spill or self.pins)
+
+    def backlog(self):
+        """The bytes waiting for it, in memory or on disk."""
+        return self.queued + len(self.spill or ())
+
+    def push(self, chunks, size, spill_threshold=None, spill_dir=None):
+        """
+        Queue a batch of chunks (`size` bytes) to be written. Once it's over
+        the `spill_threshold`, they go to its spill file, until it's caught
+        up, which may raise `OSError`.
+        """
+        if self.spill or (spill_threshold is not None and
+                          self.queued + size > spill_threshold):
+            if self.spill is None:
+                self.spill = SpillFile(spill_dir)
+            self.spill.append(chunks)
+        else:
+            self.buffer.extend(chunks)
+            self.queued += size
+
+    def write(self, limit=None):
+        """
+        Write as much as it'll take (up to `limit` bytes) in one go, and
+        return how much was written, and the errno it stopped with, if any.
+        """
+        if not self.buffer:
+            return self._write_spill(limit)
+        elif self.packets:
+            return self._write_messages(limit)
+        return self._write_buffer(limit)
+
+    def _write_buffer(self, limit):
+        buffer = self.buffer
         while True:
+            batch = list(itertools.islice(buffer, rawio.IOV_MAX))
+            if limit is not None:
+                batch = _first_bytes(batch, limit)
+            if self.stream_socket:
+                written, err = self._send_batch(batch)
+            else:
+                written, err = rawio.writev(self.fd, batch)
+            if err != errno.EINTR:
+                break
+        if err:
+            return 0, err
+
+        # Discard whatever was written; a partial write leaves the rest of a
+        # chunk at the front of the buffer.
+        self.queued -= written
+        remaining = written
+        while remaining:
+            data = buffer[0]
+            if remaining < len(data):
+                buffer[0] = data[remaining:]
+                break
+            buffer.popleft()
+            remaining -= len(data)
+        return written, 0
+
+    def _send_batch(self, batch):
+        if self.zerocopy and self.queued >= ZEROCOPY_MIN_SIZE:
             try:
-                os.write(fd, data)
-            except (Error.EPIPE, Error.ECONNRESET, Error.EIO, Error.EBADF):
-                del buffers[fd]
-                try_remove_handler(loop, fd)
-            except (Error.EAGAIN, Error.EINTR):
+                written, err = rawio.sendmsg(
+                    self.fd, batch, rawio.MSG_NOSIGNAL | rawio.MSG_ZEROCOPY)
+            except Error.ENOBUFS:
+                # Too many sends waiting to complete; copy this one.
+                pass
+            else:
+                if not err:
+                    number = self.zerocopy_sends
+                    self.pins[number] = batch
+                    self.zerocopy_sends = (number + 1) & 0xffffffff
+                return written, err
+        return rawio.sendmsg(self.fd, batch)
+
+    def _write_messages(self, limit):
+        # Send as many buffered messages as it will take, or (with a `limit`)
+        # as many as it takes to send that many bytes.
+        buffer = self.buffer
+        total = 0
+        while buffer and (limit is None or limit > 0):
+            try:
+                if self.packet_socket:
+                    batch = list(itertools.islice(buffer, rawio.IOV_MAX))
+                    if limit is not None:
+                        batch = _first_messages(batch, limit)
+                    sent, err = rawio.sendmmsg(self.fd, batch)
+                else:
+                    written, err = rawio.write(self.fd, buffer[0])
+                    sent = 1
+                    if not err and written < len(buffer[0]):
+                        # Only a message bigger than PIPE_BUF can be split.
+                        self.queued -= written
+                        total += written
+                        buffer[0] = buffer[0][written:]
+                        if limit is not None:
+                            limit -= written
+                        continue
+            except Error.EMSGSIZE:
+                # Too big for this output; the rest can still be sent.
+                sent, err = 1, 0
+            except Error.ECONNREFUSED:
+                # An earlier datagram was refused. This one wasn't sent, but
+                # the error's been cleared, so it can be tried again.
                 continue
-            break
+            if err == errno.EINTR:
+                continue
+            elif err:
+                return total, err
+            for _ in xrange(sent):
+                size = len(buffer.popleft())
+                self.queued -= size
+                total += size
+                if limit is not None:
+                    limit -= size
+        return total, 0
+
+    def _write_spill(self, limit):
+        # Write from the spill file, once the buffer is empty.
+        spill = self.spill
+        size = SPILL_WRITE_SIZE if limit is None else min(limit,
+                                                           SPILL_WRITE_SIZE)
+        while True:
+            if self.can_sendfile:
+                written, err = spill.send_to(self.fd, size)
+            else:
+                written, err = rawio.write(self.fd, spill.view(size))
+            if err != errno.EINTR:
+                break
+        if err:
+            return 0, err
+        spill.consume(written)
+        return written, 0
 
-    # Start with just the reader.
-    loop.add_handler(input_fd, reader, loop.READ | loop.ERROR)
+    def reap_zerocopy(self):
+        """Let go of chunks the kernel's done with; say if there were any."""
+        ranges, err = rawio.zerocopy_completions(self.fd)
+        pins = self.pins
+        for first, last, copied in ranges:
+            number = first
+            while True:
+                pins.pop(number, None)
+                if number == last:
+                    break
+                number = (number + 1) & 0xffffffff
+            if copied:
+                self.zerocopy = False
+        return bool(ranges)
 
-    return loop
+    def recoverable(self):
+        """Whether an error reported on it can be cleared, and was."""
+        # MSG_ZEROCOPY completions are reported as errors. And a datagram
+        # socket's error may only be that its receiver wasn't there for a
+        # datagram. Reading either clears it.
+        if self.pins is not None and self.reap_zerocopy():
+            return True
+        return (self.datagrams and
+                socket_error(self.fd) == errno.ECONNREFUSED)
+
+    def grow_send_buffer(self, max_sndbuf):
+        """Double the socket's send buffer, if it's full with more waiting."""
+        size = self.send_buffer
+        if size is None:
+            size = self.send_buffer = get_socket_option(
+                self.fd, socket.SOL_SOCKET, socket.SO_SNDBUF)
+        if size >= max_sndbuf or self.queued <= size:
+            return
+        # Linux doubles whatever it's given, to allow for its own overhead,
+        # and caps it at net.core.wmem_max.
+        set_socket_option(self.fd, socket.SOL_SOCKET, socket.SO_SNDBUF,
+                          min(size * 2, max_sndbuf) // 2)
+        grown = get_socket_option(self.fd, socket.SOL_SOCKET,
+                                  socket.SO_SNDBUF)
+        self.send_buffer = grown if grown > size else max_sndbuf
+
+    def release(self):
+        """
+        Let go of everything waiting for it, once it's been dropped, and
+        return the chunks the kernel is still sending with MSG_ZEROCOPY.
+        """
+        pins = self.pins
+        if pins:
+            self.reap_zerocopy()
+        self.pins = None
+        self.zerocopy = False
+        self.buffer.clear()
+        self.queued = 0
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        return pins
+
+
+class _Shard(object):
+
+    """
+    Some of a tee's outputs, written by a loop of their own.
+
+    It's an output of the tee which reads the input, which hands each batch
+    of chunks over to the shard's loop, in that loop's thread.
+    """
+
+    def __init__(self, outputs, options):
+        self.loop = tee(None, outputs, **options)
+
+    def append(self, chunks):
+        if not self.loop.has_outputs():
+            # Every one of them has been dropped.
+            self.close()
+            raise IOError(errno.EPIPE, os.strerror(errno.EPIPE))
+        self.loop.add_callback(partial(self.loop.feed, chunks))
+
+    def close(self):
+        self.loop.add_callback(self.loop.end_input)
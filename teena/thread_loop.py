@@ -1,8 +1,10 @@
 from contextlib import contextmanager
-import threading
+from functools import partial
 
 import tornado.ioloop
 
+from teena.handle import TeeHandle
+
 
 class ThreadLoop(tornado.ioloop.IOLoop):
 
@@ -19,27 +21,134 @@ class ThreadLoop(tornado.ioloop.IOLoop):
         ...     os.close(write_fd)
 
     In this case, ``process_items`` should detect an empty string from
-    `os.read()`, and shut down the loop.
+    `os.read()`, and shut down the loop. The loop also stops by itself once
+    no handlers, or timeouts, are left.
+
+    `start_background()` returns a `teena.handle.TeeHandle` instead, to
+    wait on the loop, or cancel it, without blocking in a `with` block.
+
+    A loop can have `workers`: other loops which do some of its work, each
+    in a thread of its own. They're started along with it (however it's
+    started), and cancelled along with it, and it isn't finished until they
+    are. They aren't closed until then, either, so it can always hand them
+    work with their `add_callback()`.
     """
 
+    # Set by `tee()`: a `teena.handle.TeeStats`, and what to do (in the
+    # loop's thread) when the loop is cancelled, before it stops. And set
+    # for `tee()`: what to do once its input has ended.
+    stats = None
+    on_cancel = None
+    on_input_end = None
+    workers = ()
+    # Set for a `tee()` which is fed its input, rather than reading it, until
+    # the input has ended: until then, it isn't idle, even with no handlers.
+    awaiting_input = False
+    # The `TeeHandle`s of the workers, once they've been started.
+    _worker_handles = ()
+    # Whether `run()` is stopping the loop once it's idle, and whether it's
+    # been cancelled.
+    _until_idle = False
+    cancelled = False
+
+    def remove_handler(self, fd):
+        super(ThreadLoop, self).remove_handler(fd)
+        self._check_idle()
+
+    def remove_handlers(self, fds):
+        """Stop listening for events on many fds, skipping unregistered ones."""
+        for fd in fds:
+            if self._handlers.pop(fd, None) is None:
+                continue
+            self._events.pop(fd, None)
+            try:
+                self._impl.unregister(fd)
+            except (OSError, IOError):
+                pass
+        self._check_idle()
+
+    def add_timeout(self, deadline, callback):
+        return super(ThreadLoop, self).add_timeout(
+            deadline, partial(self._run_timeout, callback))
+
+    def _run_timeout(self, callback):
+        try:
+            callback()
+        finally:
+            self._check_idle()
+
+    def remove_timeout(self, timeout):
+        super(ThreadLoop, self).remove_timeout(timeout)
+        self._check_idle()
+
+    def _check_idle(self):
+        # Checked on the next iteration, because a handler is often removed
+        # just before another is added.
+        if self._until_idle and self._running:
+            self.add_callback(self._stop_if_idle)
+
+    def _stop_if_idle(self):
+        # We're not a long-running web server, so once the only handler left
+        # is the 'waker', we get to stop.
+        if (self._handlers.keys() == [self._waker.fileno()] and
+                not self.awaiting_input and
+                all(timeout.callback is None for timeout in self._timeouts)):
+            self.stop()
+
+    def start(self):
+        """
+        Run the loop in this thread until it's stopped, and then wait for its
+        workers to finish.
+        """
+        handles = self._worker_handles = [
+            TeeHandle(worker, close=False) for worker in self.workers]
+        try:
+            super(ThreadLoop, self).start()
+        except Exception:
+            for handle in handles:
+                handle.cancel()
+            raise
+        finally:
+            for handle in handles:
+                handle.wait()
+                handle.loop.close()
+
+    def run(self):
+        """
+        Run the loop in this thread, until it has nothing left to do, and
+        its workers have finished.
+        """
+        self._until_idle = True
+        self.add_callback(self._stop_if_idle)
+        try:
+            self.start()
+        finally:
+            self._until_idle = False
+
+    def cancel(self):
+        """Stop the loop early, from any thread, calling `on_cancel()` first."""
+        self.add_callback(self._cancel)
+
+    def _cancel(self):
+        self.cancelled = True
+        # The workers go first, so that they drop what they have left,
+        # rather than finishing it off as the end of the input.
+        for handle in self._worker_handles:
+            handle.cancel()
+        if self.on_cancel is not None:
+            self.on_cancel()
+        self.stop()
+
+    def start_background(self):
+        """Run the loop in a new thread, and return a `TeeHandle` for it."""
+        return TeeHandle(self)
+
     @contextmanager
     def background(self):
-        # If the loop ever reaches a point where the only handler is the
-        # 'waker', terminate it (we're not a long-running web server, so we
-        # get to do this).
-        def callback():
-            if self.running():
-                if self._handlers.keys() == [self._waker.fileno()]:
-                    self.stop()
-                else:
-                    self.add_callback(callback)
-        self.add_callback(callback)
-
-        thread = threading.Thread(target=self.start)
-        thread.daemon = True
-        thread.start()
+        handle = self.start_background()
         try:
-            yield
+            yield handle
         finally:
-            thread.join()
-            self.close()
+            handle.wait()
+        if handle.exception() is not None:
+            raise handle.exception()
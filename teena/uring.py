@@ -0,0 +1,472 @@
+"""
+A minimal io_uring binding, and a tee implementation which uses it.
+
+Only the handful of operations teena needs are supported (read, write, poll
+and splice), and only on Linux 5.7 or newer. Use `is_supported()` to check
+before creating a `URing` directly; `tee()` and `splice()` fall back to the
+IOLoop backend by themselves.
+"""
+
+from contextlib import contextmanager
+import collections
+import ctypes
+import errno
+import mmap
+import os
+import stat
+import threading
+
+from teena import DEFAULT_BUFSIZE, Error
+from teena.fdutils import ensure_fd, close_fd
+
+
+__all__ = ['URing', 'URingTee', 'is_supported']
+
+
+# These syscall numbers are shared by every architecture except alpha.
+SYS_io_uring_setup = 425
+SYS_io_uring_enter = 426
+
+IORING_OFF_SQ_RING = 0
+IORING_OFF_CQ_RING = 0x8000000
+IORING_OFF_SQES = 0x10000000
+
+IORING_ENTER_GETEVENTS = 1 << 0
+
+IORING_FEAT_SINGLE_MMAP = 1 << 0
+IORING_FEAT_NODROP = 1 << 1
+# Introduced in 5.7, alongside IORING_OP_SPLICE.
+IORING_FEAT_FAST_POLL = 1 << 5
+
+IOSQE_IO_LINK = 1 << 2
+
+IORING_OP_POLL_ADD = 6
+IORING_OP_READ = 22
+IORING_OP_WRITE = 23
+IORING_OP_SPLICE = 30
+
+SPLICE_F_MOVE = 1
+POLLIN = 0x001
+POLLOUT = 0x004
+
+# An offset of -1 means 'use (and update) the current file position'.
+CURRENT_POSITION = (1 << 64) - 1
+
+DEFAULT_ENTRIES = 64
+MAX_ENTRIES = 4096
+
+# Linux's ECANCELED, which Python 2's errno module doesn't have. A linked
+# operation gets this if the poll before it fails.
+ECANCELED = getattr(errno, 'ECANCELED', 125)
+
+# Results which mean 'try the same operation again'.
+RETRY_ERRNOS = Error.TRANSIENT.match_errnos | frozenset([ECANCELED])
+
+
+class _SQRingOffsets(ctypes.Structure):
+    _fields_ = [('head', ctypes.c_uint32),
+                ('tail', ctypes.c_uint32),
+                ('ring_mask', ctypes.c_uint32),
+                ('ring_entries', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('dropped', ctypes.c_uint32),
+                ('array', ctypes.c_uint32),
+                ('resv1', ctypes.c_uint32),
+                ('user_addr', ctypes.c_uint64)]
+
+
+class _CQRingOffsets(ctypes.Structure):
+    _fields_ = [('head', ctypes.c_uint32),
+                ('tail', ctypes.c_uint32),
+                ('ring_mask', ctypes.c_uint32),
+                ('ring_entries', ctypes.c_uint32),
+                ('overflow', ctypes.c_uint32),
+                ('cqes', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('resv1', ctypes.c_uint32),
+                ('user_addr', ctypes.c_uint64)]
+
+
+class _Params(ctypes.Structure):
+    _fields_ = [('sq_entries', ctypes.c_uint32),
+                ('cq_entries', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32),
+                ('sq_thread_cpu', ctypes.c_uint32),
+                ('sq_thread_idle', ctypes.c_uint32),
+                ('features', ctypes.c_uint32),
+                ('wq_fd', ctypes.c_uint32),
+                ('resv', ctypes.c_uint32 * 3),
+                ('sq_off', _SQRingOffsets),
+                ('cq_off', _CQRingOffsets)]
+
+
+class _SQE(ctypes.Structure):
+    _fields_ = [('opcode', ctypes.c_uint8),
+                ('flags', ctypes.c_uint8),
+                ('ioprio', ctypes.c_uint16),
+                ('fd', ctypes.c_int32),
+                ('off', ctypes.c_uint64),
+                ('addr', ctypes.c_uint64),
+                ('len', ctypes.c_uint32),
+                ('op_flags', ctypes.c_uint32),
+                ('user_data', ctypes.c_uint64),
+                ('buf_index', ctypes.c_uint16),
+                ('personality', ctypes.c_uint16),
+                ('splice_fd_in', ctypes.c_int32),
+                ('addr3', ctypes.c_uint64),
+                ('pad', ctypes.c_uint64)]
+
+
+class _CQE(ctypes.Structure):
+    _fields_ = [('user_data', ctypes.c_uint64),
+                ('res', ctypes.c_int32),
+                ('flags', ctypes.c_uint32)]
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _syscall(*args):
+    args = [ctypes.c_long(arg) if isinstance(arg, (int, long)) else arg
+            for arg in args]
+    result = _libc.syscall(*args)
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class URing(object):
+
+    """
+    A submission/completion queue pair, mapped into this process.
+
+    Operations are queued with the `prep_*()` methods, each tagged with an
+    integer `user_data`, and are all handed to the kernel in a single
+    `io_uring_enter()` call by `submit()`. Their results are then collected
+    as `(user_data, result)` pairs by `completions()`, where a negative result
+    is a negated errno.
+    """
+
+    def __init__(self, entries=DEFAULT_ENTRIES):
+        params = _Params()
+        self.fd = _syscall(SYS_io_uring_setup, entries, ctypes.byref(params))
+        try:
+            self._map(params)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.features = params.features
+        self.pending = 0
+
+    def _map(self, params):
+        sq_off, cq_off = params.sq_off, params.cq_off
+        sq_size = sq_off.array + params.sq_entries * 4
+        cq_size = cq_off.cqes + params.cq_entries * ctypes.sizeof(_CQE)
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+        self._sq_map = mmap.mmap(self.fd, max(sq_size, cq_size),
+                                 mmap.MAP_SHARED, prot,
+                                 offset=IORING_OFF_SQ_RING)
+        if params.features & IORING_FEAT_SINGLE_MMAP:
+            self._cq_map = self._sq_map
+        else:
+            self._cq_map = mmap.mmap(self.fd, cq_size, mmap.MAP_SHARED, prot,
+                                     offset=IORING_OFF_CQ_RING)
+        self._sqe_map = mmap.mmap(self.fd,
+                                  params.sq_entries * ctypes.sizeof(_SQE),
+                                  mmap.MAP_SHARED, prot,
+                                  offset=IORING_OFF_SQES)
+
+        sq_base = ctypes.addressof(ctypes.c_char.from_buffer(self._sq_map))
+        cq_base = ctypes.addressof(ctypes.c_char.from_buffer(self._cq_map))
+        u32 = ctypes.c_uint32.from_address
+        self._sq_head = u32(sq_base + sq_off.head)
+        self._sq_tail = u32(sq_base + sq_off.tail)
+        self._sq_mask = u32(sq_base + sq_off.ring_mask).value
+        self.sq_entries = u32(sq_base + sq_off.ring_entries).value
+        self._sqes = (_SQE * self.sq_entries).from_buffer(self._sqe_map)
+        # Use the identity mapping from SQ ring slots to SQEs.
+        sq_array = (ctypes.c_uint32 * self.sq_entries).from_address(
+            sq_base + sq_off.array)
+        for i in xrange(self.sq_entries):
+            sq_array[i] = i
+
+        self._cq_head = u32(cq_base + cq_off.head)
+        self._cq_tail = u32(cq_base + cq_off.tail)
+        self._cq_mask = u32(cq_base + cq_off.ring_mask).value
+        self.cq_entries = u32(cq_base + cq_off.ring_entries).value
+        self._cqes = (_CQE * self.cq_entries).from_address(
+            cq_base + cq_off.cqes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap the rings and close the io_uring file descriptor."""
+        if self.fd is None:
+            return
+        # The ctypes views point into the maps, so drop them first.
+        self._sqes = self._cqes = None
+        self._sq_head = self._sq_tail = self._cq_head = self._cq_tail = None
+        for ring_map in set([self._sq_map, self._cq_map, self._sqe_map]):
+            ring_map.close()
+        os.close(self.fd)
+        self.fd = None
+
+    @property
+    def space(self):
+        """The number of SQEs which can be queued before submitting."""
+        return self.sq_entries - self.pending
+
+    def _next_sqe(self, opcode, fd, user_data, flags):
+        if not self.space:
+            self.submit()
+        tail = (self._sq_tail.value + self.pending) & 0xffffffff
+        sqe = self._sqes[tail & self._sq_mask]
+        ctypes.memset(ctypes.addressof(sqe), 0, ctypes.sizeof(_SQE))
+        sqe.opcode = opcode
+        sqe.flags = flags
+        sqe.fd = fd
+        sqe.user_data = user_data
+        self.pending += 1
+        return sqe
+
+    def prep_read(self, fd, address, length, user_data, flags=0,
+                  offset=CURRENT_POSITION):
+        """Queue a read of up to `length` bytes into memory at `address`."""
+        sqe = self._next_sqe(IORING_OP_READ, fd, user_data, flags)
+        sqe.addr = address
+        sqe.len = length
+        sqe.off = offset
+
+    def prep_write(self, fd, address, length, user_data, flags=0,
+                   offset=CURRENT_POSITION):
+        """Queue a write of `length` bytes from memory at `address`."""
+        sqe = self._next_sqe(IORING_OP_WRITE, fd, user_data, flags)
+        sqe.addr = address
+        sqe.len = length
+        sqe.off = offset
+
+    def prep_splice(self, fd_in, fd_out, length, user_data, flags=0,
+                    splice_flags=SPLICE_F_MOVE):
+        """Queue a splice of up to `length` bytes between two fds."""
+        sqe = self._next_sqe(IORING_OP_SPLICE, fd_out, user_data, flags)
+        sqe.splice_fd_in = fd_in
+        sqe.addr = CURRENT_POSITION  # The input offset.
+        sqe.off = CURRENT_POSITION
+        sqe.len = length
+        sqe.op_flags = splice_flags
+
+    def prep_poll(self, fd, poll_events, user_data, flags=0):
+        """Queue a one-shot poll; link an operation to it to retry EAGAIN."""
+        sqe = self._next_sqe(IORING_OP_POLL_ADD, fd, user_data, flags)
+        sqe.op_flags = poll_events
+
+    def submit(self, wait_nr=0):
+        """Submit every queued SQE, optionally waiting for completions."""
+        to_submit = self.pending
+        self._sq_tail.value = (self._sq_tail.value + to_submit) & 0xffffffff
+        self.pending = 0
+        flags = IORING_ENTER_GETEVENTS if wait_nr else 0
+        while True:
+            try:
+                return _syscall(SYS_io_uring_enter, self.fd, to_submit,
+                                wait_nr, flags, None, 0)
+            except OSError, exc:
+                if exc.errno != errno.EINTR:
+                    raise
+                # The SQEs were consumed before the wait was interrupted.
+                to_submit = 0
+
+    def completions(self):
+        """Yield `(user_data, result)` for every available completion."""
+        head = self._cq_head.value
+        while head != self._cq_tail.value:
+            cqe = self._cqes[head & self._cq_mask]
+            user_data, res = cqe.user_data, cqe.res
+            head = (head + 1) & 0xffffffff
+            self._cq_head.value = head
+            yield user_data, res
+
+
+_supported = []
+
+
+def is_supported():
+    """Return True if this kernel supports everything `URingTee` needs."""
+    if not _supported:
+        try:
+            with URing(entries=2) as ring:
+                required = (IORING_FEAT_SINGLE_MMAP | IORING_FEAT_NODROP |
+                            IORING_FEAT_FAST_POLL)
+                _supported.append(ring.features & required == required)
+        except (OSError, EnvironmentError, AttributeError):
+            _supported.append(False)
+    return _supported[0]
+
+
+def _ring_size(n_outputs):
+    # Room for a read, and a poll plus a write for every output.
+    entries = DEFAULT_ENTRIES
+    while entries < 2 * (n_outputs + 1) and entries < MAX_ENTRIES:
+        entries *= 2
+    return entries
+
+
+def _is_fifo(fd):
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+class URingTee(object):
+
+    """
+    Tees from one input to many outputs, with all I/O done through io_uring.
+
+    Each chunk read from the input is written to every output; all of the
+    writes, and the next read, go to the kernel in one `io_uring_enter()`
+    call. With a single output and a pipe on either side, the data are
+    spliced directly, without passing through this process.
+
+    This has the same interface as a `ThreadLoop` returned by `tee()`, and
+    follows the same rules about closing the input and outputs.
+    """
+
+    READ, WRITE, POLL, SPLICE = range(4)
+
+    def __init__(self, input_fd, output_fds, bufsize=DEFAULT_BUFSIZE):
+        self.input_fd = ensure_fd(input_fd)
+        self.bufsize = bufsize
+        self.queues = collections.OrderedDict(
+            (ensure_fd(output_fd), collections.deque())
+            for output_fd in output_fds)
+        self.use_splice = len(self.queues) == 1 and (
+            _is_fifo(self.input_fd) or _is_fifo(self.queues.keys()[0]))
+        self.ring = URing(_ring_size(len(self.queues)))
+        # user_data -> (kind, fd, chunk) for every operation in flight.
+        self.ops = {}
+        self.writing = set()
+        self.next_id = 0
+        self.exhausted = False
+
+    def _prep(self, kind, fd, chunk=None):
+        self.next_id += 1
+        self.ops[self.next_id] = (kind, fd, chunk)
+        return self.next_id
+
+    def _submit_read(self, retry=False):
+        if retry:
+            self.ring.prep_poll(self.input_fd, POLLIN,
+                                self._prep(self.POLL, self.input_fd),
+                                flags=IOSQE_IO_LINK)
+        if self.use_splice:
+            output_fd = self.queues.keys()[0]
+            if retry:
+                self.ring.prep_poll(output_fd, POLLOUT,
+                                    self._prep(self.POLL, output_fd),
+                                    flags=IOSQE_IO_LINK)
+            self.ring.prep_splice(self.input_fd, output_fd, self.bufsize,
+                                  self._prep(self.SPLICE, output_fd))
+            return
+        chunk = ctypes.create_string_buffer(self.bufsize)
+        self.ring.prep_read(self.input_fd, ctypes.addressof(chunk),
+                            self.bufsize,
+                            self._prep(self.READ, self.input_fd, chunk))
+
+    def _submit_write(self, output_fd, retry=False):
+        chunk, offset, length = self.queues[output_fd][0]
+        if retry:
+            self.ring.prep_poll(output_fd, POLLOUT,
+                                self._prep(self.POLL, output_fd),
+                                flags=IOSQE_IO_LINK)
+        self.ring.prep_write(output_fd, ctypes.addressof(chunk) + offset,
+                             length - offset,
+                             self._prep(self.WRITE, output_fd, chunk))
+        self.writing.add(output_fd)
+
+    def _finish_output(self, output_fd, close=False):
+        del self.queues[output_fd]
+        self.writing.discard(output_fd)
+        if close:
+            close_fd(output_fd)
+
+    def _finish_input(self):
+        self.exhausted = True
+        close_fd(self.input_fd)
+        for output_fd, queue in self.queues.items():
+            if not queue and output_fd not in self.writing:
+                self._finish_output(output_fd, close=True)
+
+    def _on_read(self, chunk, res):
+        if res < 0 and -res in RETRY_ERRNOS:
+            return self._submit_read(retry=True)
+        if res <= 0:
+            return self._finish_input()
+        # No outputs left: stop, but don't close the input.
+        if not self.queues:
+            return
+        for output_fd, queue in self.queues.iteritems():
+            queue.append((chunk, 0, res))
+            if output_fd not in self.writing:
+                self._submit_write(output_fd)
+        self._submit_read()
+
+    def _on_write(self, output_fd, res):
+        self.writing.discard(output_fd)
+        if output_fd not in self.queues:
+            return
+        if res < 0 and -res in RETRY_ERRNOS:
+            return self._submit_write(output_fd, retry=True)
+        if res < 0:
+            return self._finish_output(output_fd)
+        queue = self.queues[output_fd]
+        chunk, offset, length = queue[0]
+        if offset + res < length:
+            queue[0] = (chunk, offset + res, length)
+        else:
+            queue.popleft()
+        if queue:
+            self._submit_write(output_fd)
+        elif self.exhausted:
+            self._finish_output(output_fd, close=True)
+
+    def _on_splice(self, output_fd, res):
+        if res < 0 and -res in RETRY_ERRNOS:
+            return self._submit_read(retry=True)
+        if res > 0:
+            return self._submit_read()
+        if res == 0:
+            self._finish_input()
+        else:
+            self._finish_output(output_fd)
+
+    def start(self):
+        """Run the tee in the current thread, until it's finished."""
+        if self.queues:
+            self._submit_read()
+        while self.ops:
+            self.ring.submit(wait_nr=1)
+            for user_data, res in self.ring.completions():
+                kind, fd, chunk = self.ops.pop(user_data)
+                if kind == self.READ:
+                    self._on_read(chunk, res)
+                elif kind == self.WRITE:
+                    self._on_write(fd, res)
+                elif kind == self.SPLICE:
+                    self._on_splice(fd, res)
+
+    def close(self):
+        self.ring.close()
+
+    @contextmanager
+    def background(self):
+        thread = threading.Thread(target=self.start)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            thread.join()
+            self.close()
@@ -0,0 +1,126 @@
+"""Tests for serving a stream to TCP clients."""
+
+import errno
+import os
+import socket
+import threading
+import time
+
+from nose.tools import assert_raises
+
+from teena import BroadcastServer, Pipe
+from teena.broadcast import LATENCY
+from teena.handle import BACKLOG
+
+
+def wait_for_clients(server, count):
+    deadline = time.time() + 5
+    while len(server.stats.bytes_written) < count:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def receive_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def test_every_client_is_sent_the_stream_and_disconnected_at_the_end():
+    data = os.urandom(1 << 18)
+    with Pipe() as pipe:
+        server = BroadcastServer(pipe.read_fd, policy=LATENCY)
+        handle = server.loop.start_background()
+        clients = [socket.create_connection(server.address)
+                   for _ in xrange(3)]
+        wait_for_clients(server, 3)
+        results = []
+        readers = [threading.Thread(target=lambda client=client:
+                                    results.append(receive_all(client)))
+                   for client in clients]
+        for reader in readers:
+            reader.start()
+        os.write(pipe.write_fd, data)
+        pipe.close_write()
+        for reader in readers:
+            reader.join()
+        assert handle.wait(timeout=5)
+    assert results == [data] * 3
+    assert not server.stats.dropped
+    # Once the stream's over, nobody else can connect.
+    with assert_raises(socket.error):
+        socket.create_connection(server.address)
+    for client in clients:
+        client.close()
+
+
+def test_a_client_which_falls_too_far_behind_is_dropped():
+    data = os.urandom(1 << 23)
+    with Pipe() as pipe:
+        server = BroadcastServer(pipe.read_fd, max_client_backlog=1 << 20)
+        handle = server.loop.start_background()
+        slow = socket.socket()
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.connect(server.address)
+        fast = socket.create_connection(server.address)
+        wait_for_clients(server, 2)
+        results = []
+        reader = threading.Thread(target=lambda:
+                                  results.append(receive_all(fast)))
+        reader.start()
+        os.write(pipe.write_fd, data)
+        pipe.close_write()
+        reader.join()
+        assert handle.wait(timeout=5)
+    assert results == [data]
+    assert server.stats.dropped.values() == [BACKLOG]
+    # Having been dropped, it's been disconnected, once it's been sent what
+    # was already on its way.
+    slow.settimeout(5)
+    assert len(receive_all(slow)) < len(data)
+    slow.close()
+    fast.close()
+
+
+def test_unknown_policies_are_rejected():
+    with Pipe() as pipe:
+        with assert_raises(ValueError):
+            BroadcastServer(pipe.read_fd, policy='fastest')
+
+
+class OutOfFds(object):
+
+    """A listening socket which can't accept anything for a while."""
+
+    def __init__(self, sock, duration):
+        self.sock = sock
+        self.until = time.time() + duration
+        self.failures = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def accept(self):
+        if time.time() < self.until:
+            self.failures += 1
+            raise socket.error(errno.EMFILE, os.strerror(errno.EMFILE))
+        return self.sock.accept()
+
+
+def test_the_server_backs_off_while_it_is_out_of_fds():
+    with Pipe() as pipe:
+        server = BroadcastServer(pipe.read_fd)
+        server.socket = OutOfFds(server.socket, 0.3)
+        handle = server.loop.start_background()
+        client = socket.create_connection(server.address)
+        wait_for_clients(server, 1)
+        # Woken up once per back-off, rather than as fast as it can fail.
+        assert 1 <= server.socket.failures <= 5
+        os.write(pipe.write_fd, 'foo')
+        pipe.close_write()
+        assert receive_all(client) == 'foo'
+        assert handle.wait(timeout=5)
+    client.close()
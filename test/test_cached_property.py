@@ -1,8 +1,11 @@
 import uuid
 
 from nose.tools import assert_raises
+from tornado.ioloop import IOLoop
 
-from teena import cached_property
+from teena import (cached_property, instance_cached_property,
+                   slot_cached_property, expiring_cached_property,
+                   async_cached_property, invalidate)
 
 
 class Counter(object):
@@ -186,3 +189,291 @@ def test_cached_property_does_not_support_objects_without_weakref():
     y = Y()
     y.b = 456
     assert_raises(TypeError, lambda: y.incr_b)
+
+
+class InstanceCounter(object):
+    def __init__(self):
+        self.state = {'value': 0}
+
+    @instance_cached_property
+    def attr(self):
+        self.state['value'] += 1
+        return self.state['value']
+
+
+def test_instance_cached_property_is_stored_in_the_instance_dict():
+    counter = InstanceCounter()
+    assert counter.attr == 1
+    assert counter.__dict__['attr'] == 1
+    assert counter.attr == 1
+    assert counter.state['value'] == 1
+
+
+def test_instance_cached_property_can_be_set_and_deleted():
+    counter = InstanceCounter()
+    counter.attr = 123
+    assert counter.attr == 123
+    assert counter.state['value'] == 0  # Never computed.
+
+    del counter.attr
+    assert counter.attr == 1  # Recomputed.
+    assert counter.state['value'] == 1
+
+
+def test_the_instance_cached_property_descriptor_is_available_on_the_class():
+    assert isinstance(InstanceCounter.attr, instance_cached_property)
+
+
+class SlotCounter(object):
+    __slots__ = ('state', '_cached_attr')
+
+    def __init__(self):
+        self.state = {'value': 0}
+
+    @slot_cached_property
+    def attr(self):
+        self.state['value'] += 1
+        return self.state['value']
+
+
+def test_slot_cached_property_is_stored_in_its_slot():
+    counter = SlotCounter()
+    assert counter.attr == 1
+    assert counter._cached_attr == 1
+    assert counter.attr == 1
+    assert counter.state['value'] == 1
+
+
+def test_slot_cached_property_can_be_set_and_deleted():
+    counter = SlotCounter()
+    counter.attr = 123
+    assert counter.attr == 123
+    assert counter.state['value'] == 0  # Never computed.
+
+    del counter.attr
+    assert counter.attr == 1  # Recomputed.
+    assert counter.state['value'] == 1
+
+    del counter.attr
+    assert_raises(AttributeError, lambda: delattr(counter, 'attr'))
+
+
+class SlotlessCounter(object):
+    __slots__ = ('state',)
+
+    @slot_cached_property
+    def attr(self):
+        return 1
+
+
+def test_slot_cached_property_requires_a_dedicated_slot():
+    assert_raises(TypeError, lambda: SlotlessCounter().attr)
+
+
+def check_locked_cached_property_is_computed_once_across_threads(decorator):
+    import threading
+    import time
+
+    class SlowCounter(object):
+        __slots__ = ('calls', '_cached_attr', '__dict__', '__weakref__')
+
+        def __init__(self):
+            self.calls = 0
+
+        @decorator
+        def attr(self):
+            self.calls += 1
+            time.sleep(0.05)
+            return object()
+
+    counter = SlowCounter()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(counter.attr))
+               for i in xrange(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.calls == 1
+    assert len(results) == 8
+    assert all(result is results[0] for result in results)
+    assert not counter.__class__.__dict__['attr'].in_flight.locks
+
+
+def test_locked_cached_properties_are_computed_once_across_threads():
+    for decorator in (cached_property.locked,
+                      instance_cached_property.locked,
+                      slot_cached_property.locked):
+        yield check_locked_cached_property_is_computed_once_across_threads, decorator
+
+
+class Versioned(object):
+    def __init__(self):
+        self.version = 0
+        self.calls = 0
+
+    @expiring_cached_property(version=lambda self: self.version)
+    def attr(self):
+        self.calls += 1
+        return self.calls
+
+    @expiring_cached_property(ttl=60)
+    def timed(self):
+        self.calls += 1
+        return self.calls
+
+
+def test_expiring_cached_property_is_recomputed_when_the_version_changes():
+    obj = Versioned()
+    assert obj.attr == 1
+    assert obj.attr == 1
+    obj.version += 1
+    assert obj.attr == 2
+    assert obj.attr == 2
+
+
+def test_expiring_cached_property_is_recomputed_after_its_ttl():
+    import time
+    obj = Versioned()
+    assert obj.timed == 1
+    assert obj.timed == 1
+    now = time.time()
+    original_time = time.time
+    time.time = lambda: now + 61
+    try:
+        assert obj.timed == 2
+    finally:
+        time.time = original_time
+
+
+def test_expiring_cached_property_can_be_set_and_deleted():
+    obj = Versioned()
+    obj.attr = 123
+    assert obj.attr == 123
+    assert obj.calls == 0
+    del obj.attr
+    assert obj.attr == 1
+
+
+class Resolver(object):
+    def __init__(self):
+        self.pending = []
+
+    @async_cached_property
+    def address(self, callback):
+        self.pending.append(callback)
+
+
+def test_async_cached_property_shares_one_computation_between_callers():
+    resolver = Resolver()
+    results = []
+    resolver.address(results.append)
+    resolver.address(results.append)
+    assert len(resolver.pending) == 1
+    assert results == []
+
+    resolver.pending[0]('127.0.0.1')
+    assert results == ['127.0.0.1', '127.0.0.1']
+
+    # Now it's cached, callers get the value immediately.
+    resolver.address(results.append)
+    assert results[-1] == '127.0.0.1'
+    assert len(resolver.pending) == 1
+
+
+class FailingResolver(object):
+    def __init__(self):
+        self.calls = 0
+        self.pending = []
+
+    @async_cached_property
+    def address(self, callback):
+        self.calls += 1
+        if self.calls == 1:
+            raise IOError('no route')
+        elif self.calls == 2:
+            self.pending.append(callback)
+        # The third time, the callback is thrown away.
+
+
+def test_async_cached_property_fails_every_caller_and_is_retried():
+    resolver = FailingResolver()
+    errors = []
+    assert_raises(IOError, resolver.address, lambda value: None)
+    resolver.address(lambda value: None, errors.append)
+    resolver.address(lambda value: None, errors.append)
+    assert len(resolver.pending) == 1
+    failure = IOError('timed out')
+    resolver.pending[0](error=failure)
+    assert errors == [failure, failure]
+
+    resolver.address(lambda value: None, errors.append)
+    assert resolver.calls == 3
+    assert isinstance(errors[-1], RuntimeError)
+    # Nothing's left in flight.
+    assert 'address' not in resolver.__dict__
+
+
+def test_async_cached_property_fails_if_a_later_callback_raises():
+    loop = IOLoop()
+
+    class Lookup(object):
+        @async_cached_property
+        def address(self, callback):
+            def finish():
+                raise IOError('no route')
+            loop.add_callback(finish)
+
+    errors = []
+    Lookup().address(lambda value: None, errors.append)
+    loop.add_callback(loop.stop)
+    loop.start()
+    loop.close()
+    assert [str(error) for error in errors] == ['no route']
+
+
+def test_invalidate_an_instance_recomputes_every_cached_property():
+    counter = MultiCounter()
+    assert (counter.foo, counter.bar) == (1, 1)
+    invalidate(counter)
+    assert (counter.foo, counter.bar) == (2, 2)
+    invalidate(counter, 'foo')
+    assert (counter.foo, counter.bar) == (3, 2)
+
+
+def test_invalidate_a_class_recomputes_for_every_instance():
+    counters = [MultiCounter(), MultiCounter()]
+    assert [c.foo for c in counters] == [1, 1]
+    invalidate(MultiCounter)
+    assert [c.foo for c in counters] == [2, 2]
+
+    objs = [Versioned(), Versioned()]
+    assert [o.attr for o in objs] == [1, 1]
+    invalidate(Versioned)
+    assert [o.attr for o in objs] == [2, 2]
+
+    resolver = Resolver()
+    resolver.address(lambda value: None)
+    resolver.pending[0]('127.0.0.1')
+    invalidate(Resolver)
+    resolver.address(lambda value: None)
+    assert len(resolver.pending) == 2
+
+
+def test_invalidate_a_class_is_not_supported_for_instance_properties():
+    assert_raises(TypeError, invalidate, InstanceCounter)
+
+
+class MixedCounter(MultiCounter):
+    @instance_cached_property
+    def baz(self):
+        return object()
+
+
+def test_invalidate_a_class_with_instance_properties_changes_nothing():
+    counter = MixedCounter()
+    assert counter.foo == 1
+    assert_raises(TypeError, invalidate, MixedCounter)
+    assert counter.foo == 1
+    invalidate(MixedCounter, 'foo', 'bar')
+    assert counter.foo == 2
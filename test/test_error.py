@@ -62,3 +62,60 @@ def test_can_check_for_multiple_error_types():
     except OSError:
         success = False
     assert success
+
+
+def test_Error_ETYPE_is_only_created_once():
+    assert Error.EBADF is Error.EBADF
+    assert Error.EBADF is not Error.EPIPE
+
+
+def test_isinstance_checks_the_errno_of_the_instance():
+    exc = OSError(errno.EBADF, os.strerror(errno.EBADF))
+    assert isinstance(exc, Error)
+    assert isinstance(exc, Error.EBADF)
+    assert not isinstance(exc, Error.EPIPE)
+    assert not isinstance(ValueError(), Error)
+
+
+def test_a_matcher_is_not_confused_by_earlier_matches_of_the_same_type():
+    for error_number in (errno.EBADF, errno.EPIPE, errno.EBADF):
+        try:
+            raise OSError(error_number, os.strerror(error_number))
+        except Error.EBADF:
+            assert error_number == errno.EBADF
+        except Error.EPIPE:
+            assert error_number == errno.EPIPE
+
+
+def test_error_categories_match_any_of_their_errors():
+    for error_number in (errno.EPIPE, errno.ECONNRESET, errno.EIO):
+        try:
+            raise OSError(error_number, os.strerror(error_number))
+        except Error.DISCONNECTED:
+            pass
+    for error_number in (errno.EAGAIN, errno.EINTR):
+        assert isinstance(OSError(error_number, ''), Error.TRANSIENT)
+    assert isinstance(OSError(errno.EAGAIN, ''), Error.WOULD_BLOCK)
+    assert not isinstance(OSError(errno.EINTR, ''), Error.WOULD_BLOCK)
+    assert isinstance(OSError(errno.EBADF, ''), Error.BAD_FD)
+
+
+def test_error_categories_do_not_match_other_errors():
+    success = False
+    try:
+        raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+    except Error.DISCONNECTED:
+        success = False
+    except OSError:
+        success = True
+    assert success
+
+
+def test_can_define_custom_error_categories():
+    category = Error.category('MISSING', 'ENOENT', errno.ENOTDIR, 'ENOTANERROR')
+    assert Error.MISSING is category
+    assert category.match_errnos == frozenset([errno.ENOENT, errno.ENOTDIR])
+    try:
+        os.stat('/this/path/does/not/exist')
+    except Error.MISSING:
+        pass
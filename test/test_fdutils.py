@@ -0,0 +1,112 @@
+"""Tests for classifying file descriptors."""
+
+import os
+import socket
+import tempfile
+
+from teena import Pipe, fdutils
+from teena.fdutils import (FILE, PIPE, SOCKET, READ_WRITE, SENDFILE, SPLICE,
+                           WRITE, FdSet, classify, close_fd, close_fds,
+                           is_packet, transfer_strategy)
+from teena.thread_loop import ThreadLoop
+
+
+def test_classify_tells_pipes_sockets_and_files_apart():
+    sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    with Pipe() as pipe, tempfile.TemporaryFile() as temp:
+        assert classify(pipe.read_fd) == (PIPE, None)
+        assert classify(sock_a.fileno()) == (SOCKET, socket.SOCK_DGRAM)
+        assert classify(temp.fileno()).kind == FILE
+        assert classify(pipe.write_fd).pollable
+        assert not classify(temp.fileno()).pollable
+    sock_a.close()
+    sock_b.close()
+
+
+def test_is_packet_for_datagram_sockets_and_packet_pipes():
+    dgram_a, dgram_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stream_a, stream_b = socket.socketpair()
+    with Pipe() as pipe, Pipe(direct=True) as packet_pipe:
+        assert is_packet(dgram_a.fileno())
+        assert is_packet(packet_pipe.write_fd)
+        assert not is_packet(stream_a.fileno())
+        assert not is_packet(pipe.write_fd)
+    for sock in (dgram_a, dgram_b, stream_a, stream_b):
+        fdutils.forget_fd(sock.fileno())
+        sock.close()
+
+
+def test_classifications_are_cached_until_the_fd_is_closed():
+    read_fd, write_fd = os.pipe()
+    info = classify(read_fd)
+    assert classify(read_fd) is info
+    close_fd(read_fd)
+    close_fd(write_fd)
+    assert read_fd not in fdutils._classified
+
+
+def test_closing_a_pipe_forgets_its_classification():
+    with Pipe() as pipe:
+        classify(pipe.read_fd)
+    assert pipe.read_fd not in fdutils._classified
+
+
+def test_transfer_strategy():
+    sock_a, sock_b = socket.socketpair()
+    with Pipe() as pipe, tempfile.TemporaryFile() as temp:
+        assert transfer_strategy(pipe.read_fd, sock_a.fileno()) == SPLICE
+        assert transfer_strategy(temp.fileno(), pipe.write_fd) == SPLICE
+        assert transfer_strategy(temp.fileno(), sock_a.fileno()) == SENDFILE
+        assert transfer_strategy(sock_a.fileno(), temp.fileno()) == WRITE
+        assert transfer_strategy(sock_a.fileno(), sock_b.fileno()) == READ_WRITE
+    sock_a.close()
+    sock_b.close()
+
+
+def fd_is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+def test_close_fds_closes_runs_of_fds_but_not_ttys():
+    pipes = [os.pipe() for _ in xrange(4)]
+    fds = [fd for pair in pipes for fd in pair]
+    master, slave = os.openpty()
+    os.close(fds[3])  # Already closed fds are ignored.
+    close_fds(fds + [slave])
+    assert not any(fd_is_open(fd) for fd in fds)
+    assert fd_is_open(slave)
+    os.close(master)
+    os.close(slave)
+
+
+def test_an_fd_reused_after_a_tty_is_still_closed():
+    for close in (close_fd, lambda fd: close_fds([fd])):
+        master, slave = os.openpty()
+        classify(slave)
+        # Closed behind the cache's back, and the number reused.
+        os.close(slave)
+        read_fd, write_fd = os.pipe()
+        assert slave in (read_fd, write_fd)
+        close(slave)
+        assert not fd_is_open(slave)
+        for fd in (master, read_fd, write_fd):
+            if fd != slave:
+                os.close(fd)
+
+
+def test_fd_set_deregisters_and_closes_fds_in_bulk():
+    loop = ThreadLoop()
+    pipes = [Pipe() for _ in xrange(3)]
+    fds = FdSet(pipe.write_fd for pipe in pipes)
+    for fd in fds:
+        loop.add_handler(fd, lambda fd, events: None, loop.WRITE)
+    fds.deregister(loop)
+    assert not set(loop._handlers) & fds
+    fds.close()
+    assert not fds
+    assert all(pipe.write_closed for pipe in pipes)
+    loop.close()
@@ -0,0 +1,69 @@
+"""Tests for running tees in the background, through handles."""
+
+from contextlib import nested
+import os
+import time
+
+from teena import Pipe, as_completed, tee
+from teena.handle import CANCELLED, HANGUP
+
+
+def test_a_handle_waits_for_a_tee_and_reports_its_stats():
+    with nested(Pipe(), Pipe(), Pipe()) as (p1, p2, p3):
+        # An output whose reader has gone is dropped as soon as it starts.
+        p3.close_read()
+        handle = tee(p1.read_fd, (p2.write_fd, p3.write_fd)).start_background()
+        os.write(p1.write_fd, 'foobar')
+        p1.close_write()
+        assert handle.wait(timeout=5)
+        assert os.read(p2.read_fd, 6) == 'foobar'
+    assert handle.done() and not handle.cancelled()
+    assert handle.exception() is None
+    assert handle.stats.bytes_read == 6
+    assert handle.stats.bytes_written == {p2.write_fd: 6, p3.write_fd: 0}
+    assert handle.stats.dropped == {p3.write_fd: HANGUP}
+
+
+def test_a_cancelled_tee_drops_and_closes_everything():
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        handle = tee(p1.read_fd, (p2.write_fd,)).start_background()
+        assert not handle.wait(timeout=0.05)
+        assert handle.cancel()
+        assert handle.wait(timeout=5)
+        assert handle.cancelled()
+        assert not handle.cancel()
+        assert handle.stats.dropped == {p2.write_fd: CANCELLED}
+        # Both ends the tee had have been closed.
+        assert os.read(p2.read_fd, 1) == ''
+        p1.close_write()
+
+
+def test_done_callbacks_are_called_with_the_handle():
+    called = []
+    with Pipe() as p1:
+        handle = tee(p1.read_fd, ()).start_background()
+        handle.add_done_callback(called.append)
+        p1.close_write()
+        handle.wait(timeout=5)
+    handle.add_done_callback(called.append)
+    assert called == [handle, handle]
+
+
+def test_as_completed_yields_handles_as_they_finish():
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        first = tee(p1.read_fd, ()).start_background()
+        second = tee(p2.read_fd, ()).start_background()
+        p2.close_write()
+        completed = as_completed([first, second])
+        assert completed.next() is second
+        p1.close_write()
+        assert completed.next() is first
+
+
+def test_a_waiting_loop_does_not_spin():
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        with tee(p1.read_fd, (p2.write_fd,)).background():
+            start = sum(os.times()[:2])
+            time.sleep(0.2)
+            assert sum(os.times()[:2]) - start < 0.1
+            p1.close_write()
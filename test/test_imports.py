@@ -0,0 +1,54 @@
+"""Tests that teena's public names are only imported when they're used."""
+
+import os
+import subprocess
+import sys
+
+import teena
+
+
+def modules_loaded_by(statement):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Python 2 leaves None in sys.modules for failed implicit relative
+    # imports, such as 'teena.sys'.
+    script = statement + ('\nimport sys\n'
+                          'print " ".join(name for name, module '
+                          'in sys.modules.items() if module)')
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     env=dict(os.environ, PYTHONPATH=root))
+    return set(output.split())
+
+
+def test_importing_teena_imports_none_of_its_submodules():
+    loaded = modules_loaded_by('import teena')
+    assert not [name for name in loaded if name.startswith('teena.')]
+    assert 'tornado' not in loaded
+    assert 'threading' not in loaded
+
+
+def test_error_and_pipe_do_not_need_tornado():
+    loaded = modules_loaded_by('from teena import Error, Pipe')
+    assert 'teena.pipe' in loaded
+    assert 'tornado' not in loaded
+
+
+def test_names_shared_with_submodules_are_what_they_export():
+    import teena.tee
+    import teena.splice
+    from teena.cached_property import CachedProperty
+    assert teena.tee is sys.modules['teena.tee'].tee
+    assert teena.splice is sys.modules['teena.splice'].splice
+    assert teena.cached_property is CachedProperty
+
+
+def test_submodules_can_be_got_at_as_attributes():
+    loaded = modules_loaded_by('import teena\n'
+                               'teena.pipe.Pipe, teena.error.Error\n'
+                               'teena.thread_loop.ThreadLoop')
+    assert 'teena.thread_loop' in loaded
+    assert teena.fdutils is sys.modules['teena.fdutils']
+
+
+def test_unknown_names_raise_AttributeError():
+    assert not hasattr(teena, 'nonexistent')
+    assert set(teena.__all__) <= set(dir(teena))
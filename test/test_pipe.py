@@ -125,3 +125,176 @@ def test_if_both_pipes_raise_errors_on_closing_the_write_pipes_error_is_returned
     with assert_raises(Exception) as cm:
         pipe.close()
     assert cm.exception.args == ("BAR",)
+
+
+## Flags and capacity
+
+def test_pipe_can_be_created_close_on_exec():
+    import fcntl
+    with Pipe(cloexec=True) as pipe:
+        for fd in (pipe.read_fd, pipe.write_fd):
+            assert fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC
+    with Pipe() as inheritable_pipe:
+        assert not (fcntl.fcntl(inheritable_pipe.read_fd, fcntl.F_GETFD) &
+                    fcntl.FD_CLOEXEC)
+
+
+def test_non_blocking_pipes_are_non_blocking_at_both_ends():
+    import fcntl
+    with Pipe(non_blocking=True, cloexec=True) as pipe:
+        for fd in (pipe.read_fd, pipe.write_fd):
+            assert fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK
+
+
+def test_packet_mode_pipes_preserve_write_boundaries():
+    with Pipe(direct=True) as pipe:
+        os.write(pipe.write_fd, 'foo')
+        os.write(pipe.write_fd, 'bar')
+        assert os.read(pipe.read_fd, 4096) == 'foo'
+        assert os.read(pipe.read_fd, 4096) == 'bar'
+
+
+def test_pipe_capacity_can_be_read_and_changed():
+    with Pipe(capacity=1 << 20) as pipe:
+        assert pipe.capacity == 1 << 20
+        pipe.capacity = 1 << 16
+        assert pipe.capacity == 1 << 16
+        pipe.close_write()
+        assert pipe.capacity == 1 << 16
+
+
+def test_a_pipe_is_only_closed_once_by_its_owner():
+    pipe = Pipe()
+    read_fd = pipe.read_fd
+    pipe.close()
+    # Something else gets the same fd number...
+    other = Pipe()
+    assert other.read_fd == read_fd
+    # ...and closing the first pipe again leaves it alone.
+    pipe.close()
+    os.fstat(other.read_fd)
+    other.close()
+
+
+## Pooling
+
+from teena.pipe import PipePool
+
+
+def test_pipe_pool_reuses_released_pipes():
+    with PipePool() as pool:
+        pipe = pool.acquire()
+        pool.release(pipe)
+        assert len(pool) == 1
+        assert pool.acquire() is pipe
+        assert len(pool) == 0
+        pool.release(pipe)
+
+
+def test_pipe_pool_hands_out_non_blocking_pipes_of_the_requested_capacity():
+    import fcntl
+    with PipePool(capacity=1 << 18) as pool:
+        with pool.pipe() as pipe:
+            assert pipe.capacity == 1 << 18
+            assert fcntl.fcntl(pipe.read_fd, fcntl.F_GETFL) & os.O_NONBLOCK
+
+
+def test_pipe_pool_closes_pipes_with_leftover_data():
+    with PipePool() as pool:
+        with pool.pipe() as pipe:
+            os.write(pipe.write_fd, 'leftover')
+        assert len(pool) == 0
+        ensure_pipe_closed(pipe)
+
+
+def test_pipe_pool_closes_pipes_with_a_closed_end():
+    with PipePool() as pool:
+        with pool.pipe() as pipe:
+            pipe.close_write()
+        assert len(pool) == 0
+        ensure_fd_closed(pipe.read_fd)
+
+
+def test_pipe_pool_limits_the_number_of_idle_pipes():
+    with PipePool(max_idle=2) as pool:
+        pipes = [pool.acquire() for i in xrange(3)]
+        for pipe in pipes:
+            pool.release(pipe)
+        assert len(pool) == 2
+        ensure_pipe_closed(pipes[-1])
+
+
+def test_pipe_pool_closes_idle_pipes_after_a_timeout():
+    with PipePool(idle_timeout=0) as pool:
+        pipe = pool.acquire()
+        pool.release(pipe)
+        assert pool.acquire() is not pipe
+        ensure_pipe_closed(pipe)
+
+
+## Buffer I/O
+
+def test_pipe_can_read_into_and_write_from_buffers():
+    with Pipe() as pipe:
+        assert pipe.write(memoryview('foobar')[:3]) == (3, 0)
+        assert pipe.writev(['bar', bytearray('baz')]) == (6, 0)
+        buf = bytearray(6)
+        assert pipe.readinto(buf) == (6, 0)
+        assert buf == 'foobar'
+        assert pipe.read_available() == ('baz', 0)
+
+
+def test_read_available_reads_everything_in_one_go():
+    with Pipe(buffering=4) as pipe:
+        pipe.write('x' * 10000)
+        assert pipe.read_available() == ('x' * 10000, 0)
+
+
+def test_read_available_reports_EAGAIN_on_an_empty_non_blocking_pipe():
+    with Pipe(non_blocking=True) as pipe:
+        assert pipe.read_available() == ('', errno.EAGAIN)
+
+
+def test_pipe_buffering_is_used_for_its_file_objects():
+    with Pipe(buffering=0) as pipe:
+        pipe.write_file.write('unbuffered')
+        assert os.read(pipe.read_fd, 4096) == 'unbuffered'
+
+
+## vmsplice
+
+def test_vmspliced_buffers_are_pinned_until_read():
+    with Pipe() as pipe:
+        first, second = bytearray('foo'), bytearray('barbaz')
+        assert pipe.vmsplice([first, second]) == (9, 0)
+        assert pipe.pinned == 2
+        assert_raises(BufferError, first.extend, 'x')
+
+        assert os.read(pipe.read_fd, 4) == 'foob'
+        pipe.release_consumed()
+        assert pipe.pinned == 1
+        first.extend('x')  # No longer pinned, so it can be resized.
+
+        assert os.read(pipe.read_fd, 5) == 'arbaz'
+        pipe.release_consumed()
+        assert pipe.pinned == 0
+
+
+def test_vmsplice_into_a_full_pipe_pins_only_what_was_written():
+    with Pipe(non_blocking=True) as pipe:
+        data = bytearray(pipe.capacity)
+        n, err = pipe.vmsplice([data, bytearray('more')])
+        # An unaligned buffer may need one page more than the pipe holds.
+        assert 0 < n <= len(data) and err == 0
+        assert pipe.pinned == 1
+        assert pipe.vmsplice('again') == (0, errno.EAGAIN)
+        assert pipe.pinned == 1
+
+
+def test_closing_a_pipe_releases_vmspliced_buffers():
+    pipe = Pipe()
+    data = bytearray('foo')
+    pipe.vmsplice(data)
+    pipe.close()
+    assert pipe.pinned == 0
+    data.extend('bar')
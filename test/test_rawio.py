@@ -0,0 +1,114 @@
+import errno
+import os
+import socket
+import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises
+
+from teena import rawio
+from teena.pipe import Pipe
+
+
+def test_read_returns_EAGAIN_instead_of_raising():
+    with Pipe(non_blocking=True) as pipe:
+        assert rawio.read(pipe.read_fd, 4096) == ('', errno.EAGAIN)
+
+
+def test_read_and_write_return_data_and_byte_counts():
+    with Pipe() as pipe:
+        assert rawio.write(pipe.write_fd, 'hello') == (5, 0)
+        assert rawio.write(pipe.write_fd, 'hello', offset=3) == (2, 0)
+        assert rawio.read(pipe.read_fd, 4096) == ('hellolo', 0)
+        pipe.close_write()
+        assert rawio.read(pipe.read_fd, 4096) == ('', 0)
+
+
+def test_readinto_fills_a_writable_buffer():
+    with Pipe() as pipe:
+        os.write(pipe.write_fd, 'hello')
+        buf = bytearray(16)
+        assert rawio.readinto(pipe.read_fd, buf) == (5, 0)
+        assert buf[:5] == 'hello'
+
+
+def test_writev_writes_every_buffer():
+    with Pipe() as pipe:
+        buffers = ['foo', bytearray('bar'), memoryview('baz')]
+        assert rawio.writev(pipe.write_fd, buffers) == (9, 0)
+        assert os.read(pipe.read_fd, 4096) == 'foobarbaz'
+
+
+def test_write_to_a_closed_pipe_returns_EPIPE():
+    with Pipe() as pipe:
+        pipe.close_read()
+        assert rawio.write(pipe.write_fd, 'hello') == (0, errno.EPIPE)
+
+
+def test_unexpected_errors_are_raised():
+    directory_fd = os.open('/', os.O_RDONLY)
+    try:
+        with assert_raises(OSError) as cm:
+            rawio.read(directory_fd, 4096)
+        assert cm.exception.errno == errno.EISDIR
+    finally:
+        os.close(directory_fd)
+
+
+def test_sendmmsg_sends_each_buffer_as_a_message():
+    sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        messages = ['foo', bytearray('ba'), memoryview('r')]
+        assert rawio.sendmmsg(sock_a.fileno(), messages) == (3, 0)
+        assert [sock_b.recv(4096) for _ in messages] == ['foo', 'ba', 'r']
+    finally:
+        sock_a.close()
+        sock_b.close()
+
+
+def test_sendmsg_sends_several_buffers():
+    sock_a, sock_b = socket.socketpair()
+    try:
+        assert rawio.sendmsg(sock_a.fileno(), ['foo', bytearray('bar')]) == \
+            (6, 0)
+        assert sock_b.recv(4096) == 'foobar'
+    finally:
+        sock_a.close()
+        sock_b.close()
+
+
+def tcp_pair():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def test_zerocopy_sends_are_reported_complete():
+    client, server = tcp_pair()
+    try:
+        try:
+            client.setsockopt(socket.SOL_SOCKET, rawio.SO_ZEROCOPY, 1)
+        except socket.error:
+            raise SkipTest("MSG_ZEROCOPY isn't supported here")
+        data = 'x' * 65536
+        flags = rawio.MSG_NOSIGNAL | rawio.MSG_ZEROCOPY
+        for _ in xrange(2):
+            assert rawio.sendmsg(client.fileno(), [data], flags) == (65536, 0)
+        received = 0
+        while received < 2 * 65536:
+            received += len(server.recv(65536))
+        completed = []
+        deadline = time.time() + 5
+        while not completed or completed[-1][1] < 1:
+            assert time.time() < deadline
+            ranges, err = rawio.zerocopy_completions(client.fileno())
+            assert not err
+            completed.extend(ranges)
+        assert completed[0][0] == 0
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,114 @@
+"""Tests for the segmented replay log."""
+
+from contextlib import nested
+import os
+import shutil
+import tempfile
+
+from teena import LogReader, Pipe, ReplayLog, tee
+
+
+def setup_module():
+    global directory
+    directory = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(directory)
+
+
+def new_log(**kwargs):
+    path = tempfile.mkdtemp(dir=directory)
+    return path, ReplayLog(path, **kwargs)
+
+
+def test_records_can_be_read_back_from_any_record_or_byte_offset():
+    path, log = new_log(segment_size=10)
+    log.append(['foo', 'barbaz', 'qux'])
+    log.append(['quux'])
+    # Four records, over two segments.
+    assert sorted(os.listdir(path))[::2] == ['%020d.index' % 0,
+                                             '%020d.index' % 9]
+
+    reader = LogReader(path, record=2)
+    assert reader.read_record().tobytes() == 'qux'
+    assert reader.read_record().tobytes() == 'quux'
+    assert reader.read_record() is None
+
+    reader = LogReader(path, offset=5)
+    assert reader.record == 1
+    assert reader.read_record().tobytes() == 'rbaz'
+    # Byte reads stop at the end of a segment, not of a record.
+    assert reader.read(100).tobytes() == 'quxquux'
+    assert reader.read(100).tobytes() == ''
+
+
+def test_a_reader_picks_up_records_written_after_it_started():
+    path, log = new_log(segment_size=10)
+    reader = log.reader()
+    assert reader.read_record() is None
+    log.append(['hello'])
+    assert reader.read_record().tobytes() == 'hello'
+    log.append(['world!'])
+    assert reader.read_record().tobytes() == 'world!'
+
+
+def test_old_segments_are_deleted_past_the_retention_size():
+    path, log = new_log(segment_size=10, retention_bytes=25)
+    for i in xrange(10):
+        log.append(['%010d' % i])
+    reader = LogReader(path, record=0)
+    # The oldest record left is the first of the oldest segment kept.
+    assert reader.read_record().tobytes() == '%010d' % 7
+
+
+def test_a_log_is_carried_on_with_when_reopened():
+    path, log = new_log()
+    log.append(['first'])
+    log.close()
+    log = ReplayLog(path)
+    log.append(['second'])
+    reader = LogReader(path, record=1)
+    assert reader.read_record().tobytes() == 'second'
+
+
+def test_a_log_can_be_sent_to_an_fd():
+    path, log = new_log()
+    log.append(['hello ', 'world'])
+    reader = LogReader(path, offset=6)
+    with Pipe() as pipe:
+        assert reader.send_to(pipe.write_fd, 100) == (5, 0)
+        assert os.read(pipe.read_fd, 100) == 'world'
+
+
+def test_tee_can_write_to_a_replay_log():
+    path, log = new_log()
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        with tee(p1.read_fd, (p2.write_fd, log)).background():
+            os.write(p1.write_fd, 'live')
+            assert os.read(p2.read_fd, 4) == 'live'
+            p1.close_write()
+    assert log.log_fd is None
+    assert LogReader(path).read(100).tobytes() == 'live'
+
+
+def test_a_segment_without_an_index_header_has_no_records():
+    path, log = new_log()
+    log.append(['foo'])
+    log.close()
+    # As if the writer had stopped half-way through starting a segment.
+    open(os.path.join(path, '%020d.index' % 3), 'w').close()
+    open(os.path.join(path, '%020d.log' % 3), 'w').close()
+    reader = LogReader(path, record=5)
+    assert reader.record == 1
+    assert reader.read_record() is None
+    reader.seek(0)
+    assert reader.read_record().tobytes() == 'foo'
+    reader.close()
+    # A writer carries on from the last segment which was started properly.
+    log = ReplayLog(path)
+    log.append(['bar'])
+    log.close()
+    reader = LogReader(path, record=1)
+    assert reader.read_record().tobytes() == 'bar'
+    reader.close()
@@ -0,0 +1,155 @@
+"""Tests for fanning a stream out through a shared-memory ring."""
+
+import hashlib
+import os
+import threading
+
+from teena import Pipe, SharedRing, ring_tee
+
+
+def consume(consumer, results):
+    digest = hashlib.md5()
+    for view in consumer:
+        digest.update(view.tobytes())
+    results[consumer.index] = digest.hexdigest()
+
+
+def test_ring_tee_feeds_every_consumer_in_threads():
+    data = os.urandom(50000)
+    ring = SharedRing(consumers=3, capacity=4096)
+    results = {}
+    threads = [threading.Thread(target=consume, args=(consumer, results))
+               for consumer in ring.consumers]
+    for thread in threads:
+        thread.start()
+    with Pipe() as pipe:
+        with ring_tee(pipe.read_fd, ring, bufsize=1000).background():
+            os.write(pipe.write_fd, data)
+            pipe.close_write()
+        for thread in threads:
+            thread.join()
+    # A small ring, and odd-sized reads, mean plenty of wrapping around.
+    assert results == dict.fromkeys(range(3), hashlib.md5(data).hexdigest())
+    ring.close()
+
+
+def test_ring_tee_feeds_forked_consumers():
+    data = os.urandom(200000)
+    ring = SharedRing(consumers=2, capacity=16384)
+    children = []
+    for consumer in ring.consumers:
+        results = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                digest = hashlib.md5()
+                for view in consumer:
+                    digest.update(view.tobytes())
+                os.write(results.write_fd, digest.hexdigest())
+            finally:
+                os._exit(0)
+        consumer.detach()
+        children.append((pid, results))
+
+    with Pipe() as pipe:
+        with ring_tee(pipe.read_fd, ring, bufsize=4096).background():
+            os.write(pipe.write_fd, data)
+            pipe.close_write()
+    for pid, results in children:
+        os.waitpid(pid, 0)
+        assert os.read(results.read_fd, 32) == hashlib.md5(data).hexdigest()
+        results.close()
+    ring.close()
+
+
+def test_a_consumer_whose_process_has_gone_is_dropped():
+    ring = SharedRing(consumers=2, capacity=4096)
+    gone, alive = ring.consumers
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    gone.detach()
+    os.waitpid(pid, 0)
+
+    data = os.urandom(20000)
+    results = {}
+    thread = threading.Thread(target=consume, args=(alive, results))
+    thread.start()
+    with Pipe() as pipe:
+        with ring_tee(pipe.read_fd, ring).background():
+            os.write(pipe.write_fd, data)
+            pipe.close_write()
+        thread.join()
+    assert results == {1: hashlib.md5(data).hexdigest()}
+    ring.close()
+
+
+def test_a_forked_consumer_which_goes_is_dropped_while_others_read():
+    data = os.urandom(20000)
+    ring = SharedRing(consumers=2, capacity=4096)
+    reading, going = ring.consumers
+    results = Pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            digest = hashlib.md5()
+            for view in reading:
+                digest.update(view.tobytes())
+            os.write(results.write_fd, digest.hexdigest())
+        finally:
+            os._exit(0)
+    reading.detach()
+    # The first consumer's process has a copy of this one's end of its
+    # pipe, too.
+    going_pid = os.fork()
+    if going_pid == 0:
+        os._exit(0)
+    going.detach()
+
+    with Pipe() as pipe:
+        handle = ring_tee(pipe.read_fd, ring).start_background()
+        os.write(pipe.write_fd, data)
+        pipe.close_write()
+        finished = handle.wait(timeout=5)
+        if not finished:
+            handle.cancel()
+            handle.wait()
+    # Closed before the children are waited for, so the one that's reading
+    # finishes even if the tee didn't.
+    ring.close()
+    os.waitpid(going_pid, 0)
+    os.waitpid(pid, 0)
+    assert finished
+    assert os.read(results.read_fd, 32) == hashlib.md5(data).hexdigest()
+    results.close()
+
+
+def test_a_consumer_which_goes_while_the_ring_is_full_is_dropped():
+    ring = SharedRing(consumers=2, capacity=4096)
+    going, alive = ring.consumers
+    with Pipe() as go:
+        pid = os.fork()
+        if pid == 0:
+            # Never reads anything, and leaves when it's told to.
+            go.close_write()
+            os.read(go.read_fd, 1)
+            os._exit(0)
+        going.detach()
+
+        data = os.urandom(20000)
+        results = {}
+        thread = threading.Thread(target=consume, args=(alive, results))
+        thread.daemon = True
+        thread.start()
+        with Pipe() as pipe:
+            handle = ring_tee(pipe.read_fd, ring).start_background()
+            os.write(pipe.write_fd, data)
+            pipe.close_write()
+            # The ring fills up, waiting for the consumer which isn't reading.
+            assert not handle.wait(timeout=0.1)
+            go.close_write()
+            os.waitpid(pid, 0)
+            assert handle.wait(timeout=5)
+        thread.join()
+    assert results == {1: hashlib.md5(data).hexdigest()}
+    ring.close()
@@ -0,0 +1,28 @@
+"""Tests for the token buckets which limit how fast outputs are written."""
+
+from nose.tools import assert_raises
+
+from teena.shaping import MIN_BURST, TokenBucket
+
+
+def test_a_bucket_starts_full_and_is_emptied_by_writes():
+    bucket = TokenBucket(1000, burst=100)
+    assert bucket.available() == 100
+    bucket.consume(60)
+    assert bucket.available() in (40, 41)
+    bucket.consume(100)
+    assert bucket.available() == 0
+    # It's in debt, and has to pay that back before there's any more.
+    assert 0.06 <= bucket.delay(10) <= 0.08
+
+
+def test_a_bucket_waits_for_a_burst_at_most():
+    bucket = TokenBucket(1000, burst=100)
+    bucket.consume(100)
+    assert 0.09 <= bucket.delay(1 << 20) <= 0.1
+
+
+def test_a_bucket_has_a_sensible_burst_by_default():
+    assert TokenBucket(1 << 20).burst == (1 << 20) // 10
+    assert TokenBucket(1).burst == MIN_BURST
+    assert_raises(ValueError, TokenBucket, 0)
@@ -0,0 +1,71 @@
+"""Tests for spilling a backlog to a temporary file."""
+
+import os
+
+from teena import Pipe, rawio
+from teena.spill import SpillFile
+
+
+def test_spill_file_is_read_from_the_front():
+    spill = SpillFile()
+    spill.append(['foo', 'bar'])
+    spill.append(['baz'])
+    assert len(spill) == 9
+    assert spill.view(4).tobytes() == 'foob'
+    spill.consume(4)
+    assert spill.view(100).tobytes() == 'arbaz'
+    spill.close()
+
+
+def test_spill_file_is_mapped_once_for_many_views():
+    maps = []
+    def map_view(*args):
+        maps.append(args)
+        return real_map_view(*args)
+    real_map_view, rawio.map_view = rawio.map_view, map_view
+    try:
+        spill = SpillFile()
+        spill.append(['foo', 'bar', 'baz'])
+        assert spill.view(3).tobytes() == 'foo'
+        spill.consume(3)
+        assert spill.view(3).tobytes() == 'bar'
+        spill.consume(3)
+        spill.append(['qux'])
+        # It's grown past the mapping.
+        assert spill.view(6).tobytes() == 'bazqux'
+        spill.close()
+    finally:
+        rawio.map_view = real_map_view
+    assert len(maps) == 2
+
+
+def test_spill_file_is_truncated_once_it_has_been_consumed():
+    spill = SpillFile()
+    spill.append(['x' * 10000])
+    spill.consume(10000)
+    assert len(spill) == 0
+    assert os.fstat(spill.fd).st_size == 0
+    spill.append(['again'])
+    assert spill.view(5).tobytes() == 'again'
+    assert os.fstat(spill.fd).st_size == 5
+    spill.close()
+
+
+def test_spill_file_can_be_sent_to_a_pipe():
+    spill = SpillFile()
+    spill.append(['hello ', 'world'])
+    spill.consume(6)
+    with Pipe() as pipe:
+        assert spill.send_to(pipe.write_fd, 100) == (5, 0)
+        assert os.read(pipe.read_fd, 100) == 'world'
+    spill.close()
+
+
+def test_consumed_data_are_punched_out_of_the_file():
+    spill = SpillFile()
+    data = os.urandom(3 << 20)
+    spill.append([data])
+    spill.consume(2 << 20)
+    assert spill.punched == 2 << 20 or not spill.can_punch
+    assert spill.view(1 << 20).tobytes() == data[2 << 20:]
+    spill.close()
@@ -1,11 +1,25 @@
 """Tests for async-I/O file descriptor tee-ing."""
 
 from contextlib import nested
+from functools import partial
+import errno
+import fcntl
 import os
+import select
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-from teena import Pipe, tee
+from nose.plugins.skip import SkipTest
+
+from teena import Pipe, rawio, splice, tee
+from teena.fdutils import FILE, classify
+from teena.handle import CANCELLED
+from teena.shaping import TokenBucket
+from teena.spill import SpillFile
 
 
 def test_can_tee_to_two_pipes():
@@ -58,3 +72,559 @@ def test_when_input_is_closed_reading_any_output_gives_empty_string():
             assert os.read(p3.read_fd, 4096) == ''
         assert p2.write_closed
         assert p3.write_closed
+
+
+def test_outputs_are_only_registered_with_the_loop_once():
+    from teena.thread_loop import ThreadLoop
+
+    registrations = []
+    updates = []
+    original_add_handler = ThreadLoop.add_handler
+    original_update_handler = ThreadLoop.update_handler
+    def add_handler(self, fd, handler, events):
+        registrations.append(fd)
+        return original_add_handler(self, fd, handler, events)
+    def update_handler(self, fd, events):
+        updates.append(fd)
+        return original_update_handler(self, fd, events)
+
+    ThreadLoop.add_handler = add_handler
+    ThreadLoop.update_handler = update_handler
+    try:
+        with nested(Pipe(), Pipe(), Pipe()) as (p1, p2, p3):
+            # One output which can block, and one which can't.
+            fcntl.fcntl(p3.write_fd, fcntl.F_SETFL,
+                        fcntl.fcntl(p3.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            with tee(p1.read_fd, (p2.write_fd, p3.write_fd)).background():
+                for i in xrange(20):
+                    os.write(p1.write_fd, 'chunk')
+                    assert os.read(p2.read_fd, 5) == 'chunk'
+                    assert os.read(p3.read_fd, 5) == 'chunk'
+                p1.close_write()
+    finally:
+        ThreadLoop.add_handler = original_add_handler
+        ThreadLoop.update_handler = original_update_handler
+    for fd in (p1.read_fd, p2.write_fd, p3.write_fd):
+        assert registrations.count(fd) == 1
+    # Outputs which keep up are written as each chunk is read, without ever
+    # being polled for WRITE events.
+    assert updates == []
+
+
+def test_tee_drains_a_non_blocking_input():
+    # The number of reads of the input made on each wakeup.
+    reads = []
+    def read(fd, size):
+        if fd == p1.read_fd:
+            reads[-1] += 1
+        return real_read(fd, size)
+    def reader(fd, events):
+        reads.append(0)
+        real_reader(fd, events)
+
+    with nested(Pipe(non_blocking=True), Pipe(), Pipe()) as (p1, p2, p3):
+        data = 'x' * 10000
+        os.write(p1.write_fd, data)
+        p1.close_write()
+        loop = tee(p1.read_fd, (p2.write_fd, p3.write_fd), bufsize=1024,
+                   reads_per_wakeup=4)
+        real_reader = loop._handlers[p1.read_fd]
+        loop._handlers[p1.read_fd] = reader
+        real_read, rawio.read = rawio.read, read
+        try:
+            with loop.background():
+                pass
+        finally:
+            rawio.read = real_read
+        assert os.read(p2.read_fd, 20000) == data
+        assert os.read(p3.read_fd, 20000) == data
+    # Up to four reads a wakeup, until a short read; and then the hangup,
+    # which needs no read.
+    assert reads == [4, 4, 2, 0]
+
+
+def test_tee_writes_regular_file_outputs_directly():
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        temp_fd, temp_path = tempfile.mkstemp()
+        try:
+            with tee(p1.read_fd, (temp_fd, p2.write_fd)).background():
+                os.write(p1.write_fd, 'foobar')
+                p1.close_write()
+                assert os.read(p2.read_fd, 6) == 'foobar'
+            with open(temp_path) as temp:
+                assert temp.read() == 'foobar'
+        finally:
+            os.unlink(temp_path)
+
+
+## splice()
+
+def check_splice_copies(make_input, make_output):
+    data = os.urandom(100000)
+    input_fd, feed = make_input(data)
+    output_fd, collect = make_output()
+    with splice(input_fd, output_fd, bufsize=16384).background():
+        feed()
+        received = collect()
+    assert received == data
+
+
+def pipe_input(data):
+    pipe = Pipe()
+    def feed():
+        os.write(pipe.write_fd, data)
+        pipe.close_write()
+    return pipe.read_fd, feed
+
+
+def file_input(data):
+    temp = tempfile.TemporaryFile()
+    temp.write(data)
+    temp.flush()
+    temp.seek(0)
+    return os.dup(temp.fileno()), lambda: None
+
+
+def pipe_output():
+    pipe = Pipe()
+    def collect():
+        chunks = []
+        while True:
+            chunk = os.read(pipe.read_fd, 65536)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+    return pipe.write_fd, collect
+
+
+def file_output():
+    temp = tempfile.TemporaryFile()
+    return os.dup(temp.fileno()), lambda: temp  # Read once the loop's done.
+
+
+def test_splice_copies_between_pipes_and_files():
+    for make_input in (pipe_input, file_input):
+        yield check_splice_copies, make_input, pipe_output
+
+
+def test_splice_copies_to_a_regular_file():
+    for make_input in (pipe_input, file_input):
+        data = os.urandom(100000)
+        input_fd, feed = make_input(data)
+        output_fd, get_temp = file_output()
+        with splice(input_fd, output_fd, bufsize=16384).background():
+            feed()
+        temp = get_temp()
+        temp.seek(0)
+        assert temp.read() == data
+
+
+def test_splice_sends_a_file_to_a_socket():
+    data = os.urandom(100000)
+    input_fd, feed = file_input(data)
+    sock_a, sock_b = socket.socketpair()
+    sock_a.setblocking(False)
+    with splice(input_fd, sock_a.fileno(), bufsize=16384).background():
+        received = []
+        while sum(map(len, received)) < len(data):
+            received.append(sock_b.recv(65536))
+    assert ''.join(received) == data
+
+
+def test_splice_only_waits_on_an_output_which_is_full():
+    from teena.thread_loop import ThreadLoop
+
+    registrations = []
+    original_add_handler = ThreadLoop.add_handler
+    def add_handler(self, fd, handler, events):
+        registrations.append(fd)
+        return original_add_handler(self, fd, handler, events)
+
+    sock_a, sock_b = socket.socketpair()
+    sock_a.setblocking(False)
+    ThreadLoop.add_handler = add_handler
+    try:
+        with Pipe() as pipe:
+            output_fd = os.dup(sock_a.fileno())
+            loop = splice(pipe.read_fd, output_fd)
+            with loop.background():
+                for i in xrange(10):
+                    os.write(pipe.write_fd, 'chunk')
+                    assert sock_b.recv(5) == 'chunk'
+                    # Long enough for the loop to find the input empty.
+                    time.sleep(0.01)
+                pipe.close_write()
+    finally:
+        ThreadLoop.add_handler = original_add_handler
+    # The input drains every time, but the output always has room.
+    assert registrations.count(pipe.read_fd) == 1
+    assert output_fd not in registrations
+    sock_a.close()
+    sock_b.close()
+
+
+def test_splice_reclassifies_reused_fds():
+    temp = tempfile.TemporaryFile()
+    input_fd = os.dup(temp.fileno())
+    temp.close()
+    assert classify(input_fd).kind == FILE
+    # Replaced behind the cache's back by a socket, which can't be sent from
+    # with sendfile().
+    in_a, in_b = socket.socketpair()
+    os.dup2(in_a.fileno(), input_fd)
+    in_a.close()
+    out_a, out_b = socket.socketpair()
+    in_b.sendall('foobar')
+    in_b.shutdown(socket.SHUT_WR)
+    handle = splice(input_fd, os.dup(out_a.fileno())).start_background()
+    finished = handle.wait(timeout=5)
+    if not finished:
+        handle.cancel()
+        handle.wait()
+    out_a.close()
+    assert finished
+    assert out_b.recv(100) == 'foobar'
+    in_b.close()
+    out_b.close()
+
+
+def test_tee_closes_a_large_fan_out_when_the_input_ends():
+    with Pipe() as input_pipe:
+        outputs = [Pipe() for _ in xrange(200)]
+        fds = [pipe.write_fd for pipe in outputs]
+        with tee(input_pipe.read_fd, fds).background():
+            os.write(input_pipe.write_fd, 'bye')
+            input_pipe.close_write()
+        for pipe in outputs:
+            assert pipe.write_closed
+            assert os.read(pipe.read_fd, 10) == 'bye'
+            pipe.close()
+
+
+## Spilling
+
+def read_all(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def test_a_slow_output_spills_to_disk_without_losing_data():
+    data = os.urandom(1 << 20)
+    spilled = []
+    class RecordingSpillFile(SpillFile):
+        def append(self, chunks):
+            spilled.append(self)
+            SpillFile.append(self, chunks)
+    tee_module = sys.modules['teena.tee']
+    sock_a, sock_b = socket.socketpair()
+    sock_a.setblocking(False)
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        tee_module.SpillFile = RecordingSpillFile
+        try:
+            loop = tee(p1.read_fd, (p2.write_fd, os.dup(sock_a.fileno())),
+                       bufsize=65536, spill_threshold=65536)
+            sock_a.close()
+            with loop.background():
+                # Nothing is read from either output until the input's
+                # done. Then the socket is sent its backlog with sendfile(),
+                # and the pipe is written it from a memory mapping.
+                os.write(p1.write_fd, data)
+                p1.close_write()
+                results = []
+                readers = [threading.Thread(target=lambda fd=fd:
+                                            results.append(read_all(fd)))
+                           for fd in (p2.read_fd, sock_b.fileno())]
+                for reader in readers:
+                    reader.start()
+                for reader in readers:
+                    reader.join()
+        finally:
+            tee_module.SpillFile = SpillFile
+    assert results == [data, data]
+    assert spilled
+
+
+def test_an_output_which_cannot_spill_is_dropped():
+    class FullSpillFile(SpillFile):
+        def append(self, chunks):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    tee_module = sys.modules['teena.tee']
+    data = os.urandom(1 << 20)
+    log_fd, log_path = tempfile.mkstemp()
+    try:
+        with nested(Pipe(), Pipe()) as (p1, slow):
+            tee_module.SpillFile = FullSpillFile
+            try:
+                # The slow output isn't read, so its backlog has to spill;
+                # the file never has one.
+                loop = tee(p1.read_fd, (slow.write_fd, log_fd),
+                           bufsize=65536, spill_threshold=65536)
+                handle = loop.start_background()
+                os.write(p1.write_fd, data)
+                p1.close_write()
+                assert handle.wait(timeout=5)
+            finally:
+                tee_module.SpillFile = SpillFile
+        with open(log_path) as log:
+            assert log.read() == data
+    finally:
+        os.unlink(log_path)
+    assert loop.stats.dropped == {slow.write_fd: 'ENOSPC'}
+
+
+def recv_all(sock, count):
+    return [sock.recv(65536) for _ in xrange(count)]
+
+
+def test_packet_mode_keeps_message_boundaries():
+    messages = ['a', 'b' * 4000, 'c' * 100, 'd' * 3000]
+    in_a, in_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    out_a, out_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    in_b.setblocking(False)
+    with nested(Pipe(direct=True), Pipe()) as (packet_pipe, pipe):
+        loop = tee(in_b.fileno(), (out_a.fileno(), packet_pipe.write_fd,
+                                   pipe.write_fd), packets=True)
+        with loop.background():
+            for message in messages:
+                in_a.send(message)
+            # A datagram socket's input ends when it's shut down.
+            in_b.shutdown(socket.SHUT_RDWR)
+            assert recv_all(out_b, 4) == messages
+            assert [os.read(packet_pipe.read_fd, 65536)
+                    for _ in messages] == messages
+            assert read_all(pipe.read_fd) == ''.join(messages)
+    for sock in (in_a, out_b):
+        sock.close()
+
+
+def test_packet_mode_skips_empty_datagrams():
+    in_a, in_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    in_b.setblocking(False)
+    with Pipe(direct=True) as packet_pipe:
+        loop = tee(in_b.fileno(), (packet_pipe.write_fd,), packets=True)
+        with loop.background():
+            in_a.send('foo')
+            in_a.send('')
+            in_a.send('bar')
+            assert os.read(packet_pipe.read_fd, 65536) == 'foo'
+            assert os.read(packet_pipe.read_fd, 65536) == 'bar'
+            assert not packet_pipe.write_closed
+            in_b.shutdown(socket.SHUT_RDWR)
+        assert os.read(packet_pipe.read_fd, 65536) == ''
+    in_a.close()
+
+
+def test_packet_mode_drops_a_message_too_big_for_an_output():
+    in_a, in_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    out_a, out_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    out_a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    with tee(in_b, (out_a,), packets=True).background():
+        for message in ('x', 'y' * 60000, 'z'):
+            in_a.send(message)
+        assert recv_all(out_b, 2) == ['x', 'z']
+        in_b.shutdown(socket.SHUT_RDWR)
+    for sock in (in_a, out_b):
+        sock.close()
+
+
+def tcp_pair():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def check_tee_to_tcp(data, **options):
+    client, server = tcp_pair()
+    # Which turns off the kernel's own sizing of the buffer.
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 14)
+    client.setblocking(False)
+    with Pipe() as pipe:
+        loop = tee(pipe.read_fd, (os.dup(client.fileno()),), bufsize=65536,
+                   **options)
+        with loop.background():
+            # The socket's backlog builds up before anything's read.
+            os.write(pipe.write_fd, data)
+            received = []
+            while sum(map(len, received)) < len(data):
+                received.append(server.recv(1 << 20))
+            sndbuf = client.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+            pipe.close_write()
+    client.close()
+    server.close()
+    assert ''.join(received) == data
+    assert loop.stats.bytes_written.values() == [len(data)]
+    return sndbuf
+
+
+def test_a_full_socket_has_its_send_buffer_grown():
+    # Otherwise, it's left at what it was set to.
+    assert check_tee_to_tcp(os.urandom(1 << 18)) == 1 << 15
+    assert check_tee_to_tcp(os.urandom(1 << 22),
+                            max_sndbuf=1 << 20) == 1 << 20
+
+
+def test_sockets_can_be_sent_data_with_zerocopy():
+    probe = socket.socket()
+    try:
+        probe.setsockopt(socket.SOL_SOCKET, rawio.SO_ZEROCOPY, 1)
+    except socket.error:
+        raise SkipTest("MSG_ZEROCOPY isn't supported here")
+    finally:
+        probe.close()
+
+    # Loopback copies the data anyway, so check that the sends were made,
+    # and that the kernel's said it's done with every one of them.
+    zerocopy_sends, completed = [0], [0]
+    def sendmsg(fd, buffers, flags=rawio.MSG_NOSIGNAL):
+        result = real_sendmsg(fd, buffers, flags)
+        if flags & rawio.MSG_ZEROCOPY and not result[1]:
+            zerocopy_sends[0] += 1
+        return result
+    def zerocopy_completions(fd):
+        ranges, err = real_zerocopy_completions(fd)
+        for first, last, copied in ranges:
+            completed[0] += (last - first) % (1 << 32) + 1
+        return ranges, err
+    real_sendmsg, rawio.sendmsg = rawio.sendmsg, sendmsg
+    real_zerocopy_completions = rawio.zerocopy_completions
+    rawio.zerocopy_completions = zerocopy_completions
+    try:
+        check_tee_to_tcp(os.urandom(1 << 22), zerocopy=True,
+                         max_sndbuf=1 << 20)
+    finally:
+        rawio.sendmsg = real_sendmsg
+        rawio.zerocopy_completions = real_zerocopy_completions
+    assert zerocopy_sends[0] > 0
+    assert completed[0] == zerocopy_sends[0]
+
+
+## Writer threads
+
+def test_outputs_can_be_written_by_several_threads():
+    data = ''.join('%06d\n' % i for i in xrange(5000))
+    outputs = [Pipe() for _ in xrange(10)]
+    fds = [pipe.write_fd for pipe in outputs]
+    log_fd, log_path = tempfile.mkstemp()
+    try:
+        with Pipe() as p1:
+            loop = tee(p1.read_fd, fds + [log_fd], writer_threads=3)
+            assert len(loop.workers) == 3
+            with loop.background():
+                os.write(p1.write_fd, data)
+                p1.close_write()
+        for pipe in outputs:
+            assert pipe.write_closed
+            assert read_all(pipe.read_fd) == data
+            pipe.close()
+        with open(log_path) as log:
+            assert log.read() == data
+    finally:
+        os.unlink(log_path)
+    assert loop.stats.bytes_read == len(data)
+    assert loop.stats.bytes_written == dict.fromkeys(fds + [log_fd],
+                                                     len(data))
+    assert loop.stats.dropped == {}
+
+
+def test_writer_threads_are_started_by_a_plain_start():
+    outputs = [Pipe() for _ in xrange(4)]
+    fds = [pipe.write_fd for pipe in outputs]
+    with Pipe() as p1:
+        loop = tee(p1.read_fd, fds, writer_threads=2)
+        thread = threading.Thread(target=loop.start)
+        thread.daemon = True
+        thread.start()
+        os.write(p1.write_fd, 'foobar')
+        p1.close_write()
+        for pipe in outputs:
+            assert select.select([pipe.read_fd], [], [], 5)[0]
+            assert read_all(pipe.read_fd) == 'foobar'
+            pipe.close()
+        loop.add_callback(loop.stop)
+        thread.join(5)
+        assert not thread.is_alive()
+    assert loop.stats.bytes_written == dict.fromkeys(fds, 6)
+    assert loop.stats.dropped == {}
+
+def test_cancelling_a_tee_cancels_its_writer_threads():
+    outputs = [Pipe() for _ in xrange(4)]
+    fds = [pipe.write_fd for pipe in outputs]
+    with Pipe() as p1:
+        handle = tee(p1.read_fd, fds, writer_threads=2).start_background()
+        assert not handle.wait(timeout=0.05)
+        handle.cancel()
+        assert handle.wait(timeout=5)
+        assert handle.stats.dropped == dict.fromkeys(fds, CANCELLED)
+        for pipe in outputs:
+            assert os.read(pipe.read_fd, 1) == ''
+            pipe.close()
+
+
+def test_a_tee_without_an_input_can_be_fed():
+    with Pipe() as p1:
+        loop = tee(None, (p1.write_fd,))
+        handle = loop.start_background()
+        assert handle.add_callback(partial(loop.feed, ['foo', 'bar']))
+        assert handle.add_callback(loop.end_input)
+        assert handle.wait(timeout=5)
+        assert read_all(p1.read_fd) == 'foobar'
+    assert not handle.add_callback(loop.end_input)
+
+
+## Shaping and priorities
+
+def check_rate_limit(output_fd, read=None):
+    data = os.urandom(50000)
+    bucket = TokenBucket(100000, burst=10000)
+    with Pipe() as p1:
+        start = time.time()
+        with tee(p1.read_fd, (output_fd,),
+                 rate_limits={output_fd: bucket}).background():
+            os.write(p1.write_fd, data)
+            p1.close_write()
+            if read is not None:
+                assert read() == data
+    # The first burst goes at once; the rest takes 0.4s to come in.
+    assert 0.35 < time.time() - start < 2
+    return data
+
+
+def test_a_rate_limited_output_is_written_no_faster_than_its_rate():
+    with Pipe() as p2:
+        check_rate_limit(p2.write_fd, lambda: read_all(p2.read_fd))
+
+
+def test_a_rate_limited_file_is_finished_before_the_tee_stops():
+    temp_fd, temp_path = tempfile.mkstemp()
+    try:
+        data = check_rate_limit(temp_fd)
+        with open(temp_path) as temp:
+            assert temp.read() == data
+    finally:
+        os.unlink(temp_path)
+
+
+def test_outputs_are_written_in_order_of_priority():
+    order = []
+    def writev(fd, chunks):
+        order.append(fd)
+        return real_writev(fd, chunks)
+    real_writev, rawio.writev = rawio.writev, writev
+    try:
+        with nested(Pipe(), Pipe(), Pipe(), Pipe()) as (p1, low, high, mid):
+            fds = [low.write_fd, high.write_fd, mid.write_fd]
+            priorities = {high.write_fd: 5, mid.write_fd: 1}
+            with tee(p1.read_fd, fds, priorities=priorities).background():
+                os.write(p1.write_fd, 'foo')
+                p1.close_write()
+    finally:
+        rawio.writev = real_writev
+    assert order == [high.write_fd, mid.write_fd, low.write_fd]
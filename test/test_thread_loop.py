@@ -1,4 +1,5 @@
 import os
+import time
 
 from teena import Error
 from teena.thread_loop import ThreadLoop
@@ -30,3 +31,14 @@ def test_thread_loop_runs_in_background():
         os.close(write_fd)
     assert ''.join(strings) == "Message 1\nMessage 2\n"
     os.close(read_fd)
+
+
+def test_a_loop_is_not_idle_until_its_timeouts_have_run():
+    called = []
+    loop = ThreadLoop()
+    loop.add_timeout(time.time() + 0.05, lambda: called.append('late'))
+    cancelled = loop.add_timeout(time.time() + 60, lambda: called.append(1))
+    loop.remove_timeout(cancelled)
+    handle = loop.start_background()
+    assert handle.wait(timeout=5)
+    assert called == ['late']
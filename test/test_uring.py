@@ -0,0 +1,85 @@
+"""Tests for the io_uring tee backend."""
+
+from contextlib import nested
+import os
+
+from nose.plugins.skip import SkipTest
+
+from teena import Pipe, splice, tee
+from teena import uring
+from teena.tee import IO_URING
+from teena.thread_loop import ThreadLoop
+
+
+def setup():
+    if not uring.is_supported():
+        raise SkipTest("io_uring is not supported on this kernel")
+
+
+def test_uring_tee_to_two_pipes():
+    with nested(Pipe(), Pipe(), Pipe()) as (p1, p2, p3):
+        loop = tee(p1.read_fd, (p2.write_fd, p3.write_fd), backend=IO_URING)
+        assert isinstance(loop, uring.URingTee)
+        with loop.background():
+            os.write(p1.write_fd, 'foobar')
+            assert os.read(p2.read_fd, 6) == 'foobar'
+            assert os.read(p3.read_fd, 6) == 'foobar'
+            p1.close_write()
+        assert os.read(p2.read_fd, 4096) == ''
+        assert os.read(p3.read_fd, 4096) == ''
+        assert p2.write_closed
+        assert p3.write_closed
+
+
+def test_uring_tee_handles_non_blocking_pipes():
+    with nested(Pipe(non_blocking=True), Pipe(non_blocking=True)) as (p1, p2):
+        data = os.urandom(200000)
+        with tee(p1.read_fd, (p2.write_fd,), backend=IO_URING).background():
+            received = []
+            written = 0
+            while written < len(data) or sum(map(len, received)) < len(data):
+                if written < len(data):
+                    try:
+                        written += os.write(p1.write_fd, data[written:])
+                    except OSError:
+                        pass
+                    if written == len(data):
+                        p1.close_write()
+                try:
+                    received.append(os.read(p2.read_fd, 65536))
+                except OSError:
+                    pass
+        assert ''.join(received) == data
+
+
+def test_uring_splice_between_pipes():
+    with nested(Pipe(), Pipe()) as (p1, p2):
+        loop = splice(p1.read_fd, p2.write_fd, backend=IO_URING)
+        assert loop.use_splice
+        with loop.background():
+            os.write(p1.write_fd, 'foobar')
+            p1.close_write()
+        assert os.read(p2.read_fd, 4096) == 'foobar'
+        assert p2.write_closed
+
+
+def test_uring_backend_falls_back_to_the_ioloop_for_its_options():
+    with nested(Pipe(), Pipe(), Pipe()) as (p1, p2, p3):
+        for options in (dict(rate_limits={p2.write_fd: 1 << 20}),
+                        dict(priorities={p2.write_fd: 1}),
+                        dict(writer_threads=2), dict(max_backlog=1 << 20)):
+            loop = tee(p1.read_fd, (p2.write_fd, p3.write_fd),
+                       backend=IO_URING, **options)
+            assert isinstance(loop, ThreadLoop), options
+
+
+def test_uring_backend_falls_back_to_the_ioloop_when_unsupported():
+    uring._supported[:] = [False]
+    try:
+        with nested(Pipe(), Pipe()) as (p1, p2):
+            loop = tee(p1.read_fd, (p2.write_fd,), backend=IO_URING)
+            assert isinstance(loop, ThreadLoop)
+            with loop.background():
+                p1.close_write()
+    finally:
+        del uring._supported[:]